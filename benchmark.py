@@ -0,0 +1,269 @@
+import os, sys
+import math, time, random, resource
+import tempfile
+
+import numpy as np
+
+import json
+import cv2
+
+import torch
+
+from run_nerf import create_arg_parser
+from data.datasets import PatchNeRFDataset
+from data.collater import Ray_Batch_Collate
+from models.nerf_net import NeRFNet
+from models.vgg import Vgg16
+from models.tineuvox import compute_bbox_by_cam_frustrm
+from engines.trainer import train_step_dynamic, VGGFeatureCache
+import utils.profiler as profiler
+from utils.precision import grad_scaler
+
+'''How to use:
+python benchmark.py --config configs/lego_dynamic.txt --patch_size 24 --bench_steps 20 --bench_json logs/bench.json
+python benchmark.py --config configs/lego_dynamic.txt --patch_size 24 --bench_baseline logs/bench.json
+python benchmark.py --config configs/lego_dynamic.txt --patch_size 24 --occ_grid --bench_check_empty --bench_steps 1
+'''
+
+# Per-stage times are the utils/profiler spans of the real training step (sampler/*, query/*, renderer, vgg, loss,
+# backward, optimizer, ...) plus the data loading span of this script. Spans nest, so shares do not add up to one.
+
+def look_at(eye, target=np.zeros(3), up=np.array([0., 0., 1.])):
+    '''Camera-to-world matrix [3, 4] of a camera looking down its -z axis at target'''
+    back = eye - target
+    back = back / np.linalg.norm(back)
+    right = np.cross(up, back)
+    right = right / np.linalg.norm(right)
+    cam_up = np.cross(back, right)
+    return np.stack([right, cam_up, back, eye], -1)
+
+
+def write_synthetic_dataset(root_dir, n_views=8, height=64, width=64, near=2., far=6., radius=4., compact=True):
+    '''Write a random dynamic scene in the gen_dataset.py layout, cameras sit on a sphere looking at the origin.
+    Args:
+      compact: write poses/intrinsics/frame_times like gen_dataset.py, otherwise dense rays/times like --save_rays.
+    Returns:
+      style_path: path of a random style image for the single style mode.
+    '''
+    rng = np.random.RandomState(0)
+    focal = float(width)
+    K = np.array([[focal, 0., width * .5], [0., focal, height * .5], [0., 0., 1.]], dtype=np.float32)
+
+    for split in ['train', 'test']:
+        dirs = rng.randn(n_views, 3)
+        dirs[:, 2] = np.abs(dirs[:, 2]) # upper hemisphere
+        dirs = dirs / np.linalg.norm(dirs, axis=-1, keepdims=True)
+        poses = np.stack([look_at(radius * d) for d in dirs], 0).astype(np.float32) # [N, 3, 4]
+        intrinsics = np.tile(K[None], (n_views, 1, 1)) # [N, 3, 3]
+        frame_times = np.linspace(0., 1., n_views).astype(np.float32) # [N,]
+        rgbs = rng.rand(n_views, height, width, 3).astype(np.float32) * 0.9 # avoid all-white patches
+
+        np.save(os.path.join(root_dir, f'rgbs_{split}.npy'), rgbs)
+        np.save(os.path.join(root_dir, f'mask_{split}.npy'), np.ones([n_views, height, width, 1], dtype=np.float32))
+        if compact:
+            np.save(os.path.join(root_dir, f'poses_{split}.npy'), poses)
+            np.save(os.path.join(root_dir, f'intrinsics_{split}.npy'), intrinsics)
+            np.save(os.path.join(root_dir, f'frame_times_{split}.npy'), frame_times)
+        else:
+            from utils.ray import get_persp_rays
+            rays = torch.stack([get_persp_rays(height, width, torch.tensor(K), torch.tensor(p)) for p in poses], 0) # [N, ro+rd, H, W, 3]
+            rays = rays.permute([0, 2, 3, 1, 4]).numpy().astype(np.float32) # [N, H, W, ro+rd, 3]
+            times = np.ones(rays.shape[:-1] + (1,), dtype=np.float32) * frame_times[:, None, None, None, None]
+            np.save(os.path.join(root_dir, f'rays_{split}.npy'), rays)
+            np.save(os.path.join(root_dir, f'times_{split}.npy'), times)
+
+    meta_dict = {
+        'H': height, 'W': width, 'focal': focal,
+        'near': near, 'far': far,
+        'i_train': list(range(n_views)), 'i_val': [], 'i_test': list(range(n_views)),
+        'white_bkgd': True, 'is_dynamic': True
+    }
+    with open(os.path.join(root_dir, 'meta.json'), 'w') as f:
+        json.dump(meta_dict, f)
+
+    style_path = os.path.join(root_dir, 'style.png')
+    cv2.imwrite(style_path, (rng.rand(height, width, 3) * 255).astype(np.uint8))
+    return style_path
+
+
+def check_empty_space_step(net, VGG, optimizer, scaler, vgg_cache, batch, near, far, stl_num, device, args):
+    '''Regression check: a training step where the occupancy grid drops every sample, as on an all-background patch,
+    must still backpropagate into every trainable parameter (otherwise backward or the DDP reducer fails)
+    '''
+    if net.occupancy_grid is None:
+        raise ValueError("--bench_check_empty requires --occ_grid")
+    bitfield = net.occupancy_grid.bitfield.clone()
+    net.occupancy_grid.bitfield.zero_()
+    try:
+        out = train_step_dynamic(net, None, VGG, batch, near, far, stl_num, optimizer, scaler, vgg_cache, device, args)
+    finally:
+        net.occupancy_grid.bitfield.copy_(bitfield)
+    missing = [n for n, p in net.named_parameters() if p.requires_grad and p.grad is None]
+    if not out['loss'].requires_grad or len(missing) > 0:
+        raise RuntimeError(f"empty space step left parameters without gradient: {missing}")
+    print(f"[Bench]: empty space step OK, loss {round(out['loss'].item(), 4)}")
+
+
+def peak_memory_mb():
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024. ** 2) if sys.platform == 'darwin' else peak / 1024.
+
+
+def run_benchmark(args, data_dir):
+    device = torch.device('cpu')
+    style_path = write_synthetic_dataset(data_dir, n_views=args.bench_views, height=args.bench_res, width=args.bench_res,
+                                         compact=not args.bench_dense)
+    train_set = PatchNeRFDataset(data_dir, split='train', patch_size=args.patch_size, style_path=style_path, with_mask=True,
+                                 patch_stride=args.patch_stride, is_dynamic=True, mmap=args.mmap_data)
+    train_loader = torch.utils.data.DataLoader(train_set, batch_size=1, shuffle=True, num_workers=args.num_workers,
+                                               collate_fn=Ray_Batch_Collate(), persistent_workers=args.num_workers > 0)
+    near, far = train_set.near_far()
+    stl_num = train_set.style_num
+
+    xyz_min, xyz_max = compute_bbox_by_cam_frustrm(train_set.rays, near, far)
+    num_voxels = args.num_voxels // (2 ** len(args.pg_scale)) if args.pg_scale else args.num_voxels
+    net = NeRFNet(netdepth=args.netdepth, netwidth=args.netwidth, netwidth_fine=args.netwidth_fine, netdepth_fine=args.netdepth_fine, no_skip=args.no_skip,
+        act_fn=args.act_fn, N_samples=args.N_samples, N_importance=args.N_importance, viewdirs=args.use_viewdirs, use_embed=args.use_embed, multires=args.multires,
+        multires_views=args.multires_views, ray_chunk=args.ray_chunk, pts_chuck=args.pts_chunk, perturb=args.perturb,
+        raw_noise_std=args.raw_noise_std, fix_param=args.fix_param, zero_viewdir=args.zero_viewdir, embed_mlp=args.embed_mlp, offset_mlp=args.offset_mlp,
+        embed_posembed=args.embed_posembed, stl_num=stl_num, is_dynamic=True, xyz_min=xyz_min, xyz_max=xyz_max, num_voxels=num_voxels, num_voxels_base=args.num_voxels_base, num_voxel_grids=args.num_voxel_grids,
+        multires_times=args.multires_times, multires_grid=args.multires_grid, deformation_depth=args.deformation_depth,
+        occ_grid=args.occ_grid, occ_grid_res=args.occ_grid_res, occ_thres=args.occ_thres, cache_viewdirs=args.cache_viewdirs,
+        grad_checkpoint=args.grad_checkpoint).to(device)
+    VGG = Vgg16(requires_grad=False, pretrained=args.vgg_pretrained).to(device)
+    optimizer = torch.optim.Adam(params=net.parameters(), lr=args.lrate, betas=(0.9, 0.999))
+    scaler = grad_scaler(args.precision)
+    vgg_cache = VGGFeatureCache(style=args.cache_style and not args.rand_style, content_size=args.content_cache_size)
+    net.train()
+
+    if args.bench_check_empty:
+        check_empty_space_step(net, VGG, optimizer, scaler, vgg_cache, next(iter(train_loader)), near, far, stl_num, device, args)
+
+    total_steps = args.bench_warmup + args.bench_steps
+    rays_per_step, step_times = [], []
+    loader_iter = iter(train_loader)
+    for step in range(total_steps):
+        t0 = time.perf_counter()
+        with profiler.span('data'):
+            try:
+                batch = next(loader_iter)
+            except StopIteration:
+                loader_iter = iter(train_loader)
+                batch = next(loader_iter)
+        out = train_step_dynamic(net, None, VGG, batch, near, far, stl_num, optimizer, scaler, vgg_cache, device, args,
+            dataset=train_set, global_step=step + 1)
+        loss = out['loss'].item()
+        step_times.append(time.perf_counter() - t0)
+        rays_per_step.append(out['n_rays'])
+        profiler.step()
+        if step + 1 == args.bench_warmup:
+            profiler.reset()
+        tag = 'warmup' if step < args.bench_warmup else 'step'
+        print(f"[Bench]: {tag} {step + 1}/{total_steps}, loss {round(loss, 4)}, {round(step_times[-1] * 1e3, 1)} ms")
+
+    step_times = np.asarray(step_times[args.bench_warmup:])
+    step_ms = float(step_times.mean() * 1e3)
+    stats = {k: {'mean_ms': v['ms'], 'calls': v['calls'], 'share': v['ms'] / max(step_ms, 1e-12)}
+             for k, v in sorted(profiler.summary().items())}
+    profiler.log(verbose=False)
+    n_rays = float(np.sum(rays_per_step[args.bench_warmup:]))
+    return {
+        'config': {
+            'netdepth': args.netdepth, 'netwidth': args.netwidth, 'N_samples': args.N_samples, 'N_importance': args.N_importance,
+            'patch_size': args.patch_size, 'patch_stride': args.patch_stride, 'num_voxels': args.num_voxels,
+            'num_voxel_grids': args.num_voxel_grids, 'occ_grid': args.occ_grid, 'cache_viewdirs': args.cache_viewdirs, 'grad_checkpoint': args.grad_checkpoint,
+            'views': args.bench_views, 'resolution': args.bench_res, 'compact': not args.bench_dense,
+            'mmap': args.mmap_data, 'precision': args.precision,
+            'cache_style': args.cache_style and not args.rand_style, 'content_cache_size': args.content_cache_size, 'threads': torch.get_num_threads(), 'torch': torch.__version__,
+        },
+        'steps': args.bench_steps,
+        'warmup': args.bench_warmup,
+        'stages': stats,
+        'step_ms': step_ms,
+        'rays_per_step': n_rays / max(args.bench_steps, 1),
+        'rays_per_sec': n_rays / max(float(step_times.sum()), 1e-12),
+        'peak_memory_mb': peak_memory_mb(),
+    }
+
+
+def print_report(result, baseline=None):
+    print(f"{'stage':<28}{'mean ms':>10}{'calls':>8}{'share':>8}" + (f"{'vs base':>10}" if baseline else ''))
+    for k, s in result['stages'].items():
+        line = f"{k:<28}{s['mean_ms']:>10.2f}{s['calls']:>8.1f}{s['share'] * 100:>7.1f}%"
+        if baseline and k in baseline['stages'] and baseline['stages'][k]['mean_ms'] > 0:
+            line += f"{s['mean_ms'] / baseline['stages'][k]['mean_ms']:>9.2f}x"
+        print(line)
+    print(f"[Bench]: step {round(result['step_ms'], 2)} ms, {round(result['rays_per_sec'], 1)} rays/sec, peak memory {round(result['peak_memory_mb'], 1)} MB")
+    if baseline:
+        print(f"[Bench]: baseline step {round(baseline['step_ms'], 2)} ms, {round(baseline['rays_per_sec'], 1)} rays/sec, "
+              f"speedup {round(baseline['step_ms'] / max(result['step_ms'], 1e-12), 3)}x")
+
+
+def create_bench_parser():
+    parser = create_arg_parser()
+    parser.add_argument('--bench_steps', type=int, default=10,
+                        help='number of timed training steps')
+    parser.add_argument('--bench_warmup', type=int, default=2,
+                        help='number of untimed steps before measuring')
+    parser.add_argument('--bench_views', type=int, default=8,
+                        help='number of synthetic views per split')
+    parser.add_argument('--bench_res', type=int, default=64,
+                        help='height and width of the synthetic views')
+    parser.add_argument('--bench_dense', action='store_true', default=False,
+                        help='write dense rays/times instead of the compact camera layout')
+    parser.add_argument('--bench_threads', type=int, default=0,
+                        help='number of torch CPU threads, 0 keeps the torch default')
+    parser.add_argument('--bench_data', type=str, default='',
+                        help='directory to keep the synthetic dataset, a temporary directory is used if empty')
+    parser.add_argument('--bench_json', type=str, default='',
+                        help='path to write the benchmark result as JSON')
+    parser.add_argument('--bench_baseline', type=str, default='',
+                        help='JSON result of a previous run to compare against')
+    parser.add_argument('--bench_check_empty', action='store_true', default=False,
+                        help='with --occ_grid, first check that a step on a fully empty occupancy grid still backpropagates')
+    parser.add_argument('--vgg_pretrained', action='store_true', default=False,
+                        help='load ImageNet weights for VGG, random weights time the same')
+    return parser
+
+
+if __name__=='__main__':
+    # Random seed
+    np.random.seed(0)
+    random.seed(0)
+    torch.manual_seed(0)
+
+    parser = create_bench_parser()
+    args, _ = parser.parse_known_args()
+    if args.bench_threads > 0:
+        torch.set_num_threads(args.bench_threads)
+    # patches must fit in the synthetic views
+    args.patch_size = min(args.patch_size, args.bench_res)
+
+    # stage times come from the profiling spans, --profile additionally writes a Chrome trace next to --bench_json
+    profiler.enable(sync=False, trace_path=args.bench_json.replace('.json', '_trace.json') if args.profile and args.bench_json else None,
+                    trace_steps=args.profile_trace_steps)
+    # the model is not wrapped in DataParallel and there is no teacher, as in a single device run without --with_teach
+    args.num_devices = 1
+    if not args.with_teach and not args.self_distilled:
+        args.loss_terms = [t for t in args.loss_terms if t != 'density']
+
+    print(f"[Info]: Benchmark {args.bench_steps} steps (+{args.bench_warmup} warmup) on CPU with {torch.get_num_threads()} threads")
+    if args.bench_data:
+        os.makedirs(args.bench_data, exist_ok=True)
+        result = run_benchmark(args, args.bench_data)
+    else:
+        with tempfile.TemporaryDirectory() as data_dir:
+            result = run_benchmark(args, data_dir)
+
+    baseline = None
+    if args.bench_baseline:
+        with open(args.bench_baseline, 'r') as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+
+    if args.bench_json:
+        os.makedirs(os.path.dirname(os.path.abspath(args.bench_json)), exist_ok=True)
+        with open(args.bench_json, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"[Info]: Saved benchmark result to {args.bench_json}")
@@ -37,7 +37,12 @@ class Ray_Batch_Collate(object):
         if "times" in xs[0]:
             batch_times = torch.stack([torch.as_tensor(x['times']) for x in xs], 0)
 
-        return batch_rays, batch_rgbs, batch_style, batch_idx, batch_mask, batch_stl_idx, batch_times
+        # patch origin, size and stride to identify repeated patches
+        batch_patch = None
+        if "patch" in xs[0]:
+            batch_patch = torch.stack([torch.as_tensor(x['patch']) for x in xs], 0)
+
+        return batch_rays, batch_rgbs, batch_style, batch_idx, batch_mask, batch_stl_idx, batch_times, batch_patch
 
 class Image_Batch_Collate(object):
     def __init__(self, H, W):
@@ -7,13 +7,65 @@ import cv2
 from glob import glob
 from pdb import set_trace as st
 
+from utils.ray import get_persp_rays
+
+def view_window(index, height, width):
+    # Split an index [i, h_slice, w_slice] of a per-view array into view id and pixel window
+    if not isinstance(index, tuple):
+        index = (index,)
+    i, h_slice, w_slice = index + (slice(None),) * (3 - len(index))
+    h0, h1, h_step = h_slice.indices(height)
+    w0, w1, w_step = w_slice.indices(width)
+    return i, (h0, h_step, len(range(h0, h1, h_step))), (w0, w_step, len(range(w0, w1, w_step)))
+
+class PerspRays:
+    '''Rays of perspective cameras generated on demand, indexed like a [N, H, W, ro+rd, 3] array'''
+
+    def __init__(self, poses, intrinsics, height, width):
+        self.poses = torch.from_numpy(poses[:, :3, :4]).float() # [N, 3, 4]
+        self.intrinsics = torch.from_numpy(intrinsics).float() # [N, 3, 3]
+        self.height, self.width = height, width
+        self.shape = (len(self.poses), height, width, 2, 3)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        i, (h0, h_step, h), (w0, w_step, w) = view_window(index, self.height, self.width)
+        # Shift and scale the principal point and focal so that the window starts at pixel (0, 0)
+        K = self.intrinsics[i].clone()
+        K[0, 0], K[0, 2] = K[0, 0] / w_step, (K[0, 2] - w0) / w_step
+        K[1, 1], K[1, 2] = K[1, 1] / h_step, (K[1, 2] - h0) / h_step
+        rays = get_persp_rays(h, w, K, self.poses[i]) # [ro+rd, h, w, 3]
+        return rays.permute([1, 2, 0, 3]) # [h, w, ro+rd, 3]
+
+class FrameTimes:
+    '''Per-view time broadcast on demand, indexed like a [N, H, W, ro+rd, 1] array'''
+
+    def __init__(self, values, height, width):
+        self.values = values.reshape(-1).astype(np.float32) # [N,]
+        self.height, self.width = height, width
+        self.shape = (len(self.values), height, width, 2, 1)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        i, (_, _, h), (_, _, w) = view_window(index, self.height, self.width)
+        return torch.full([h, w, 2, 1], float(self.values[i]))
+
 class BaseNeRFDataset(torch.utils.data.Dataset):
 
-    def __init__(self, root_dir, split='train', subsample=0, cam_id=False, rgb=True, with_mask=False, is_dynamic=False):
+    def __init__(self, root_dir, split='train', subsample=0, cam_id=False, rgb=True, with_mask=False, is_dynamic=False, mmap=False):
 
         super().__init__()
 
         self.split = split
+        # Memory-map arrays instead of loading them, patches are sliced out of the mapped files on demand
+        self.mmap = mmap
+        self.mmap_paths = {}
+        if mmap and cam_id:
+            raise ValueError('cam_id is not supported with memory-mapped datasets')
 
         # Read metadata
         with open(os.path.join(root_dir, 'meta.json'), 'r') as f:
@@ -25,36 +77,55 @@ class BaseNeRFDataset(torch.utils.data.Dataset):
 
         # Construct loaded filename
         rgbs_name, rays_name = 'rgbs_' + split, 'rays_' + split
+        poses_name, intrinsics_name = 'poses_' + split, 'intrinsics_' + split
         if with_mask:
             masks_name = 'mask_' + split
         # add subsample suffix
         if subsample != 0:
             rgbs_name, rays_name = rgbs_name + f'_x{subsample}', rays_name + f'_x{subsample}'
+            poses_name, intrinsics_name = poses_name + f'_x{subsample}', intrinsics_name + f'_x{subsample}'
             if with_mask:
                 masks_name = masks_name + f'_x{subsample}'
         # add extension name
         rgbs_name, rays_name = rgbs_name + '.npy', rays_name + '.npy'
+        poses_name, intrinsics_name = poses_name + '.npy', intrinsics_name + '.npy'
         if with_mask:
             masks_name = masks_name + '.npy'
 
-        self.rays = np.load(os.path.join(root_dir, rays_name)) # [N, H, W, ro+rd, 3]
-        print(f"[Data info]: self.rays.shape: {self.rays.shape}")
+        # Compact datasets store per-view cameras only, rays are generated on the fly
+        self.compact = os.path.exists(os.path.join(root_dir, poses_name))
+        if self.compact and cam_id:
+            raise ValueError('cam_id is not supported with compact datasets')
+        self.lazy = self.mmap or self.compact
 
         # RGB files may not exist considering exhibit set
         if rgb:
             rgb_path = os.path.join(root_dir, rgbs_name)
-            self.rgbs = np.load(rgb_path) # [N, H, W, C]
+            self.rgbs = self.load_array('rgbs', rgb_path) # [N, H, W, C]
+
+        if self.compact:
+            poses = np.load(os.path.join(root_dir, poses_name)) # [N, 3, 4]
+            intrinsics = np.load(os.path.join(root_dir, intrinsics_name)) # [N, 3, 3]
+            if rgb:
+                height, width = self.rgbs.shape[1], self.rgbs.shape[2]
+            else:
+                height, width = self.meta_dict['H'], self.meta_dict['W']
+            self.rays = PerspRays(poses, intrinsics, height, width) # [N, H, W, ro+rd, 3]
+        else:
+            self.rays = self.load_array('rays', os.path.join(root_dir, rays_name)) # [N, H, W, ro+rd, 3]
+        print(f"[Data info]: self.rays.shape: {self.rays.shape}")
 
         if with_mask:
             mask_path = os.path.join(root_dir, masks_name)
             try:
-                self.masks = np.load(mask_path) # [N, H, W, C]
+                self.masks = self.load_array('masks', mask_path) # [N, H, W, C]
             except:
                 print(f"[Warning!] mask_path {mask_path} not exist!")
-                self.masks = np.ones([self.rays.shape[0], self.rays.shape[1], self.rays.shape[2], 1])
+                self.masks = None if mmap else np.ones([self.rays.shape[0], self.rays.shape[1], self.rays.shape[2], 1])
             if "llff" in root_dir:
                 print("[Data info]: llff in root_dir")
-                self.masks = np.ones([self.rays.shape[0], self.rays.shape[1], self.rays.shape[2], 1])
+                self.mmap_paths.pop('masks', None)
+                self.masks = None if mmap else np.ones([self.rays.shape[0], self.rays.shape[1], self.rays.shape[2], 1])
         else:
             self.masks = None
 
@@ -72,8 +143,12 @@ class BaseNeRFDataset(torch.utils.data.Dataset):
 
         self.is_dynamic = is_dynamic
         if(is_dynamic):
-            times_name = "times_" + split + ".npy"
-            self.times = np.load(os.path.join(root_dir, times_name))
+            if self.compact:
+                times = np.load(os.path.join(root_dir, "frame_times_" + split + ".npy")) # [N,]
+                self.times = FrameTimes(times, self.rays.shape[1], self.rays.shape[2])
+            else:
+                times_name = "times_" + split + ".npy"
+                self.times = self.load_array('times', os.path.join(root_dir, times_name))
         # Basic attributes
         self.height = self.rays.shape[1]
         self.width = self.rays.shape[2]
@@ -81,6 +156,31 @@ class BaseNeRFDataset(torch.utils.data.Dataset):
         self.image_count = self.rays.shape[0]
         self.image_step = self.height * self.width
 
+    def load_array(self, name, path):
+        if not self.mmap:
+            return np.load(path)
+        array = np.load(path, mmap_mode='r')
+        self.mmap_paths[name] = path
+        return array
+
+    def as_tensor(self, x):
+        # Copy slices of memory-mapped arrays out of the mapping
+        if isinstance(x, np.ndarray):
+            return torch.from_numpy(np.array(x, dtype=np.float32))
+        return x
+
+    def __getstate__(self):
+        # Do not pickle memory-mapped arrays to DataLoader workers, each worker maps the files again
+        state = self.__dict__.copy()
+        for name in self.mmap_paths:
+            state[name] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name, path in self.mmap_paths.items():
+            setattr(self, name, np.load(path, mmap_mode='r'))
+
     def num_images(self):
         return self.image_count
 
@@ -90,6 +190,15 @@ class BaseNeRFDataset(torch.utils.data.Dataset):
     def near_far(self):
         return self.meta_dict['near'], self.meta_dict['far']
 
+    def frame_times(self):
+        # Unique time of each view for dynamic scenes
+        if not self.is_dynamic:
+            return None
+        if self.compact:
+            return np.unique(self.times.values)
+        times = np.asarray(self.times).reshape(self.times.shape[0], -1)[:, 0]
+        return np.unique(times)
+
 class BatchNeRFDataset(BaseNeRFDataset):
 
     def __init__(self, root_dir, split='train', subsample=0, cam_id=False):
@@ -124,9 +233,9 @@ class BatchNeRFDataset(BaseNeRFDataset):
 class PatchNeRFDataset(BaseNeRFDataset):
 
     def __init__(self, root_dir, split='train', subsample=0, cam_id=False, patch_size=48, style_path=None, with_mask=False,
-    rand_style=False, sphere_style=None, mixed_styles=None, patch_stride=1,is_dynamic=False):
+    rand_style=False, sphere_style=None, mixed_styles=None, patch_stride=1,is_dynamic=False, mmap=False):
 
-        super().__init__(root_dir, split=split, subsample=subsample, cam_id=cam_id, rgb=True, with_mask=with_mask, is_dynamic=is_dynamic)
+        super().__init__(root_dir, split=split, subsample=subsample, cam_id=cam_id, rgb=True, with_mask=with_mask, is_dynamic=is_dynamic, mmap=mmap)
 
         self.sphere_style = sphere_style
         self.crop_size = patch_size
@@ -135,17 +244,19 @@ class PatchNeRFDataset(BaseNeRFDataset):
         self.mixed_styles = mixed_styles
         self.single_style_path = style_path
         self.ps = patch_stride
-        # Cast to tensors
-        self.rays = torch.from_numpy(self.rays).float()
-        self.rgbs = torch.from_numpy(self.rgbs).float()
-        if(is_dynamic):
-            self.times = torch.from_numpy(self.times).float()
+        # Cast to tensors, memory-mapped arrays are cast per patch in __getitem__
+        if not self.lazy:
+            self.rays = torch.from_numpy(self.rays).float()
+            if(is_dynamic):
+                self.times = torch.from_numpy(self.times).float()
+        if not self.mmap:
+            self.rgbs = torch.from_numpy(self.rgbs).float()
 
-        if self.with_mask:
-            self.masks = torch.from_numpy(self.masks).float()
-            # self.masks = (self.masks >= 0.5).float()
-        else:
-            self.masks = torch.ones_like(self.rgbs)[..., 0:1]
+            if self.with_mask:
+                self.masks = torch.from_numpy(self.masks).float()
+                # self.masks = (self.masks >= 0.5).float()
+            else:
+                self.masks = torch.ones_like(self.rgbs)[..., 0:1]
         self.n_samples = self.rays.shape[0]
         self.img_h = self.rays.shape[1]
         self.img_w = self.rays.shape[2]
@@ -177,17 +288,18 @@ class PatchNeRFDataset(BaseNeRFDataset):
                     raise RuntimeError
             else:
                 raise RuntimeError
-        else:
+        elif not self.lazy:
             self.rays = self.rays.permute([0, 3, 1, 2, 4]) # [N, ro+rd, H, W, 3(+id)]
             if (is_dynamic):
                 self.times = self.times.permute([0, 3, 1, 2, 4]) # [N, ro+rd, H, W, 1]
 
         print(f"[Data info]: Random style patch is {self.rand_style}, mixtured styles is {self.mixed_styles}, single style path is {self.single_style_path}, \n \
                     sphere style is {self.sphere_style}, data mask is {self.with_mask}, image resolution is {self.img_h, self.img_w}, patch stride is {self.ps}")
-        try:
-            print(f"[Data info]: np.unique(self.masks): {np.unique(self.masks)}")
-        except:
-            pass
+        if not self.mmap:
+            try:
+                print(f"[Data info]: np.unique(self.masks): {np.unique(self.masks)}")
+            except:
+                pass
 
 
     def __len__(self):
@@ -210,18 +322,18 @@ class PatchNeRFDataset(BaseNeRFDataset):
                 h_idx_s = random.randint(0, self.img_h-self.crop_size)
                 w_idx_s = random.randint(0, self.img_w-self.crop_size)
 
-                ray_sample = self.rays[idx]
-                rgb_sample = self.rgbs[idx]
-                mask_sample = self.masks[idx]
-                rays = ray_sample[h_idx:h_idx+self.crop_size:self.ps, w_idx:w_idx+self.crop_size:self.ps, :]
-                rgbs = rgb_sample[h_idx:h_idx+self.crop_size:self.ps, w_idx:w_idx+self.crop_size:self.ps, :]
+                rgbs = self.as_tensor(self.rgbs[idx, h_idx:h_idx+self.crop_size:self.ps, w_idx:w_idx+self.crop_size:self.ps])
                 # all background
                 if torch.mean(rgbs) >= 0.99:
                     continue
                 # contains foreground
                 else:
                     break_flag = True
-                masks = mask_sample[h_idx:h_idx+self.crop_size:self.ps, w_idx:w_idx+self.crop_size:self.ps, :]
+                rays = self.as_tensor(self.rays[idx, h_idx:h_idx+self.crop_size:self.ps, w_idx:w_idx+self.crop_size:self.ps])
+                if self.masks is None:
+                    masks = torch.ones_like(rgbs)[..., 0:1]
+                else:
+                    masks = self.as_tensor(self.masks[idx, h_idx:h_idx+self.crop_size:self.ps, w_idx:w_idx+self.crop_size:self.ps])
 
                 stl_idx = 999
                 if self.mixed_styles not in [None, "None"]:
@@ -238,29 +350,42 @@ class PatchNeRFDataset(BaseNeRFDataset):
                         stls = self.img_style
                 if break_flag:
                     break
+            patch = torch.tensor([h_idx, w_idx, self.crop_size, self.ps])
             if(self.is_dynamic):
-                time_sample = self.times[idx]
-                times = time_sample[h_idx:h_idx+self.crop_size:self.ps, w_idx:w_idx+self.crop_size:self.ps, :]
-                return dict(rays = rays, target_s = rgbs, style=stls, masks=masks, idx=idx, stl_idx=stl_idx, times=times) # [3,]
+                times = self.as_tensor(self.times[idx, h_idx:h_idx+self.crop_size:self.ps, w_idx:w_idx+self.crop_size:self.ps])
+                return dict(rays = rays, target_s = rgbs, style=stls, masks=masks, idx=idx, stl_idx=stl_idx, times=times, patch=patch) # [3,]
             else:
-                return dict(rays = rays, target_s = rgbs, style=stls, masks=masks, idx=idx, stl_idx=stl_idx) # [3,]
+                return dict(rays = rays, target_s = rgbs, style=stls, masks=masks, idx=idx, stl_idx=stl_idx, patch=patch) # [3,]
         else:
+            rays, rgbs = self.rays[i], self.as_tensor(self.rgbs[i])
+            if self.lazy:
+                rays = self.as_tensor(rays).permute([2, 0, 1, 3]) # [ro+rd, H, W, 3]
+            if self.is_dynamic:
+                times = self.times[i]
+                if self.lazy:
+                    times = self.as_tensor(times).permute([2, 0, 1, 3]) # [ro+rd, H, W, 1]
             if self.with_mask:
+                masks = torch.ones_like(rgbs)[..., 0:1] if self.masks is None else self.as_tensor(self.masks[i])
                 if(self.is_dynamic):
-                    return dict(rays = self.rays[i], target_s = self.rgbs[i], mask = self.masks[i], times = self.times[i]) # [ro+rd, H, W, 3]
+                    return dict(rays = rays, target_s = rgbs, mask = masks, times = times) # [ro+rd, H, W, 3]
                 else:
-                    return dict(rays = self.rays[i], target_s = self.rgbs[i], mask = self.masks[i]) # [ro+rd, H, W, 3]
+                    return dict(rays = rays, target_s = rgbs, mask = masks) # [ro+rd, H, W, 3]
             else:
                 if(self.is_dynamic):
-                    return dict(rays = self.rays[i], target_s = self.rgbs[i], times = self.times[i]) # [ro+rd, H, W, 3]
+                    return dict(rays = rays, target_s = rgbs, times = times) # [ro+rd, H, W, 3]
                 else:
-                    return dict(rays = self.rays[i], target_s = self.rgbs[i]) # [ro+rd, H, W, 3]
+                    return dict(rays = rays, target_s = rgbs) # [ro+rd, H, W, 3]
 
 # Containing only rays for rendering, no rgb groundtruth
 class ExhibitNeRFDataset(BaseNeRFDataset):
 
-    def __init__(self, root_dir, subsample=0, is_dynamic=False):
-        super().__init__(root_dir, split='exhibit', subsample=subsample, cam_id=False, rgb=False, is_dynamic=is_dynamic)
+    def __init__(self, root_dir, subsample=0, is_dynamic=False, mmap=False):
+        super().__init__(root_dir, split='exhibit', subsample=subsample, cam_id=False, rgb=False, is_dynamic=is_dynamic, mmap=mmap)
+
+        self.img_h = self.rays.shape[1]
+        self.img_w = self.rays.shape[2]
+        if self.lazy:
+            return
 
         self.rays = torch.from_numpy(self.rays).float()
         # TODO: check this
@@ -270,14 +395,17 @@ class ExhibitNeRFDataset(BaseNeRFDataset):
         self.rays = self.rays.permute([0, 3, 1, 2, 4]) # [N, ro+rd, H, W, 3(+id)]
         if(is_dynamic):
             self.times = self.times.permute([0, 3, 1, 2, 4])
-        self.img_h = self.rays.shape[2]
-        self.img_w = self.rays.shape[3]
 
     def __len__(self):
         # return self.image_count * self.height * self.width
         return self.rays.shape[0]
 
     def __getitem__(self, i):
+        if self.lazy:
+            rays = self.as_tensor(self.rays[i]).permute([2, 0, 1, 3])
+            if(self.is_dynamic):
+                return dict(rays=rays, times=self.as_tensor(self.times[i]).permute([2, 0, 1, 3]))
+            return dict(rays=rays)
         if(self.is_dynamic):
             return dict(rays=self.rays[i], times=self.times[i])
         else:
@@ -0,0 +1,89 @@
+import os, sys
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import imageio
+import cv2
+
+# Parallel image decoding shared by the data/load_*.py loaders.
+# Decoded (and resized) uint8 images are cached on disk under a hash of the file content and the decoding
+# options, so repeated gen_dataset.py runs over the same scene skip decoding entirely.
+
+CACHE_VERSION = 1
+
+
+def _cache_key(path, size, factor, channels, imread_kwargs):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    h.update(repr((CACHE_VERSION, size, factor, channels, sorted(imread_kwargs.items()))).encode())
+    return h.hexdigest()
+
+
+def read_image(path, size=None, factor=None, channels=None, cache_dir=None, **imread_kwargs):
+    '''Decode one image into a uint8 array.
+    Args:
+      size: (W, H) the image is resized to with area interpolation.
+      factor: downsampling factor, used when size is None.
+      channels: number of leading channels kept, None keeps all.
+      cache_dir: directory of the decoded image cache, None to disable caching.
+    Returns:
+      uint8 array [H, W(, C)]
+    '''
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, _cache_key(path, size, factor, channels, imread_kwargs) + '.npy')
+        if os.path.exists(cache_path):
+            try:
+                return np.load(cache_path)
+            except (OSError, ValueError):
+                pass # partially written or corrupted entry, decode again
+
+    img = np.asarray(imageio.imread(path, **imread_kwargs))
+    if img.dtype == np.uint16:
+        img = (img >> 8).astype(np.uint8)
+    elif img.dtype != np.uint8:
+        img = np.clip(img, 0, 255).astype(np.uint8)
+    if channels is not None and img.ndim == 3:
+        img = img[..., :channels]
+    if size is None and factor is not None and factor != 1:
+        size = (int(round(img.shape[1] / factor)), int(round(img.shape[0] / factor)))
+    if size is not None and (img.shape[1], img.shape[0]) != tuple(size):
+        img = cv2.resize(img, tuple(size), interpolation=cv2.INTER_AREA)
+
+    if cache_path is not None:
+        tmp_path = cache_path[:-len('.npy')] + f'.{os.getpid()}.tmp.npy'
+        try:
+            np.save(tmp_path, img)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"[Warning!] Failed to cache {path}: {e}", file=sys.stderr)
+    return img
+
+
+def load_images(paths, size=None, factor=None, channels=None, cache_dir=None, workers=None, **imread_kwargs):
+    '''Decode images on a thread pool, PNG/JPEG decoding and cv2.resize release the GIL.
+    Args:
+      workers: number of decoding threads, defaults to the number of CPUs.
+      others: see read_image.
+    Returns:
+      uint8 array [N, H, W(, C)]
+    '''
+    paths = list(paths)
+    if cache_dir is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError as e:
+            print(f"[Warning!] Image cache {cache_dir} is not writable, decoding without cache: {e}", file=sys.stderr)
+            cache_dir = None
+    if not workers:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(paths)))
+    decode = lambda p: read_image(p, size=size, factor=factor, channels=channels, cache_dir=cache_dir, **imread_kwargs)
+    if workers == 1:
+        imgs = [decode(p) for p in paths]
+    else:
+        with ThreadPoolExecutor(workers) as pool:
+            imgs = list(pool.map(decode, paths))
+    return np.stack(imgs, 0)
@@ -6,6 +6,8 @@ import json
 import torch.nn.functional as F
 import cv2
 
+from data.image_io import load_images
+
 
 trans_t = lambda t : torch.Tensor([
     [1,0,0,0],
@@ -34,7 +36,7 @@ def pose_spherical(theta, phi, radius):
     return c2w
 
 
-def load_LINEMOD_data(basedir, half_res=False, testskip=1):
+def load_LINEMOD_data(basedir, half_res=False, testskip=1, cache_dir=None, workers=None):
     splits = ['train', 'val', 'test']
     metas = {}
     for s in splits:
@@ -53,13 +55,16 @@ def load_LINEMOD_data(basedir, half_res=False, testskip=1):
         else:
             skip = testskip
             
+        fnames = []
         for idx_test, frame in enumerate(meta['frames'][::skip]):
             fname = frame['file_path']
             if s == 'test':
                 print(f"{idx_test}th test frame: {fname}")
-            imgs.append(imageio.imread(fname))
+            fnames.append(fname)
             poses.append(np.array(frame['transform_matrix']))
-        imgs = (np.array(imgs) / 255.).astype(np.float32) # keep all 4 channels (RGBA)
+        # decoded in parallel, half_res images are downsampled while decoding
+        imgs = load_images(fnames, factor=2 if half_res else None, cache_dir=cache_dir, workers=workers)
+        imgs = (imgs / 255.).astype(np.float32) # keep all 4 channels (RGBA)
         poses = np.array(poses).astype(np.float32)
         counts.append(counts[-1] + imgs.shape[0])
         all_imgs.append(imgs)
@@ -78,16 +83,9 @@ def load_LINEMOD_data(basedir, half_res=False, testskip=1):
     render_poses = torch.stack([pose_spherical(angle, -30.0, 4.0) for angle in np.linspace(-180,180,40+1)[:-1]], 0)
     
     if half_res:
-        H = H//2
-        W = W//2
+        # H, W already come from the downsampled images
         focal = focal/2.
 
-        imgs_half_res = np.zeros((imgs.shape[0], H, W, 3))
-        for i, img in enumerate(imgs):
-            imgs_half_res[i] = cv2.resize(img, (W, H), interpolation=cv2.INTER_AREA)
-        imgs = imgs_half_res
-        # imgs = tf.image.resize_area(imgs, [400, 400]).numpy()
-
     near = np.floor(min(metas['train']['near'], metas['test']['near']))
     far = np.ceil(max(metas['train']['far'], metas['test']['far']))
     return imgs, poses, render_poses, [H, W, focal], K, i_split, near, far
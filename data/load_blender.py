@@ -7,6 +7,8 @@ import torch.nn.functional as F
 import cv2
 from pdb import set_trace as st
 
+from data.image_io import load_images
+
 trans_t = lambda t : torch.Tensor([
     [1,0,0,0],
     [0,1,0,0],
@@ -34,7 +36,7 @@ def pose_spherical(theta, phi, radius):
     return c2w
 
 
-def load_blender_data(basedir, half_res=False, testskip=1):
+def load_blender_data(basedir, half_res=False, testskip=1, cache_dir=None, workers=None):
     splits = ['train', 'val', 'test']
     metas = {}
     for s in splits:
@@ -54,12 +56,14 @@ def load_blender_data(basedir, half_res=False, testskip=1):
         else:
             skip = testskip
 
+        fnames = []
         for t, frame in enumerate(meta['frames'][::skip]):
-            fname = os.path.join(basedir, frame['file_path'] + '.png')
-            imgs.append(imageio.imread(fname))
+            fnames.append(os.path.join(basedir, frame['file_path'] + '.png'))
             poses.append(np.array(frame['transform_matrix']))
 
-        imgs = (np.array(imgs) / 255.).astype(np.float32) # keep all 4 channels (RGBA)
+        # decoded in parallel, half_res images are downsampled while decoding
+        imgs = load_images(fnames, factor=2 if half_res else None, cache_dir=cache_dir, workers=workers)
+        imgs = (imgs / 255.).astype(np.float32) # keep all 4 channels (RGBA)
         poses = np.array(poses).astype(np.float32)
 
         counts.append(counts[-1] + imgs.shape[0])
@@ -76,20 +80,11 @@ def load_blender_data(basedir, half_res=False, testskip=1):
     focal = .5 * W / np.tan(.5 * camera_angle_x)
     render_poses = torch.stack([pose_spherical(angle, -30.0, 4.0) for angle in np.linspace(-180,180,100+1)[:-1]], 0)
     print("[half res]:", half_res)
-    if half_res:
-        H = H//2
-        W = W//2
-        focal = focal/2.
-
-        imgs_half_res = np.zeros((imgs.shape[0], H, W, 4))
-        for i, img in enumerate(imgs):
-            imgs_half_res[i] = cv2.resize(img, (H, W), interpolation=cv2.INTER_AREA)
-        imgs = imgs_half_res
-        # imgs = tf.image.resize_area(imgs, [400, 400]).numpy()
+    # with half_res the images are already downsampled, H, W and focal follow from their size
 
     return imgs, poses, render_poses, [H, W, focal], i_split
 
-def load_blender_data_dynamic(basedir, half_res=False, testskip=1):
+def load_blender_data_dynamic(basedir, half_res=False, testskip=1, cache_dir=None, workers=None):
     splits = ['train', 'val', 'test']
     metas = {}
     for s in splits:
@@ -111,13 +106,16 @@ def load_blender_data_dynamic(basedir, half_res=False, testskip=1):
         else:
             skip = testskip
 
-        for t, frame in enumerate(meta['frames'][::skip]):
-            fname = os.path.join(basedir, frame['file_path'] + '.png')
-            imgs.append(imageio.imread(fname))
+        fnames = []
+        frames = meta['frames'][::skip]
+        for t, frame in enumerate(frames):
+            fnames.append(os.path.join(basedir, frame['file_path'] + '.png'))
             poses.append(np.array(frame['transform_matrix']))
-            times.append(frame['time'] if 'time' in frame else float(t) / (len(meta['frames'][::skip] - 1))) # Some datasets don't include time, need to calculate manually
+            times.append(frame['time'] if 'time' in frame else float(t) / max(len(frames) - 1, 1)) # Some datasets don't include time, need to calculate manually
 
-        imgs = (np.array(imgs) / 255.).astype(np.float32) # keep all 4 channels (RGBA)
+        # decoded in parallel, half_res images are downsampled while decoding
+        imgs = load_images(fnames, factor=2 if half_res else None, cache_dir=cache_dir, workers=workers)
+        imgs = (imgs / 255.).astype(np.float32) # keep all 4 channels (RGBA)
         poses = np.array(poses).astype(np.float32)
         times = np.array(times).astype(np.float32)
 
@@ -139,16 +137,7 @@ def load_blender_data_dynamic(basedir, half_res=False, testskip=1):
     render_poses = torch.stack([pose_spherical(angle, -30.0, 4.0) for angle in np.linspace(-180,180,100+1)[:-1]], 0)
     render_times = np.linspace(0, 1, len(render_poses))
     print("[half res]:", half_res)
-    if half_res:
-        H = H//2
-        W = W//2
-        focal = focal/2.
-
-        imgs_half_res = np.zeros((imgs.shape[0], H, W, 4))
-        for i, img in enumerate(imgs):
-            imgs_half_res[i] = cv2.resize(img, (H, W), interpolation=cv2.INTER_AREA)
-        imgs = imgs_half_res
-        # imgs = tf.image.resize_area(imgs, [400, 400]).numpy()
+    # with half_res the images are already downsampled, H, W and focal follow from their size
 
     # if(is_dynamic):
     #     return imgs, poses, times, render_poses, [H, W, focal], i_split
@@ -2,8 +2,10 @@ import os
 import numpy as np
 import imageio 
 
+from data.image_io import load_images
 
-def load_dv_data(scene='cube', basedir='/data/deepvoxels', testskip=8):
+
+def load_dv_data(scene='cube', basedir='/data/deepvoxels', testskip=8, cache_dir=None, workers=None):
     
 
     def parse_intrinsics(filepath, trgt_sidelength, invert_y=False):
@@ -82,16 +84,16 @@ def load_dv_data(scene='cube', basedir='/data/deepvoxels', testskip=8):
     valposes = valposes[::testskip]
 
     imgfiles = [f for f in sorted(os.listdir(os.path.join(deepvoxels_base, 'rgb'))) if f.endswith('png')]
-    imgs = np.stack([imageio.imread(os.path.join(deepvoxels_base, 'rgb', f))/255. for f in imgfiles], 0).astype(np.float32)
+    imgs = (load_images([os.path.join(deepvoxels_base, 'rgb', f) for f in imgfiles], cache_dir=cache_dir, workers=workers)/255.).astype(np.float32)
     
     
     testimgd = '{}/test/{}/rgb'.format(basedir, scene)
     imgfiles = [f for f in sorted(os.listdir(testimgd)) if f.endswith('png')]
-    testimgs = np.stack([imageio.imread(os.path.join(testimgd, f))/255. for f in imgfiles[::testskip]], 0).astype(np.float32)
+    testimgs = (load_images([os.path.join(testimgd, f) for f in imgfiles[::testskip]], cache_dir=cache_dir, workers=workers)/255.).astype(np.float32)
     
     valimgd = '{}/validation/{}/rgb'.format(basedir, scene)
     imgfiles = [f for f in sorted(os.listdir(valimgd)) if f.endswith('png')]
-    valimgs = np.stack([imageio.imread(os.path.join(valimgd, f))/255. for f in imgfiles[::testskip]], 0).astype(np.float32)
+    valimgs = (load_images([os.path.join(valimgd, f) for f in imgfiles[::testskip]], cache_dir=cache_dir, workers=workers)/255.).astype(np.float32)
     
     all_imgs = [imgs, valimgs, testimgs]
     counts = [0] + [x.shape[0] for x in all_imgs]
@@ -1,65 +1,13 @@
 import numpy as np
 import os, imageio
 
+from data.image_io import load_images
+
 
 ########## Slightly modified version of LLFF data loading code 
 ##########  see https://github.com/Fyusion/LLFF for original
 
-def _minify(basedir, factors=[], resolutions=[]):
-    needtoload = False
-    for r in factors:
-        imgdir = os.path.join(basedir, 'images_{}'.format(r))
-        if not os.path.exists(imgdir):
-            needtoload = True
-    for r in resolutions:
-        imgdir = os.path.join(basedir, 'images_{}x{}'.format(r[1], r[0]))
-        if not os.path.exists(imgdir):
-            needtoload = True
-    if not needtoload:
-        return
-    
-    from shutil import copy
-    from subprocess import check_output
-    
-    imgdir = os.path.join(basedir, 'images')
-    imgs = [os.path.join(imgdir, f) for f in sorted(os.listdir(imgdir))]
-    imgs = [f for f in imgs if any([f.endswith(ex) for ex in ['JPG', 'jpg', 'png', 'jpeg', 'PNG']])]
-    imgdir_orig = imgdir
-    
-    wd = os.getcwd()
-
-    for r in factors + resolutions:
-        if isinstance(r, int):
-            name = 'images_{}'.format(r)
-            resizearg = '{}%'.format(100./r)
-        else:
-            name = 'images_{}x{}'.format(r[1], r[0])
-            resizearg = '{}x{}'.format(r[1], r[0])
-        imgdir = os.path.join(basedir, name)
-        if os.path.exists(imgdir):
-            continue
-            
-        print('Minifying', r, basedir)
-        
-        os.makedirs(imgdir)
-        check_output('cp {}/* {}'.format(imgdir_orig, imgdir), shell=True)
-        
-        ext = imgs[0].split('.')[-1]
-        args = ' '.join(['mogrify', '-resize', resizearg, '-format', 'png', '*.{}'.format(ext)])
-        print(args)
-        os.chdir(imgdir)
-        check_output(args, shell=True)
-        os.chdir(wd)
-        
-        if ext != 'png':
-            check_output('rm {}/*.{}'.format(imgdir, ext), shell=True)
-            print('Removed duplicates')
-        print('Done')
-            
-        
-        
-        
-def _load_data(basedir, factor=None, width=None, height=None, load_imgs=True, crpt=False):
+def _load_data(basedir, factor=None, width=None, height=None, load_imgs=True, crpt=False, cache_dir=None, workers=None):
     
     poses_arr = np.load(os.path.join(basedir, 'poses_bounds.npy'))
     poses = poses_arr[:, :-2].reshape([-1, 3, 5]).transpose([1,2,0])
@@ -70,20 +18,21 @@ def _load_data(basedir, factor=None, width=None, height=None, load_imgs=True, cr
     sh = imageio.imread(img0).shape
     
     sfx = ''
+    size = None # (W, H) the full resolution images are downsampled to while decoding
     
     if factor is not None:
         sfx = '_{}'.format(factor)
-        _minify(basedir, factors=[factor])
+        size = (int(round(sh[1] / factor)), int(round(sh[0] / factor)))
         factor = factor
     elif height is not None:
         factor = sh[0] / float(height)
         width = int(sh[1] / factor)
-        _minify(basedir, resolutions=[[height, width]])
+        size = (width, height)
         sfx = '_{}x{}'.format(width, height)
     elif width is not None:
         factor = sh[1] / float(width)
         height = int(sh[0] / factor)
-        _minify(basedir, resolutions=[[height, width]])
+        size = (width, height)
         sfx = '_{}x{}'.format(width, height)
     else:
         factor = 1
@@ -91,6 +40,11 @@ def _load_data(basedir, factor=None, width=None, height=None, load_imgs=True, cr
     if crpt:
         sfx += "_crpt"
     imgdir = os.path.join(basedir, 'images' + sfx)
+    if size is not None and not crpt and not os.path.exists(imgdir):
+        # no minified copy on disk, downsample the full resolution images in memory (cached by load_images)
+        imgdir = os.path.join(basedir, 'images')
+    elif factor == 1 or os.path.exists(imgdir):
+        size = None
     print("imgdir:", imgdir)
 
     if not os.path.exists(imgdir):
@@ -102,21 +56,16 @@ def _load_data(basedir, factor=None, width=None, height=None, load_imgs=True, cr
         print( 'Mismatch between imgs {} and poses {} !!!!'.format(len(imgfiles), poses.shape[-1]) )
         return
     
-    sh = imageio.imread(imgfiles[0]).shape
+    sh = imageio.imread(imgfiles[0]).shape if size is None else (size[1], size[0])
     poses[:2, 4, :] = np.array(sh[:2]).reshape([2, 1])
     poses[2, 4, :] = poses[2, 4, :] * 1./factor
     
     if not load_imgs:
         return poses, bds
     
-    def imread(f):
-        if f.endswith('png'):
-            return imageio.imread(f, ignoregamma=True)
-        else:
-            return imageio.imread(f)
-        
-    imgs = imgs = [imread(f)[...,:3]/255. for f in imgfiles]
-    imgs = np.stack(imgs, -1)  
+    imread_kwargs = dict(ignoregamma=True) if imgfiles[0].endswith('png') else {}
+    imgs = load_images(imgfiles, size=size, channels=3, cache_dir=cache_dir, workers=workers, **imread_kwargs) / 255.
+    imgs = np.moveaxis(imgs, 0, -1) # [H, W, 3, N]
     
     print('Loaded image data', imgs.shape, poses[:,-1,0])
     return poses, bds, imgs
@@ -244,9 +193,9 @@ def spherify_poses(poses, bds):
     return poses_reset, new_poses, bds
     
 
-def load_llff_data(basedir, factor=8, recenter=True, bd_factor=.75, spherify=False, path_zflat=False, crpt=False):
+def load_llff_data(basedir, factor=8, recenter=True, bd_factor=.75, spherify=False, path_zflat=False, crpt=False, cache_dir=None, workers=None):
 
-    poses, bds, imgs = _load_data(basedir, factor=factor, crpt=crpt) # factor=8 downsamples original imgs by 8x
+    poses, bds, imgs = _load_data(basedir, factor=factor, crpt=crpt, cache_dir=cache_dir, workers=workers) # factor=8 downsamples original imgs by 8x
     print('Loaded', basedir, bds.min(), bds.max())
     
     # Correct rotation matrix ordering and move variable dim to axis 0
@@ -15,66 +15,98 @@ from tqdm import tqdm, trange
 
 from utils.image import to8b, img2mse, mse2psnr
 from utils.ray import get_ortho_rays
+from utils.distributed import unwrap
+from utils.video import VideoWriter
 import cv2
 from pdb import set_trace as st
 
-def eval_one_view(model, batch, near_far, device, stl_idx=None, bs=2, filter=False, **render_kwargs):
+EVAL_OUTPUTS = ('rgb', 'disp', 'acc')
+
+
+def render_tiles(model, rays, times, near_far, device, stl_idx=None, tile_rays=None, outputs=EVAL_OUTPUTS, **render_kwargs):
+    '''Render one view in tiles of whole image rows.
+    On CUDA the next tile is copied to the device on a side stream while the current one is rendered.
+    Args:
+      rays: [ro+rd, H, W, 3] host tensor.
+      times: [H, W, 1] host tensor, None for static scenes.
+      tile_rays: approximate number of rays per tile, defaults to the ray chunk of the model.
+      outputs: keys of the render dict that are kept, the others (raw, weights, coarse outputs ...) are dropped per tile.
+    Yields:
+      row0, row1, dict of the requested outputs on the device, [(row1-row0)*W, ...]
+    '''
+    img_h, img_w = rays.shape[1:3]
+    if tile_rays is None:
+        tile_rays = getattr(unwrap(model), 'chunk', 1024*32)
+    rows = max(1, tile_rays // img_w)
+    render_kwargs.setdefault('retraw', any(k.startswith('raw') for k in outputs))
+    copy_stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+
+    def upload(row0):
+        row1 = min(row0 + rows, img_h)
+        tile = [rays[:, row0:row1].reshape([2, -1, rays.shape[-1]])]
+        if times is not None:
+            tile.append(times[row0:row1].reshape([-1, times.shape[-1]]))
+        if copy_stream is None:
+            return row0, row1, [t.to(device) for t in tile]
+        with torch.cuda.stream(copy_stream):
+            return row0, row1, [t.pin_memory().to(device, non_blocking=True) for t in tile]
+
+    pending = upload(0)
+    while pending is not None:
+        row0, row1, tile = pending
+        if copy_stream is not None:
+            torch.cuda.current_stream(device).wait_stream(copy_stream)
+            for t in tile:
+                t.record_stream(torch.cuda.current_stream(device))
+        pending = upload(row1) if row1 < img_h else None
+
+        tile_rays_od, tile_times = tile[0], (tile[1][None] if len(tile) > 1 else None)
+        ret = model(tile_rays_od[0][None], tile_rays_od[1][None], tile_times, near_far, stl_idx=stl_idx, test=True, **render_kwargs)
+        yield row0, row1, {k: ret[k] for k in outputs if k in ret}
+
+
+def eval_one_view(model, batch, near_far, device, stl_idx=None, bs=1, filter=False, outputs=EVAL_OUTPUTS, tile_rays=None, **render_kwargs):
     '''Model inference
+    The view is rendered tile by tile with render_tiles, the requested outputs are copied into preallocated host images.
+    With multi_style=True in render_kwargs, stl_idx holds K style vectors and rgb/disp/acc are [K, H, W, C]
+    Args:
+      bs: unused, tiling is controlled by tile_rays.
+      outputs: keys of the render dict that are returned.
     '''
+    multi_style = render_kwargs.get('multi_style', False)
+    device = torch.device(device) if device is not None else torch.device('cpu')
     model.eval()
-    near, far = near_far
+    img_h, img_w = batch['rays'].shape[1:3]
+    times = batch['times'][0] if 'times' in batch else None # [H, W, 1]
+
+    ret_dict = {}
     with torch.no_grad():
-        batch_rays = batch['rays'].cuda()
-        # Run nerf
-        # batch size = 1 in testing
-        img_h, img_w = batch['rays'].shape[1:3]
-        batch_rays = batch_rays.permute(1, 2, 0, 3)
-        batch_rays = batch_rays.reshape([batch_rays.shape[0]*batch_rays.shape[1], 2, 3])
-        batch_rays = torch.chunk(batch_rays, bs, dim=0)
-        batch_rays = torch.stack(batch_rays)
-        batch_rays = batch_rays.permute(0, 2, 1, 3)
-
-        batch_times = None
-        if("times" in batch):
-            batch_times = batch['times'].cuda()
-            batch_times = batch_times.permute(1, 2, 0, 3)
-            batch_times = batch_times.reshape([batch_times.shape[0]*batch_times.shape[1], 2, 1])
-            batch_times = torch.chunk(batch_times, bs, dim=0)
-            batch_times = torch.stack(batch_times)
-            batch_times = batch_times.permute(0, 2, 1, 3)
-
-        # TODO: split into minibatches
-        # Disentangle ray batch
-        rays_o, rays_d = batch_rays.squeeze(0) #[2,1,3] -> [1,3] [1,3]
-        assert rays_o.shape == rays_d.shape
-        batch_times, _ = batch_times.squeeze(0)
-        # Batch inputs
-        # batch_rays_o = torch.stack(torch.split(rays_o, len(rays_o)//2))
-        # batch_rays_d = torch.stack(torch.split(rays_d, len(rays_o)//2))
-        # batch_times = torch.stack(torch.split(batch_times, len(rays_o)//2))
-        batch_rays_o = torch.unsqueeze(rays_o, 0)
-        batch_rays_d = torch.unsqueeze(rays_d, 0)
-        batch_times = torch.unsqueeze(batch_times, 0)
-
-        ret_dict = model(batch_rays_o, batch_rays_d, batch_times, (near, far), stl_idx=stl_idx, test=True, **render_kwargs)
-
-        for k, v in ret_dict.items():
-            ret_dict[k] = v.cpu()
-
-        ret_dict['rgb'] = ret_dict['rgb'].reshape([img_h, img_w, 3])
-        ret_dict['disp'] = ret_dict['disp'].reshape([img_h, img_w, 1])
-        ret_dict['acc'] = ret_dict['acc'].reshape([img_h, img_w, 1])
-
-        metric_dict = {}
-        if 'target_s' in batch:
-            target_s = batch['target_s']
-            ret_dict['target_s'] = target_s
-
-            mse = img2mse(ret_dict['rgb'], target_s)
-            metric_dict['mse'] = mse
-            metric_dict['psnr'] = mse2psnr(mse)
-
-        return ret_dict, metric_dict
+        for row0, row1, ret in render_tiles(model, batch['rays'], times, near_far, device, stl_idx=stl_idx,
+                                            tile_rays=tile_rays, outputs=outputs, **render_kwargs):
+            for k, v in ret.items():
+                if k not in ret_dict:
+                    # pinned host buffers let the device to host copies overlap the next tile
+                    ret_dict[k] = torch.empty([img_h * img_w] + list(v.shape[1:]), dtype=v.dtype, pin_memory=device.type == 'cuda')
+                ret_dict[k][row0 * img_w:row1 * img_w].copy_(v, non_blocking=True)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+
+    for k, v in ret_dict.items():
+        v = v.reshape([img_h, img_w] + list(v.shape[1:]))
+        if multi_style and v.dim() == 4:
+            v = v.permute([2, 0, 1, 3]) # [K, H, W, C]
+        ret_dict[k] = v
+
+    metric_dict = {}
+    if 'target_s' in batch and 'rgb' in ret_dict:
+        target_s = batch['target_s']
+        ret_dict['target_s'] = target_s
+
+        mse = img2mse(ret_dict['rgb'], target_s)
+        metric_dict['mse'] = mse
+        metric_dict['psnr'] = mse2psnr(mse)
+
+    return ret_dict, metric_dict
 
 
 def get_idx():
@@ -105,38 +137,53 @@ def linear_eval(model, dataset, save_dir=None,  expname=None, stl_idx=None, bs=1
     '''Main function of conditional style interpolation
     '''
     near, far = dataset.near_far()
-    rgbs, disps = [], []
     stl_idx_list = get_idx()
-    for i, batch in enumerate(tqdm(dataset, desc='Rendering')):
-        # if i >= 30:
-        #     continue
-        stl_idx = stl_idx_list[i]
-        ret_dict, metric_dict = eval_one_view(model, batch, (near, far), stl_idx=stl_idx, device=device, bs=bs)
-        img, disp = ret_dict['rgb'].numpy(), ret_dict['disp'].numpy()
-        rgbs.append(to8b(img))
-        disps.append(to8b(disp / np.max(disp)))
-    size = rgbs[-1].shape[:2]
-
-    out = cv2.VideoWriter(os.path.join(save_dir, f"rgb_{expname}_linear_eval.mp4"), cv2.VideoWriter_fourcc('M','P','4','V'), 30, (400, 400), True)
-    for i in range(len(rgbs)):
-        rgb_img = cv2.cvtColor(rgbs[i], cv2.COLOR_RGB2BGR)
-        out.write(cv2.resize(rgb_img, (400, 400)))
-    out.release()
+    writer = VideoWriter(os.path.join(save_dir, f"rgb_{expname}_linear_eval.mp4"), fps=30)
+    try:
+        for i, batch in enumerate(tqdm(dataset, desc='Rendering')):
+            # if i >= 30:
+            #     continue
+            stl_idx = stl_idx_list[i]
+            ret_dict, metric_dict = eval_one_view(model, batch, (near, far), stl_idx=stl_idx, device=device, bs=bs, outputs=('rgb',))
+            writer.write(video_frame('rgb', ret_dict['rgb'].numpy()))
+    finally:
+        writer.close()
+
+
+def style_sweep(model, dataset, save_dir, stl_idx_list=None, view_idx=0, style_batch=16, expname='', fps=30, bs=1, device=None, **render_kwargs):
+    '''Render one view under a list of style vectors, style_batch styles share one geometry pass
+    '''
+    near, far = dataset.near_far()
+    if stl_idx_list is None:
+        stl_idx_list = get_idx()
+    batch = dataset[view_idx]
+    writer = VideoWriter(os.path.join(save_dir, f"rgb_{expname}_style_sweep_{view_idx:03d}.mp4"), fps=fps)
+    try:
+        for i in tqdm(range(0, len(stl_idx_list), style_batch), desc='Rendering styles'):
+            stl_idx = torch.stack(stl_idx_list[i:i+style_batch])
+            ret_dict, _ = eval_one_view(model, batch, (near, far), stl_idx=stl_idx, device=device, bs=bs, multi_style=True, outputs=('rgb',), **render_kwargs)
+            for img in ret_dict['rgb'].numpy():
+                writer.write(video_frame('rgb', img))
+    finally:
+        writer.close()
 
 
 def evaluate(model_and_transformNet, dataset, device, save_dir=None, stl_idx=None, slice=-1, bs=1, is_dynamic=False, **render_kwargs):
     '''Main function of  evaluation
+    stl_idx may hold K style vectors [K, stl_num], all styles are then rendered in one pass per view
     '''
     if isinstance(model_and_transformNet, list):
         model, transformer = model_and_transformNet
     else:
         model = model_and_transformNet
     near, far = dataset.near_far()
+    multi_style = stl_idx is not None and stl_idx.dim() == 2 and stl_idx.shape[0] > 1
     total_mse = 0.
     for i, batch in enumerate(dataset):
         # if i == 1:
         #     return
-        ret_dict, metric_dict = eval_one_view(model, batch, (near, far), stl_idx=stl_idx, device=device, bs=bs, is_dynamic=is_dynamic, **render_kwargs)
+        ret_dict, metric_dict = eval_one_view(model, batch, (near, far), stl_idx=stl_idx, device=device, bs=bs, is_dynamic=is_dynamic,
+            multi_style=multi_style, **render_kwargs)
         if ("mse" not in metric_dict.keys()):
             metric_dict["mse"] = torch.Tensor([0])
         if ("psnr" not in metric_dict.keys()):
@@ -148,14 +195,19 @@ def evaluate(model_and_transformNet, dataset, device, save_dir=None, stl_idx=Non
         total_mse += metric_dict['mse']
 
         if save_dir is not None:
-            if stl_idx is not None:
-                idx = stl_idx.cpu().numpy().tolist()
-                idx = str(idx)
+            if multi_style:
+                styles, imgs, disps, accs = stl_idx, img, disp, acc
             else:
-                idx = ""
-            imageio.imwrite(os.path.join(save_dir, f'rgb_{i:03d}_{idx}.png'), to8b(img))
-            imageio.imwrite(os.path.join(save_dir, f'disp_{i:03d}_{idx}.png'), to8b(disp / np.max(disp)))
-            imageio.imwrite(os.path.join(save_dir, f'acc_{i:03d}_{idx}.png'), to8b(acc / np.max(acc)))
+                styles, imgs, disps, accs = [stl_idx], [img], [disp], [acc]
+            for stl, img, disp, acc in zip(styles, imgs, disps, accs):
+                if stl is not None:
+                    idx = stl.cpu().numpy().tolist()
+                    idx = str(idx)
+                else:
+                    idx = ""
+                imageio.imwrite(os.path.join(save_dir, f'rgb_{i:03d}_{idx}.png'), to8b(img))
+                imageio.imwrite(os.path.join(save_dir, f'disp_{i:03d}_{idx}.png'), to8b(disp / np.max(disp)))
+                imageio.imwrite(os.path.join(save_dir, f'acc_{i:03d}_{idx}.png'), to8b(acc / np.max(acc)))
 
     total_mse = total_mse / len(dataset)
     total_psnr = mse2psnr(total_mse)
@@ -163,29 +215,48 @@ def evaluate(model_and_transformNet, dataset, device, save_dir=None, stl_idx=Non
     return {'mse': total_mse.item(), 'psnr': total_psnr.item()}
 
 
-def render_video(model, dataset, device, save_dir, suffix='', fps=30, quality=8, expname='', stl_idx=None, bs=2, is_dynamic=False, **render_kwargs):
+def video_frame(output, x):
+    '''uint8 frame of a rendered output, disp and acc are normalized by their maximum'''
+    if output == 'rgb':
+        return to8b(x)
+    return to8b(x / max(np.max(x), 1e-10))
+
+
+def render_video(model, dataset, device, save_dir, suffix='', fps=30, quality=8, expname='', stl_idx=None, bs=2, is_dynamic=False,
+    outputs=('rgb',), size=None, resume=False, **render_kwargs):
     '''Render video
+    Frames are encoded on background threads while the next view is rendered.
+    Args:
+      outputs: rendered outputs (rgb, disp, acc) written to one video each, all from the same render pass.
+      size: (W, H) of the videos, None keeps the native resolution.
+      resume: also save every frame as PNG next to the video and skip the views whose frames are already saved.
     '''
     near, far = dataset.near_far()
-    rgbs, disps = [], []
-    for i, batch in enumerate(tqdm(dataset, desc='Rendering')):
-        # if i >= 1:
-        #     continue
-
-        ret_dict, metric_dict = eval_one_view(model, batch, (near, far), stl_idx=stl_idx, device=device, bs=bs, filter=False, is_dynamic=is_dynamic, **render_kwargs)
-        img, disp = ret_dict['rgb'].numpy(), ret_dict['disp'].numpy()
-        rgbs.append(to8b(img))
-        disps.append(to8b(disp / np.max(disp)))
-    size = rgbs[-1].shape[:2]
-
     if stl_idx is not None:
         idx = stl_idx.cpu().numpy().tolist()
         idx = str(idx)
     else:
         idx = None
 
-    out = cv2.VideoWriter(os.path.join(save_dir, f"rgb_{suffix}_{expname}_stl{idx}.mp4"), cv2.VideoWriter_fourcc('M','P','4','V'), fps, (400, 400), True)
-    for i in range(len(rgbs)):
-        rgb_img = cv2.cvtColor(rgbs[i], cv2.COLOR_RGB2BGR)
-        out.write(cv2.resize(rgb_img, (400, 400)))
-    out.release()
\ No newline at end of file
+    writers = {}
+    for output in outputs:
+        name = f"{output}_{suffix}_{expname}_stl{idx}"
+        writers[output] = VideoWriter(os.path.join(save_dir, name + '.mp4'), fps=fps, size=size,
+                                      frame_dir=os.path.join(save_dir, name + '_frames') if resume else None)
+    try:
+        skipped = 0
+        for i in trange(len(dataset), desc='Rendering'):
+            if resume and all(w.has_frame(i) for w in writers.values()):
+                for w in writers.values():
+                    w.write(None, i)
+                skipped += 1
+                continue
+            ret_dict, metric_dict = eval_one_view(model, dataset[i], (near, far), stl_idx=stl_idx, device=device, bs=bs, filter=False, is_dynamic=is_dynamic,
+                outputs=tuple(outputs), **render_kwargs)
+            for output, w in writers.items():
+                w.write(video_frame(output, ret_dict[output].numpy()), i)
+        if skipped > 0:
+            print(f"[Info]: Reused {skipped}/{len(dataset)} saved frames")
+    finally:
+        for w in writers.values():
+            w.close()
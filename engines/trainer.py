@@ -1,6 +1,7 @@
 import os, sys
 import pdb
 import math, time, random
+from collections import OrderedDict
 
 import numpy as np
 
@@ -16,6 +17,9 @@ from utils.image import to8b, img2mse, mse2psnr, img2mae, contrast_loss
 from models.nerf_net import NeRFNet
 from engines.eval import eval_one_view, evaluate, render_video
 import utils.style_utils as style_utils
+import utils.profiler as profiler
+from utils.precision import autocast, grad_scaler, float32
+from utils.distributed import is_main_process, is_distributed, unwrap
 from pdb import set_trace as st
 import cv2
 
@@ -30,6 +34,7 @@ def normalize_batch(batch):
     batch = batch.div_(255.0)
     return (batch - mean) / std
 
+@float32
 def gram_matrix(y):
     (b, ch, h, w) = y.size()
     features = y.view(b, ch, w * h)
@@ -37,17 +42,103 @@ def gram_matrix(y):
     gram = features.bmm(features_t) / (ch * h * w)
     return gram
 
+class VGGFeatureCache:
+    '''Caches VGG targets that do not change between steps.
+    Style Gram matrices are kept per style index when style images are fixed (no rand_style).
+    Content relu2_2 targets are kept in an LRU keyed by (view, patch origin, patch size, stride) if content_size > 0.
+    '''
+
+    def __init__(self, style=True, content_size=0):
+        self.style = style
+        self.content_size = content_size
+        self.grams = {}
+        self.content = OrderedDict()
+
+    @torch.no_grad()
+    def style_grams(self, VGG, style_s, stl_idx):
+        """Args:
+          style_s: [B, 3, 224, 224]. Resized style images in 0-255.
+          stl_idx: [B]. Style index of each image.
+        Returns:
+          list of [B, C, C] Gram matrices, one per VGG layer.
+        """
+        if not self.style:
+            return [gram_matrix(y) for y in VGG(normalize_batch(style_s)).values()]
+        keys = [int(i) for i in stl_idx]
+        missing = [j for j, k in enumerate(keys) if k not in self.grams]
+        if len(missing) > 0:
+            features = VGG(normalize_batch(style_s[missing]))
+            for n, j in enumerate(missing):
+                self.grams[keys[j]] = [gram_matrix(y[n:n+1]) for y in features.values()]
+        n_layers = len(self.grams[keys[0]])
+        return [torch.cat([self.grams[k][l] for k in keys], 0) for l in range(n_layers)]
+
+    @torch.no_grad()
+    def content_target(self, VGG, target_s, mask, idx, patch):
+        """Args:
+          target_s: [B, 3, 224, 224]. Resized ground truth patches in 0-255.
+          mask: [B, 1, 224, 224]. Resized masks.
+          idx: [B]. View index of each patch.
+          patch: [B, 4]. Patch origin h, w, patch size and stride.
+        Returns:
+          [B, C, H, W] relu2_2 features of the masked ground truth.
+        """
+        if self.content_size <= 0 or patch is None:
+            return VGG(normalize_batch(target_s) * mask)['relu2_2']
+        keys = [(int(i),) + tuple(int(x) for x in p) for i, p in zip(idx, patch)]
+        missing = [j for j, k in enumerate(keys) if k not in self.content]
+        if len(missing) > 0:
+            features = VGG(normalize_batch(target_s[missing]) * mask[missing])['relu2_2']
+            for n, j in enumerate(missing):
+                self.content[keys[j]] = features[n:n+1]
+                if len(self.content) > self.content_size:
+                    self.content.popitem(last=False)
+        for k in keys:
+            self.content.move_to_end(k)
+        return torch.cat([self.content[k] for k in keys], 0)
+
+def log_throughput(summary_writer, global_step, n_rays, avg_time):
+    '''Log rays per second and the peak memory since the last call, to weigh options such as --grad_checkpoint
+    '''
+    rays_per_sec = n_rays / max(avg_time, 1e-12)
+    summary_writer.add_scalar('train/rays_per_sec', rays_per_sec, global_step)
+    msg = f"[Info]: {round(rays_per_sec, 1)} rays/sec"
+    if torch.cuda.is_available():
+        peak = max(torch.cuda.max_memory_allocated(i) for i in range(torch.cuda.device_count())) / 1024**3
+        for i in range(torch.cuda.device_count()):
+            torch.cuda.reset_peak_memory_stats(i)
+        summary_writer.add_scalar('train/peak_mem_gb', peak, global_step)
+        msg += f", peak memory {round(peak, 2)} GB"
+    print(msg)
+
+def update_occupancy_grid(model, dataset, args):
+    '''Refresh the empty space skipping grid of the model
+    '''
+    model = getattr(model, 'module', model)
+    times = dataset.frame_times()
+    if times is not None and len(times) > args.occ_time_samples:
+        times = np.random.choice(times, args.occ_time_samples, replace=False)
+    model.update_occupancy_grid(times)
+    print(f"[Occupancy]: {model.occupancy_grid.bitfield.float().mean().item():.4f} of cells occupied")
+
 def train_one_epoch(model_and_VGG_and_TransformNet, optimizer, scheduler, train_loader, test_set, exhibit_set, summary_writer, global_step, max_steps,
-    run_dir, device, i_print=100, i_img=500, log_img_idx=0, i_weights=10000, i_testset=50000, i_video=50000, args=None):
+    run_dir, device, i_print=100, i_img=500, log_img_idx=0, i_weights=10000, i_testset=50000, i_video=50000, args=None, scaler=None, vgg_cache=None, ckpt_writer=None):
 
     model, teacher, VGG, transformer = model_and_VGG_and_TransformNet
     near, far = train_loader.dataset.near_far()
 
     stl_num = train_loader.dataset.style_num
 
+    # plain backward and step unless fp16 loss scaling is requested
+    if scaler is None:
+        scaler = grad_scaler(args.precision)
+    # recompute all VGG targets unless a shared cache is given
+    if vgg_cache is None:
+        vgg_cache = VGGFeatureCache(style=False)
+
     start_step = global_step
     time0 = time.time()
-    for (batch_rays, target_s, style_s, idx, mask, stl_idx) in train_loader:
+    for (batch_rays, target_s, style_s, idx, mask, stl_idx, _, patch) in train_loader:
         model.train()
 
         # counter accumulate
@@ -61,7 +152,7 @@ def train_one_epoch(model_and_VGG_and_TransformNet, optimizer, scheduler, train_
 
         # dataset pre-processing
         batch_rays, target_s, style_s, mask, stl_idx = \
-            batch_rays.cuda(), target_s.cuda(), style_s.cuda(), mask.cuda(), stl_idx.cuda()
+            batch_rays.to(device), target_s.to(device), style_s.to(device), mask.to(device), stl_idx.to(device)
 
         # nerf forward
         if stl_idx[0].item() != 999:
@@ -70,9 +161,10 @@ def train_one_epoch(model_and_VGG_and_TransformNet, optimizer, scheduler, train_
             _stl_idx = None
         # _input: 2, 12, 12, 3
         _input = batch_rays.permute(0, 3, 1, 2, 4)
-        ret_dict = model(_input, (near, far), stl_idx=_stl_idx, test=False) # no extraction
-        if teacher is not None and (not args.self_distilled):
-            ret_dict_teach = teacher(_input, (near, far), test=False)
+        with autocast(args.precision, batch_rays.device.type):
+            ret_dict = model(_input, (near, far), stl_idx=_stl_idx, test=False) # no extraction
+            if teacher is not None and (not args.self_distilled):
+                ret_dict_teach = teacher(_input, (near, far), test=False)
         optimizer.zero_grad()
 
         # print("Input:", _input.shape)
@@ -126,22 +218,19 @@ def train_one_epoch(model_and_VGG_and_TransformNet, optimizer, scheduler, train_
         _style_s = interpolate(style_s)
         _mask = interpolate(mask)
 
-        rgb_pred_features = VGG(normalize_batch(_rgb_pred) * _mask)
-        rgb_gt_features = VGG(normalize_batch(_target_s) * _mask)
-        style_features = VGG(normalize_batch(_style_s))
+        with autocast(args.precision, batch_rays.device.type):
+            rgb_pred_features = VGG(normalize_batch(_rgb_pred) * _mask)
+            content_target = vgg_cache.content_target(VGG, _target_s, _mask, idx, patch)
+            gram_style = vgg_cache.style_grams(VGG, _style_s, stl_idx)
 
         ### compute loss ###
         loss = 0
 
         # content loss
-        content_loss = img2mse(rgb_gt_features['relu2_2'], rgb_pred_features['relu2_2'])
+        content_loss = img2mse(content_target.float(), rgb_pred_features['relu2_2'].float())
 
         # style loss
         style_loss = 0.
-        gram_style = []
-        for k, y in style_features.items():
-            gram_style.append(gram_matrix(y))
-
         gram_pred = []
         for k, y in rgb_pred_features.items():
             gram_pred.append(gram_matrix(y))
@@ -163,26 +252,26 @@ def train_one_epoch(model_and_VGG_and_TransformNet, optimizer, scheduler, train_
             style_loss *= (args.perceptual_weight * args.style_weight)
             loss += (content_loss + style_loss)
         else:
-            content_loss = torch.Tensor([0]).cuda()
-            style_loss = torch.Tensor([0]).cuda()
+            content_loss = torch.Tensor([0]).to(device)
+            style_loss = torch.Tensor([0]).to(device)
 
         if "fine" in args.loss_terms:
             img_loss *= args.rgb_weight
             loss += img_loss
         else:
-            img_loss = torch.Tensor([0]).cuda()
+            img_loss = torch.Tensor([0]).to(device)
 
         if "coarse" in args.loss_terms:
             img_loss0 *= args.rgb_weight
             loss += img_loss0
         else:
-            img_loss0 = torch.Tensor([0]).cuda()
+            img_loss0 = torch.Tensor([0]).to(device)
 
         if "density" in args.loss_terms:
             if not args.self_distilled:
                 if teacher is None:
                     print(f"[Warning] teacher model is None, skip density loss")
-                    d_loss = torch.Tensor([0]).cuda()
+                    d_loss = torch.Tensor([0]).to(device)
                 else:
                     d_loss_c = img2mae(ret_dict['raw0'][..., -1].reshape(-1, 1), ret_dict_teach['raw0'][..., -1].reshape(-1, 1))
                     d_loss_f = img2mae(ret_dict['raw'][..., -1].reshape(-1, 1), ret_dict_teach['raw'][..., -1].reshape(-1, 1))
@@ -193,22 +282,30 @@ def train_one_epoch(model_and_VGG_and_TransformNet, optimizer, scheduler, train_
                 d_loss = args.d_weight * d_loss
                 loss += d_loss
         else:
-            d_loss = torch.Tensor([0]).cuda()
+            d_loss = torch.Tensor([0]).to(device)
 
         if "contrast" in args.loss_terms:
             c_loss = contrast_loss(gram_pred, stl_idx)
 
         # Optimize
-        loss.backward()
-        optimizer.step()
+        with profiler.span('backward'):
+            scaler.scale(loss).backward()
+        with profiler.span('optimizer'):
+            scaler.step(optimizer)
+            scaler.update()
         scheduler.step(global_step)
+        profiler.step()
+
+        # refresh empty space skipping
+        if args.occ_grid and global_step % args.occ_update_every == 0:
+            update_occupancy_grid(model, train_loader.dataset, args)
 
         ############################
         ##### Rest is logging ######
         ############################
 
         # logging errors
-        if (global_step % i_print == 0 and global_step > 0) or global_step == 200001:
+        if is_main_process() and ((global_step % i_print == 0 and global_step > 0) or global_step == 200001):
             dt = time.time() - time0
             time0 = time.time()
             avg_time = dt / min(global_step - start_step, i_print)
@@ -226,6 +323,8 @@ def train_one_epoch(model_and_VGG_and_TransformNet, optimizer, scheduler, train_
             # log training metric
             summary_writer.add_scalar('train/loss', loss, global_step)
             summary_writer.add_scalar('train/psnr', psnr, global_step)
+            profiler.log(summary_writer, global_step)
+            log_throughput(summary_writer, global_step, out['n_rays'], avg_time)
 
             # log learning rate
             lr_groups = {}
@@ -233,26 +332,29 @@ def train_one_epoch(model_and_VGG_and_TransformNet, optimizer, scheduler, train_
                 lr_groups['group_'+str(i)] = param['lr']
             summary_writer.add_scalars('l_rate', lr_groups, global_step)
 
+        # checkpoints, test images and videos are produced by rank 0 only, on the unwrapped model under DDP
+        eval_model = unwrap(model) if is_distributed() else model
+
         # save checkpoint
-        if global_step % i_weights == 0 and global_step > 0:
+        if is_main_process() and global_step % i_weights == 0 and global_step > 0:
             path = os.path.join(run_dir, 'checkpoints', '{:08d}.ckpt'.format(global_step))
             print('Checkpointing at', path)
-            save_checkpoint(path, global_step, model, optimizer)
+            save_checkpoint(path, global_step, model, optimizer, scaler, writer=ckpt_writer, latest='latest.ckpt')
 
         # test images
-        if (global_step % i_testset == 0 and global_step > 0) or global_step == 200001:
+        if is_main_process() and ((global_step % i_testset == 0 and global_step > 0) or global_step == 200001):
             print("Evaluating test images ...")
             save_dir = os.path.join(run_dir, 'testset_{:08d}'.format(global_step))
             os.makedirs(save_dir, exist_ok=True)
-            metric_dict = evaluate([model, transformer], test_set, device=device, save_dir=save_dir, fast_mode=args.fast_mode, stl_idx=_stl_idx, bs=args.batch_size)
+            metric_dict = evaluate([eval_model, transformer], test_set, device=device, save_dir=save_dir, fast_mode=args.fast_mode, stl_idx=_stl_idx, bs=args.batch_size)
 
             # log testing metric
             summary_writer.add_scalar('test/mse', metric_dict['mse'], global_step)
             summary_writer.add_scalar('test/psnr', metric_dict['psnr'], global_step)
 
         # exhibition video
-        if global_step % i_video==0 and global_step > 0 and exhibit_set is not None:
-            render_video(model, exhibit_set, device=device, save_dir=run_dir, suffix=str(global_step), expname=args.expname, fast_mode=args.fast_mode, stl_idx=_stl_idx, bs=args.batch_size)
+        if is_main_process() and global_step % i_video==0 and global_step > 0 and exhibit_set is not None:
+            render_video(eval_model, exhibit_set, device=device, save_dir=run_dir, suffix=str(global_step), expname=args.expname, fast_mode=args.fast_mode, stl_idx=_stl_idx, bs=args.batch_size)
 
         # End training if finished
         if global_step >= max_steps:
@@ -261,155 +363,99 @@ def train_one_epoch(model_and_VGG_and_TransformNet, optimizer, scheduler, train_
 
     return global_step
 
-def train_one_epoch_dynamic(model_and_VGG_and_TransformNet, optimizer, scheduler, train_loader, test_set, exhibit_set, summary_writer, global_step, max_steps,
-    run_dir, device, i_print=100, i_img=500, log_img_idx=0, i_weights=10000, i_testset=50000, i_video=50000, args=None):
-
-    assert(args.is_dynamic)
-
-    model, teacher, VGG, transformer = model_and_VGG_and_TransformNet
-    near, far = train_loader.dataset.near_far()
-
-    stl_num = train_loader.dataset.style_num
-
-    start_step = global_step
-    time0 = time.time()
-    for (batch_rays, target_s, style_s, idx, mask, stl_idx, times) in train_loader:
-        model.train()
-
-        # counter accumulate
-        global_step += 1
-
-        if args.scale_ps_step != -1:
-            if global_step % args.scale_ps_step == 0:
-                ps = max(1, train_loader.dataset.ps // 2)
-                print(f"[Info]: Set ps from {train_loader.dataset.ps} to {ps}")
-                train_loader.dataset.ps = ps
-
-        # dataset pre-processing
-        batch_rays, target_s, style_s, mask, stl_idx, times = \
-            batch_rays.cuda(), target_s.cuda(), style_s.cuda(), mask.cuda(), stl_idx.cuda(), times.cuda()
-        # nerf forward
-        if stl_idx[0].item() != 999:
-            _stl_idx = F.one_hot(stl_idx, num_classes=stl_num).float()
-        else:
-            _stl_idx = None
-        # _input: 2, 12, 12, 3
-        _input = batch_rays.permute(0, 3, 1, 2, 4)
-        _times = times.permute(0, 3, 1, 2, 4)
-
-        # TODO: split into minibatches
-        # Disentangle ray batch
-        rays_o, rays_d = _input.squeeze(0) #[2,1,3] -> [1,3] [1,3]
-        assert rays_o.shape == rays_d.shape
-        # Flatten ray batch
-        old_shape = rays_d.shape # [..., 3(+id)]
-        rays_o = torch.reshape(rays_o, [-1,rays_o.shape[-1]]).float()
-        rays_d = torch.reshape(rays_d, [-1,rays_d.shape[-1]]).float()
-        # Flatten time
-        if(_times is not None):
-            _times = torch.reshape(_times[:, 0, ...], [-1,_times.shape[-1]]).float()
-        # Batch inputs
-        if args.num_devices > 1:
-            batch_rays_o = torch.stack(torch.split(rays_o, len(rays_o)//args.num_devices))
-            batch_rays_d = torch.stack(torch.split(rays_d, len(rays_o)//args.num_devices))
-            batch_times = torch.stack(torch.split(_times, len(rays_o)//args.num_devices))
-        else:
-            batch_rays_o = torch.unsqueeze(rays_o, 0)
-            batch_rays_d = torch.unsqueeze(rays_d, 0)
-            batch_times = torch.unsqueeze(_times, 0)
-
-
-        # ret_dict = model(_input, (near, far), times = _times, stl_idx=_stl_idx, test=False) # no extraction
+def train_step_dynamic(model, teacher, VGG, batch, near, far, stl_num, optimizer, scaler, vgg_cache, device, args,
+    dataset=None, global_step=0):
+    '''One optimization step of train_one_epoch_dynamic, shared with benchmark.py.
+    Args:
+      batch: (batch_rays, target_s, style_s, idx, mask, stl_idx, times, patch) from Ray_Batch_Collate.
+      dataset: training set the occupancy grid is refreshed from every args.occ_update_every steps, None to skip.
+    Returns:
+      dict of the loss terms, psnr, the one-hot style vector and the number of rays of the step.
+    '''
+    batch_rays, target_s, style_s, idx, mask, stl_idx, times, patch = batch
+
+    # dataset pre-processing
+    batch_rays, target_s, style_s, mask, stl_idx, times = \
+        batch_rays.to(device), target_s.to(device), style_s.to(device), mask.to(device), stl_idx.to(device), times.to(device)
+    # nerf forward
+    if stl_idx[0].item() != 999:
+        _stl_idx = F.one_hot(stl_idx, num_classes=stl_num).float()
+    else:
+        _stl_idx = None
+    # _input: 2, 12, 12, 3
+    _input = batch_rays.permute(0, 3, 1, 2, 4)
+    _times = times.permute(0, 3, 1, 2, 4)
+
+    # TODO: split into minibatches
+    # Disentangle ray batch
+    rays_o, rays_d = _input.squeeze(0) #[2,1,3] -> [1,3] [1,3]
+    assert rays_o.shape == rays_d.shape
+    # Flatten ray batch
+    old_shape = rays_d.shape # [..., 3(+id)]
+    rays_o = torch.reshape(rays_o, [-1,rays_o.shape[-1]]).float()
+    rays_d = torch.reshape(rays_d, [-1,rays_d.shape[-1]]).float()
+    # Flatten time
+    if(_times is not None):
+        _times = torch.reshape(_times[:, 0, ...], [-1,_times.shape[-1]]).float()
+    # Batch inputs
+    if args.num_devices > 1:
+        batch_rays_o = torch.stack(torch.split(rays_o, len(rays_o)//args.num_devices))
+        batch_rays_d = torch.stack(torch.split(rays_d, len(rays_o)//args.num_devices))
+        batch_times = torch.stack(torch.split(_times, len(rays_o)//args.num_devices))
+    else:
+        batch_rays_o = torch.unsqueeze(rays_o, 0)
+        batch_rays_d = torch.unsqueeze(rays_d, 0)
+        batch_times = torch.unsqueeze(_times, 0)
+
+    with autocast(args.precision, batch_rays.device.type):
         ret_dict = model(batch_rays_o, batch_rays_d, batch_times, (near, far), stl_idx=_stl_idx, test=False) # no extraction
         if teacher is not None and (not args.self_distilled):
-            # ret_dict_teach = teacher(_input, (near, far), times = _times, test=False)
             ret_dict_teach = teacher(batch_rays_o, batch_rays_d, batch_times, (near, far), test=False)
-        optimizer.zero_grad()
-
-        # print("Input:", _input.shape)
-        # for key, val in ret_dict.items():
-        #     print(key + ":", val.shape)
-
-        # Input: torch.Size([1, 2, 36, 36, 3]) - [Batch_Size, ray origins + directions, patch_width, patch_size, ]
-        # rgb: torch.Size([1, 36, 36, 3]) - Predicted RGB values for rays.
-        # disp: torch.Size([1, 36, 36, 1]) - Disparity map. Inverse of depth map.
-        # acc: torch.Size([1, 36, 36, 1]) - Accumulated opacity (alpha) along a ray
-        # weights: torch.Size([1, 36, 36, 192]) - Weights assigned to each sampled color.
-        # depth: torch.Size([1, 36, 36, 1]) - Estimated distance to object.
-        # raw: torch.Size([1, 36, 36, 192, 4]) - raw output of (fine) NeRF
-        # z_std: torch.Size([1, 36, 36]) - std of resampled point along rays
-        # rgb0: torch.Size([1, 36, 36, 3]) - RGB output.  Coarse model output, used as "backup"
-        # disp0: torch.Size([1, 36, 36, 1]) - Disparity map. Inverse of depth map.  Coarse model output, used as "backup"
-        # acc0: torch.Size([1, 36, 36, 1]) - Accumulated opacity (alpha) along a ray.  Coarse model output, used as "backup"
-        # weights0: torch.Size([1, 36, 36, 64]) - Weights assigned to each sampled color.   Coarse model output, used as "backup"
-        # depth0: torch.Size([1, 36, 36, 1]) - Estimated distance to object.   Coarse model output, used as "backup"
-        # raw0: torch.Size([1, 36, 36, 64, 4]) - Raw outputs.  Coarse model output, used as "backup"
-
-
-        # TODO: unbind minibatches
-        # Unflatten
-        for k in ret_dict:
-            k_sh = [1] + list(old_shape[:-1]) + list(ret_dict[k].shape[1:])
-            ret_dict[k] = torch.reshape(ret_dict[k], k_sh) # [input_rays_shape, per_ray_output_shape]
-        if teacher is not None and (not args.self_distilled):
-            for k in ret_dict_teach:
-                k_sh = [1] + list(old_shape[:-1]) + list(ret_dict_teach[k].shape[1:])
-                ret_dict_teach[k] = torch.reshape(ret_dict_teach[k], k_sh) # [input_rays_shape, per_ray_output_shape]
-
-        # pre-process for VGG
-        rgb_pred0 = ret_dict['rgb0']
-        rgb_pred = ret_dict['rgb']
-        rgb_pred0, rgb_pred, target_s, style_s = \
-            rgb_pred0 * 255, rgb_pred * 255, target_s * 255, style_s * 255
-
-        # _rgb_pred0, _rgb_pred, _target_s, _style_s, _mask = \
-        #     rgb_pred0.detach().cpu().numpy()[0, ...], rgb_pred.detach().cpu().numpy()[0, ...], target_s.detach().cpu().numpy()[0, ...], style_s.detach().cpu().numpy()[0, ...], (mask*255).detach().cpu().numpy()[0, ...]
-        # cv2.imwrite("logs/vis_/_rgb_pred0.png", _rgb_pred0.astype(np.uint8))
-        # cv2.imwrite("logs/vis_/_rgb_pred.png", _rgb_pred.astype(np.uint8))
-        # cv2.imwrite("logs/vis_/_target_s.png", _target_s.astype(np.uint8))
-        # cv2.imwrite("logs/vis_/_style_s.png", _style_s.astype(np.uint8))
-        # cv2.imwrite("logs/vis_/_mask.png", _mask.astype(np.uint8))
-        # st()
-
-        # print("device: ", rgb_pred0.get_device())
-        # print("_input: ", _input.shape)
-        # print("rgb_pred0: ", rgb_pred0.shape)
-        # print("rgb_pred: ", rgb_pred.shape)
-        # print("target_s: ", target_s.shape)
-        # print("style_s: ", style_s.shape)
-
-        rgb_pred0, rgb_pred, target_s, style_s, mask = \
-            rgb_pred0.permute(0, 3, 1, 2), rgb_pred.permute(0, 3, 1, 2), target_s.permute(0, 3, 1, 2), style_s.permute(0, 3, 1, 2), mask.permute(0, 3, 1, 2)
-
-        rgb_pred0, rgb_pred, target_s, style_s, mask = \
-            torch.clamp(rgb_pred0, 0, 255, out=None), torch.clamp(rgb_pred, 0, 255, out=None), torch.clamp(target_s, 0, 255, out=None), torch.clamp(style_s, 0, 255, out=None), torch.clamp(mask, 0, 1, out=None)
-
-        ### VGG forward ###
-
-        rgb_pred0, rgb_pred, target_s, style_s, mask = \
-            torch.clamp(rgb_pred0, 0, 255, out=None), torch.clamp(rgb_pred, 0, 255, out=None), torch.clamp(target_s, 0, 255, out=None), torch.clamp(style_s, 0, 255, out=None), torch.clamp(mask, 0, 1, out=None)
-
+    optimizer.zero_grad()
+
+    # TODO: unbind minibatches
+    # Unflatten
+    for k in ret_dict:
+        k_sh = [1] + list(old_shape[:-1]) + list(ret_dict[k].shape[1:])
+        ret_dict[k] = torch.reshape(ret_dict[k], k_sh) # [input_rays_shape, per_ray_output_shape]
+    if teacher is not None and (not args.self_distilled):
+        for k in ret_dict_teach:
+            k_sh = [1] + list(old_shape[:-1]) + list(ret_dict_teach[k].shape[1:])
+            ret_dict_teach[k] = torch.reshape(ret_dict_teach[k], k_sh) # [input_rays_shape, per_ray_output_shape]
+
+    # pre-process for VGG
+    rgb_pred0 = ret_dict['rgb0']
+    rgb_pred = ret_dict['rgb']
+    rgb_pred0, rgb_pred, target_s, style_s = \
+        rgb_pred0 * 255, rgb_pred * 255, target_s * 255, style_s * 255
+
+    rgb_pred0, rgb_pred, target_s, style_s, mask = \
+        rgb_pred0.permute(0, 3, 1, 2), rgb_pred.permute(0, 3, 1, 2), target_s.permute(0, 3, 1, 2), style_s.permute(0, 3, 1, 2), mask.permute(0, 3, 1, 2)
+
+    rgb_pred0, rgb_pred, target_s, style_s, mask = \
+        torch.clamp(rgb_pred0, 0, 255, out=None), torch.clamp(rgb_pred, 0, 255, out=None), torch.clamp(target_s, 0, 255, out=None), torch.clamp(style_s, 0, 255, out=None), torch.clamp(mask, 0, 1, out=None)
+
+    ### VGG forward ###
+    with profiler.span('vgg', rgb_pred):
         _rgb_pred = interpolate(rgb_pred)
         _target_s = interpolate(target_s)
         _style_s = interpolate(style_s)
         _mask = interpolate(mask)
 
-        rgb_pred_features = VGG(normalize_batch(_rgb_pred) * _mask)
-        rgb_gt_features = VGG(normalize_batch(_target_s) * _mask)
-        style_features = VGG(normalize_batch(_style_s))
+        with autocast(args.precision, batch_rays.device.type):
+            rgb_pred_features = VGG(normalize_batch(_rgb_pred) * _mask)
+            content_target = vgg_cache.content_target(VGG, _target_s, _mask, idx, patch)
+            gram_style = vgg_cache.style_grams(VGG, _style_s, stl_idx)
 
-        ### compute loss ###
+    ### compute loss ###
+    with profiler.span('loss'):
         loss = 0
 
         # content loss
-        content_loss = img2mse(rgb_gt_features['relu2_2'], rgb_pred_features['relu2_2'])
+        content_loss = img2mse(content_target.float(), rgb_pred_features['relu2_2'].float())
 
         # style loss
         style_loss = 0.
-        gram_style = []
-        for k, y in style_features.items():
-            gram_style.append(gram_matrix(y))
-
         gram_pred = []
         for k, y in rgb_pred_features.items():
             gram_pred.append(gram_matrix(y))
@@ -417,12 +463,8 @@ def train_one_epoch_dynamic(model_and_VGG_and_TransformNet, optimizer, scheduler
         for gm_y, gm_s in zip(gram_pred, gram_style):
             style_loss += img2mse(gm_y, gm_s)
         # image loss
-        # print(rgb_pred.shape)
-        # print(target_s.shape)
         img_loss = img2mse(rgb_pred, target_s)
-        # print("IMG_LOSS:", img_loss)
         psnr = mse2psnr(img_loss)
-        view_id = list(idx.cpu().numpy())
         if 'rgb0' in ret_dict:
             img_loss0 = img2mse(rgb_pred0, target_s)
             psnr0 = mse2psnr(img_loss0)
@@ -434,26 +476,26 @@ def train_one_epoch_dynamic(model_and_VGG_and_TransformNet, optimizer, scheduler
             style_loss *= (args.perceptual_weight * args.style_weight)
             loss += (content_loss + style_loss)
         else:
-            content_loss = torch.Tensor([0]).cuda()
-            style_loss = torch.Tensor([0]).cuda()
+            content_loss = torch.Tensor([0]).to(device)
+            style_loss = torch.Tensor([0]).to(device)
 
         if "fine" in args.loss_terms:
             img_loss *= args.rgb_weight
             loss += img_loss
         else:
-            img_loss = torch.Tensor([0]).cuda()
+            img_loss = torch.Tensor([0]).to(device)
 
         if "coarse" in args.loss_terms:
             img_loss0 *= args.rgb_weight
             loss += img_loss0
         else:
-            img_loss0 = torch.Tensor([0]).cuda()
+            img_loss0 = torch.Tensor([0]).to(device)
 
         if "density" in args.loss_terms:
             if not args.self_distilled:
                 if teacher is None:
                     print(f"[Warning] teacher model is None, skip density loss")
-                    d_loss = torch.Tensor([0]).cuda()
+                    d_loss = torch.Tensor([0]).to(device)
                 else:
                     d_loss_c = img2mae(ret_dict['raw0'][..., -1].reshape(-1, 1), ret_dict_teach['raw0'][..., -1].reshape(-1, 1))
                     d_loss_f = img2mae(ret_dict['raw'][..., -1].reshape(-1, 1), ret_dict_teach['raw'][..., -1].reshape(-1, 1))
@@ -464,22 +506,70 @@ def train_one_epoch_dynamic(model_and_VGG_and_TransformNet, optimizer, scheduler
                 d_loss = args.d_weight * d_loss
                 loss += d_loss
         else:
-            d_loss = torch.Tensor([0]).cuda()
+            d_loss = torch.Tensor([0]).to(device)
 
         if "contrast" in args.loss_terms:
             c_loss = contrast_loss(gram_pred, stl_idx)
 
-        # Optimize
-        loss.backward()
-        optimizer.step()
+    # Optimize
+    with profiler.span('backward'):
+        scaler.scale(loss).backward()
+    with profiler.span('optimizer'):
+        scaler.step(optimizer)
+        scaler.update()
+
+    # refresh empty space skipping
+    if dataset is not None and args.occ_grid and global_step % args.occ_update_every == 0:
+        update_occupancy_grid(model, dataset, args)
+
+    return {'loss': loss, 'img_loss': img_loss, 'img_loss0': img_loss0, 'd_loss': d_loss, 'style_loss': style_loss,
+            'content_loss': content_loss, 'psnr': psnr, 'stl_idx': _stl_idx,
+            'n_rays': target_s.shape[0] * target_s.shape[-2] * target_s.shape[-1]}
+
+def train_one_epoch_dynamic(model_and_VGG_and_TransformNet, optimizer, scheduler, train_loader, test_set, exhibit_set, summary_writer, global_step, max_steps,
+    run_dir, device, i_print=100, i_img=500, log_img_idx=0, i_weights=10000, i_testset=50000, i_video=50000, args=None, scaler=None, vgg_cache=None, ckpt_writer=None):
+
+    assert(args.is_dynamic)
+
+    model, teacher, VGG, transformer = model_and_VGG_and_TransformNet
+    near, far = train_loader.dataset.near_far()
+
+    stl_num = train_loader.dataset.style_num
+
+    # plain backward and step unless fp16 loss scaling is requested
+    if scaler is None:
+        scaler = grad_scaler(args.precision)
+    # recompute all VGG targets unless a shared cache is given
+    if vgg_cache is None:
+        vgg_cache = VGGFeatureCache(style=False)
+
+    start_step = global_step
+    time0 = time.time()
+    for batch in train_loader:
+        model.train()
+
+        # counter accumulate
+        global_step += 1
+
+        if args.scale_ps_step != -1:
+            if global_step % args.scale_ps_step == 0:
+                ps = max(1, train_loader.dataset.ps // 2)
+                print(f"[Info]: Set ps from {train_loader.dataset.ps} to {ps}")
+                train_loader.dataset.ps = ps
+
+        out = train_step_dynamic(model, teacher, VGG, batch, near, far, stl_num, optimizer, scaler, vgg_cache, device, args,
+            dataset=train_loader.dataset, global_step=global_step)
+        loss, img_loss, d_loss, style_loss, content_loss, psnr, _stl_idx = \
+            out['loss'], out['img_loss'], out['d_loss'], out['style_loss'], out['content_loss'], out['psnr'], out['stl_idx']
         scheduler.step(global_step)
+        profiler.step()
 
         ############################
         ##### Rest is logging ######
         ############################
 
         # logging errors
-        if (global_step % i_print == 0 and global_step > 0) or global_step == 200001:
+        if is_main_process() and ((global_step % i_print == 0 and global_step > 0) or global_step == 200001):
             dt = time.time() - time0
             time0 = time.time()
             avg_time = dt / min(global_step - start_step, i_print)
@@ -496,6 +586,8 @@ def train_one_epoch_dynamic(model_and_VGG_and_TransformNet, optimizer, scheduler
             # log training metric
             summary_writer.add_scalar('train/loss', loss, global_step)
             summary_writer.add_scalar('train/psnr', psnr, global_step)
+            profiler.log(summary_writer, global_step)
+            log_throughput(summary_writer, global_step, out['n_rays'], avg_time)
 
             # log learning rate
             lr_groups = {}
@@ -503,26 +595,29 @@ def train_one_epoch_dynamic(model_and_VGG_and_TransformNet, optimizer, scheduler
                 lr_groups['group_'+str(i)] = param['lr']
             summary_writer.add_scalars('l_rate', lr_groups, global_step)
 
+        # checkpoints, test images and videos are produced by rank 0 only, on the unwrapped model under DDP
+        eval_model = unwrap(model) if is_distributed() else model
+
         # save checkpoint
-        if global_step % i_weights == 0 and global_step > 0:
+        if is_main_process() and global_step % i_weights == 0 and global_step > 0:
             path = os.path.join(run_dir, 'checkpoints', '{:08d}.ckpt'.format(global_step))
             print('Checkpointing at', path)
-            save_checkpoint(path, global_step, model, optimizer)
+            save_checkpoint(path, global_step, model, optimizer, scaler, writer=ckpt_writer, latest='latest.ckpt')
 
         # test images
-        if (global_step % i_testset == 0 and global_step > 0) or global_step == 200001 or global_step == 0:
+        if is_main_process() and ((global_step % i_testset == 0 and global_step > 0) or global_step == 200001 or global_step == 0):
             print("Evaluating test images ...")
             save_dir = os.path.join(run_dir, 'testset_{:08d}'.format(global_step))
             os.makedirs(save_dir, exist_ok=True)
-            metric_dict = evaluate([model, transformer], test_set, device=device, save_dir=save_dir, fast_mode=args.fast_mode, stl_idx=_stl_idx, bs=args.batch_size, is_dynamic=args.is_dynamic)
+            metric_dict = evaluate([eval_model, transformer], test_set, device=device, save_dir=save_dir, fast_mode=args.fast_mode, stl_idx=_stl_idx, bs=args.batch_size, is_dynamic=args.is_dynamic)
 
             # log testing metric
             summary_writer.add_scalar('test/mse', metric_dict['mse'], global_step)
             summary_writer.add_scalar('test/psnr', metric_dict['psnr'], global_step)
 
         # exhibition video
-        if global_step % i_video==0 and global_step > 0 and exhibit_set is not None:
-            render_video(model, exhibit_set, device=device, save_dir=run_dir, suffix=str(global_step), expname=args.expname, fast_mode=args.fast_mode, stl_idx=_stl_idx, bs=args.batch_size, is_dynamic=args.is_dynamic)
+        if is_main_process() and global_step % i_video==0 and global_step > 0 and exhibit_set is not None:
+            render_video(eval_model, exhibit_set, device=device, save_dir=run_dir, suffix=str(global_step), expname=args.expname, fast_mode=args.fast_mode, stl_idx=_stl_idx, bs=args.batch_size, is_dynamic=args.is_dynamic)
 
         # End training if finished
         if global_step >= max_steps:
@@ -532,10 +627,22 @@ def train_one_epoch_dynamic(model_and_VGG_and_TransformNet, optimizer, scheduler
     return global_step
 
 
-def save_checkpoint(path, global_step, model, optimizer):
+def save_checkpoint(path, global_step, model, optimizer, scaler=None, writer=None, latest=None):
+    '''Save a training checkpoint.
+    Args:
+      writer: CheckpointWriter, writes in the background and applies its retention policy to step checkpoints,
+        None to write synchronously.
+      latest: with a writer, file name in the checkpoint directory linked to this checkpoint once written,
+        also marks the checkpoint as a step checkpoint subject to retention.
+    '''
     save_dict = {
         'global_step': global_step,
         'model': model.state_dict(),
         'optimizer': optimizer.state_dict()
     }
-    torch.save(save_dict, path)
\ No newline at end of file
+    if scaler is not None and scaler.is_enabled():
+        save_dict['scaler'] = scaler.state_dict()
+    if writer is None:
+        torch.save(save_dict, path)
+    else:
+        writer.save(save_dict, path, step=global_step if latest is not None else None, latest=latest)
\ No newline at end of file
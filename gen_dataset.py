@@ -59,6 +59,14 @@ def create_arg_parser():
 
     parser.add_argument('--with_mask', action='store_true', default=False)
 
+    # image decoding
+    parser.add_argument('--decode_workers', type=int, default=0,
+        help='Number of image decoding threads, 0 uses all CPUs')
+    parser.add_argument('--image_cache', type=str, default='',
+        help='Directory of the decoded image cache (e.g. ~/.cache/ins_images), no cache if empty')
+    parser.add_argument('--save_rays', action='store_true', default=False,
+        help='Also save precomputed per-pixel rays and times (legacy format). By default only per-view cameras are saved and rays are generated on the fly')
+
     return parser
 
 def generate_dataset(args, output_path):
@@ -66,9 +74,12 @@ def generate_dataset(args, output_path):
         print('Dataset path not exists:', args.data_path)
         exit(-1)
     K = None # intrinsic matrix
+    # decoded, resized images are cached under a hash of the file content, reruns over the same scene skip decoding
+    cache_dir = os.path.expanduser(args.image_cache) if args.image_cache else None
+    io_kwargs = dict(cache_dir=cache_dir, workers=args.decode_workers)
     if args.data_type == 'llff':
         images, poses, bds, render_poses, i_test = load_llff_data(args.data_path, factor=args.factor,
-            recenter=True, bd_factor=.75, spherify=args.spherify)
+            recenter=True, bd_factor=.75, spherify=args.spherify, **io_kwargs)
         hwf = poses[0,:3,-1]
         poses = poses[:,:3,:4]
         images_tmp = images
@@ -91,10 +102,10 @@ def generate_dataset(args, output_path):
 
     elif args.data_type == 'blender':
         if(args.is_dynamic):
-            images, poses, times, render_poses, render_times, hwf, i_split = load_blender_data_dynamic(args.data_path, args.half_res, args.test_skip)
+            images, poses, times, render_poses, render_times, hwf, i_split = load_blender_data_dynamic(args.data_path, args.half_res, args.test_skip, **io_kwargs)
             print('Loaded blender', images.shape, render_poses.shape, times.shape, hwf, args.data_path)
         else:
-            images, poses, render_poses, hwf, i_split = load_blender_data(args.data_path, args.half_res, args.test_skip)
+            images, poses, render_poses, hwf, i_split = load_blender_data(args.data_path, args.half_res, args.test_skip, **io_kwargs)
             print('Loaded blender', images.shape, render_poses.shape, hwf, args.data_path)
 
         i_train, i_val, i_test = i_split
@@ -108,7 +119,7 @@ def generate_dataset(args, output_path):
             images = images[...,:3]
 
     elif args.data_type == 'LINEMOD':
-        images, poses, render_poses, hwf, K, i_split, near, far = load_LINEMOD_data(args.data_path, args.half_res, args.test_skip)
+        images, poses, render_poses, hwf, K, i_split, near, far = load_LINEMOD_data(args.data_path, args.half_res, args.test_skip, **io_kwargs)
         print(f'Loaded LINEMOD, images shape: {images.shape}, hwf: {hwf}, K: {K}')
         print(f'[CHECK HERE] near: {near}, far: {far}.')
         i_train, i_val, i_test = i_split
@@ -119,7 +130,7 @@ def generate_dataset(args, output_path):
             images = images[...,:3]
 
     elif args.data_type == 'deepvoxels':
-        images, poses, render_poses, hwf, i_split = load_dv_data(scene=args.dv_scene, basedir=args.data_path, testskip=args.test_skip)
+        images, poses, render_poses, hwf, i_split = load_dv_data(scene=args.dv_scene, basedir=args.data_path, testskip=args.test_skip, **io_kwargs)
 
         print('Loaded deepvoxels', images.shape, render_poses.shape, hwf, args.data_path)
         i_train, i_val, i_test = i_split
@@ -141,27 +152,39 @@ def generate_dataset(args, output_path):
     print('Intrinsic matrix:', K)
     print('Train/valid/test split', i_train, i_val, i_test)
 
-    print('Calculating train/valid/test rays ...')
-    rays = torch.stack([get_persp_rays(H, W, K, torch.tensor(p)) for p in tqdm(poses[:,:3,:4])], 0) # [N, ro+rd, H, W, 3]
-    if args.is_dynamic:
-        times = torch.ones(*rays.shape[:-1], 1) * times[:, None, None, None, None]
-
-    rays = rays.permute([0, 2, 3, 1, 4]).numpy().astype(np.float32) # [N, H, W, ro+rd, 3]
+    # Per-view cameras of the compact format
+    poses = np.asarray(poses[:,:3,:4], dtype=np.float32) # [N, 3, 4]
+    K = np.asarray(K, dtype=np.float32) # [3, 3]
+    intrinsics = np.tile(K[None], (len(poses), 1, 1)) # [N, 3, 3]
+
+    print('Splitting train/valid/test cameras ...')
+    poses_train, poses_val, poses_test = poses[i_train], poses[i_val], poses[i_test]
+    intrinsics_train, intrinsics_val, intrinsics_test = intrinsics[i_train], intrinsics[i_val], intrinsics[i_test]
+    rgbs_train, masks_train = images[i_train], mask[i_train]
+    rgbs_val, masks_val = images[i_val], mask[i_val]
+    rgbs_test, masks_test = images[i_test], mask[i_test]
     if(args.is_dynamic):
-        times = times.permute([0, 2, 3, 1, 4]).numpy().astype(np.float32)
+        frame_times = np.asarray(times, dtype=np.float32).reshape(-1) # [N,]
+        frame_times_train, frame_times_val, frame_times_test = frame_times[i_train], frame_times[i_val], frame_times[i_test]
 
-    if(args.is_dynamic):
-        print('Done.', rays.shape, times.shape)
-    else:
-        print('Done.', rays.shape)
+    if args.save_rays:
+        print('Calculating train/valid/test rays ...')
+        rays = torch.stack([get_persp_rays(H, W, K, torch.tensor(p)) for p in tqdm(poses)], 0) # [N, ro+rd, H, W, 3]
+        if args.is_dynamic:
+            times = torch.ones(*rays.shape[:-1], 1) * torch.tensor(frame_times)[:, None, None, None, None]
 
+        rays = rays.permute([0, 2, 3, 1, 4]).numpy().astype(np.float32) # [N, H, W, ro+rd, 3]
+        if(args.is_dynamic):
+            times = times.permute([0, 2, 3, 1, 4]).numpy().astype(np.float32)
 
-    print('Splitting train/valid/test rays ...')
-    rays_train, rgbs_train, masks_train = rays[i_train], images[i_train], mask[i_train]
-    rays_val, rgbs_val, masks_val = rays[i_val], images[i_val], mask[i_val]
-    rays_test, rgbs_test, masks_test = rays[i_test], images[i_test], mask[i_test]
-    if(args.is_dynamic):
-        times_train, times_val, times_test = times[i_train], times[i_val], times[i_test]
+        if(args.is_dynamic):
+            print('Done.', rays.shape, times.shape)
+        else:
+            print('Done.', rays.shape)
+
+        rays_train, rays_val, rays_test = rays[i_train], rays[i_val], rays[i_test]
+        if(args.is_dynamic):
+            times_train, times_val, times_test = times[i_train], times[i_val], times[i_test]
 
     '''
     save tmp poses
@@ -177,45 +200,67 @@ def generate_dataset(args, output_path):
     f.close()
     '''
 
-    print('Calculating exhibition rays ...')
-    rays_exhibit = torch.stack([get_persp_rays(H, W, K, torch.tensor(p)) for p in tqdm(render_poses[:,:3,:4])], 0) # [N, ro+rd, H, W, 3]
-    if args.is_dynamic:
-        times_exhibit = torch.ones(*rays_exhibit.shape[:-1], 1) * render_times[:, None, None, None, None]
-
-    rays_exhibit = rays_exhibit.permute([0, 2, 3, 1, 4]).numpy().astype(np.float32) # [N, H, W, ro+rd, 3]
+    poses_exhibit = np.asarray(render_poses[:,:3,:4], dtype=np.float32) # [N, 3, 4]
+    intrinsics_exhibit = np.tile(K[None], (len(poses_exhibit), 1, 1)) # [N, 3, 3]
     if(args.is_dynamic):
-        times_exhibit = times_exhibit.permute([0, 2, 3, 1, 4]).numpy().astype(np.float32)
+        frame_times_exhibit = np.asarray(render_times, dtype=np.float32).reshape(-1) # [N,]
 
-    if(args.is_dynamic):
-        print('Done.', rays_exhibit.shape, times_exhibit.shape)
-    else:
-        print('Done.', rays_exhibit.shape)
+    if args.save_rays:
+        print('Calculating exhibition rays ...')
+        rays_exhibit = torch.stack([get_persp_rays(H, W, K, torch.tensor(p)) for p in tqdm(poses_exhibit)], 0) # [N, ro+rd, H, W, 3]
+        if args.is_dynamic:
+            times_exhibit = torch.ones(*rays_exhibit.shape[:-1], 1) * torch.tensor(frame_times_exhibit)[:, None, None, None, None]
+
+        rays_exhibit = rays_exhibit.permute([0, 2, 3, 1, 4]).numpy().astype(np.float32) # [N, H, W, ro+rd, 3]
+        if(args.is_dynamic):
+            times_exhibit = times_exhibit.permute([0, 2, 3, 1, 4]).numpy().astype(np.float32)
+
+        if(args.is_dynamic):
+            print('Done.', rays_exhibit.shape, times_exhibit.shape)
+        else:
+            print('Done.', rays_exhibit.shape)
 
-    print('Training set:', rays_train.shape, rgbs_train.shape)
-    print('Validation set:', rays_val.shape, rgbs_val.shape)
-    print('Testing set:', rays_test.shape, rgbs_test.shape)
-    print('Exhibition set:', rays_exhibit.shape)
+    print('Training set:', poses_train.shape, rgbs_train.shape)
+    print('Validation set:', poses_val.shape, rgbs_val.shape)
+    print('Testing set:', poses_test.shape, rgbs_test.shape)
+    print('Exhibition set:', poses_exhibit.shape)
 
     print('Saving to: ', output_path)
-    np.save(os.path.join(output_path, 'rays_train.npy'), rays_train)
+    np.save(os.path.join(output_path, 'poses_train.npy'), poses_train)
+    np.save(os.path.join(output_path, 'intrinsics_train.npy'), intrinsics_train)
     np.save(os.path.join(output_path, 'rgbs_train.npy'), rgbs_train)
     np.save(os.path.join(output_path, 'mask_train.npy'), masks_train)
 
-    np.save(os.path.join(output_path, 'rays_val.npy'), rays_val)
+    np.save(os.path.join(output_path, 'poses_val.npy'), poses_val)
+    np.save(os.path.join(output_path, 'intrinsics_val.npy'), intrinsics_val)
     np.save(os.path.join(output_path, 'rgbs_val.npy'), rgbs_val)
     np.save(os.path.join(output_path, 'mask_val.npy'), masks_val)
 
-    np.save(os.path.join(output_path, 'rays_test.npy'), rays_test)
+    np.save(os.path.join(output_path, 'poses_test.npy'), poses_test)
+    np.save(os.path.join(output_path, 'intrinsics_test.npy'), intrinsics_test)
     np.save(os.path.join(output_path, 'rgbs_test.npy'), rgbs_test)
     np.save(os.path.join(output_path, 'mask_test.npy'), masks_test)
 
-    np.save(os.path.join(output_path, 'rays_exhibit.npy'), rays_exhibit)
+    np.save(os.path.join(output_path, 'poses_exhibit.npy'), poses_exhibit)
+    np.save(os.path.join(output_path, 'intrinsics_exhibit.npy'), intrinsics_exhibit)
 
     if(args.is_dynamic):
-        np.save(os.path.join(output_path, 'times_train.npy'), times_train)
-        np.save(os.path.join(output_path, 'times_val.npy'), times_val)
-        np.save(os.path.join(output_path, 'times_test.npy'), times_test)
-        np.save(os.path.join(output_path, 'times_exhibit.npy'), times_exhibit)
+        np.save(os.path.join(output_path, 'frame_times_train.npy'), frame_times_train)
+        np.save(os.path.join(output_path, 'frame_times_val.npy'), frame_times_val)
+        np.save(os.path.join(output_path, 'frame_times_test.npy'), frame_times_test)
+        np.save(os.path.join(output_path, 'frame_times_exhibit.npy'), frame_times_exhibit)
+
+    if args.save_rays:
+        np.save(os.path.join(output_path, 'rays_train.npy'), rays_train)
+        np.save(os.path.join(output_path, 'rays_val.npy'), rays_val)
+        np.save(os.path.join(output_path, 'rays_test.npy'), rays_test)
+        np.save(os.path.join(output_path, 'rays_exhibit.npy'), rays_exhibit)
+
+        if(args.is_dynamic):
+            np.save(os.path.join(output_path, 'times_train.npy'), times_train)
+            np.save(os.path.join(output_path, 'times_val.npy'), times_val)
+            np.save(os.path.join(output_path, 'times_test.npy'), times_test)
+            np.save(os.path.join(output_path, 'times_exhibit.npy'), times_exhibit)
 
 
     # Save meta data
@@ -22,6 +22,7 @@ def evaluate(**kwargs):
     evals_folder_name = kwargs['evals_folder_name']
     eval_cameras = kwargs['eval_cameras']
     eval_rendering = kwargs['eval_rendering']
+    device = utils.get_device(kwargs.get('device', 'auto'))
 
     expname = conf.get_string('train.expname') + kwargs['expname']
     scan_id = kwargs['scan_id'] if kwargs['scan_id'] != -1 else conf.get_int('dataset.scan_id', default=-1)
@@ -48,8 +49,7 @@ def evaluate(**kwargs):
     utils.mkdir_ifnotexists(evaldir)
 
     model = utils.get_class(conf.get_string('train.model_class'))(conf=conf.get_config('model'))
-    if torch.cuda.is_available():
-        model.cuda()
+    model.to(device)
 
     dataset_conf = conf.get_config('dataset')
     if kwargs['scan_id'] != -1:
@@ -60,7 +60,7 @@ def evaluate(**kwargs):
     scale_mat = eval_dataset.get_scale_mat()
     if eval_cameras:
         num_images = len(eval_dataset)
-        pose_vecs = torch.nn.Embedding(num_images, 7, sparse=True).cuda()
+        pose_vecs = torch.nn.Embedding(num_images, 7, sparse=True).to(device)
         pose_vecs.weight.data.copy_(eval_dataset.get_pose_init())
 
         gt_pose = eval_dataset.get_gt_pose()
@@ -76,12 +76,12 @@ def evaluate(**kwargs):
 
     old_checkpnts_dir = os.path.join(expdir, timestamp, 'checkpoints')
 
-    saved_model_state = torch.load(os.path.join(old_checkpnts_dir, 'ModelParameters', str(kwargs['checkpoint']) + ".pth"))
+    saved_model_state = torch.load(os.path.join(old_checkpnts_dir, 'ModelParameters', str(kwargs['checkpoint']) + ".pth"), map_location=device)
     model.load_state_dict(saved_model_state["model_state_dict"])
     epoch = saved_model_state['epoch']
 
     if eval_cameras:
-        data = torch.load(os.path.join(old_checkpnts_dir, 'CamParameters', str(kwargs['checkpoint']) + ".pth"))
+        data = torch.load(os.path.join(old_checkpnts_dir, 'CamParameters', str(kwargs['checkpoint']) + ".pth"), map_location=device)
         pose_vecs.load_state_dict(data["pose_vecs_state_dict"])
 
     ####################################################################################################################
@@ -107,7 +107,8 @@ def evaluate(**kwargs):
 
         mesh = plt.get_surface_high_res_mesh(
             sdf=lambda x: model.implicit_network(x)[:, 0],
-            resolution=kwargs['resolution']
+            resolution=kwargs['resolution'],
+            device=device
         )
 
         # Transform to world coordinates
@@ -128,15 +129,15 @@ def evaluate(**kwargs):
 
         psnrs = []
         for data_index, (indices, model_input, ground_truth) in enumerate(eval_dataloader):
-            model_input["intrinsics"] = model_input["intrinsics"].cuda()
-            model_input["uv"] = model_input["uv"].cuda()
-            model_input["object_mask"] = model_input["object_mask"].cuda()
+            model_input["intrinsics"] = model_input["intrinsics"].to(device)
+            model_input["uv"] = model_input["uv"].to(device)
+            model_input["object_mask"] = model_input["object_mask"].to(device)
 
             if eval_cameras:
-                pose_input = pose_vecs(indices.cuda())
+                pose_input = pose_vecs(indices.to(device))
                 model_input['pose'] = pose_input
             else:
-                model_input['pose'] = model_input['pose'].cuda()
+                model_input['pose'] = model_input['pose'].to(device)
 
             split = utils.split_input(model_input, total_pixels)
             res = []
@@ -243,6 +244,7 @@ if __name__ == '__main__':
     parser.add_argument('--expname', type=str, default='', help='The experiment name to be evaluated.')
     parser.add_argument('--exps_folder', type=str, default='exps', help='The experiments folder name.')
     parser.add_argument('--gpu', type=str, default='auto', help='GPU to use [default: GPU auto]')
+    parser.add_argument('--device', type=str, default='auto', help='Device to run on, e.g. cpu or cuda [default: cuda if available]')
     parser.add_argument('--timestamp', default='latest', type=str, help='The experiemnt timestamp to test.')
     parser.add_argument('--checkpoint', default='latest',type=str,help='The trained model checkpoint to test')
     parser.add_argument('--scan_id', type=int, default=-1, help='If set, taken to be the scan id.')
@@ -253,7 +255,9 @@ if __name__ == '__main__':
 
     opt = parser.parse_args()
 
-    if opt.gpu == "auto":
+    if opt.device == 'cpu':
+        gpu = 'ignore'
+    elif opt.gpu == "auto":
         deviceIDs = GPUtil.getAvailable(order='memory', limit=1, maxLoad=0.5, maxMemory=0.5, includeNan=False, excludeID=[], excludeUUID=[])
         gpu = deviceIDs[0]
     else:
@@ -271,5 +275,6 @@ if __name__ == '__main__':
              scan_id=opt.scan_id,
              resolution=opt.resolution,
              eval_cameras=opt.eval_cameras,
-             eval_rendering=opt.eval_rendering
+             eval_rendering=opt.eval_rendering,
+             device=opt.device
              )
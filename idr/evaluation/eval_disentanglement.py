@@ -26,6 +26,7 @@ def evaluate(**kwargs):
 
     geometry_id = kwargs['geometry_id']
     appearance_id = kwargs['appearance_id']
+    device = utils.get_device(kwargs.get('device', 'auto'))
 
     utils.mkdir_ifnotexists(os.path.join('./', evals_folder_name))
     expdir_geometry = os.path.join('./', exps_folder_name, expname + '_{0}'.format(geometry_id))
@@ -34,20 +35,18 @@ def evaluate(**kwargs):
     utils.mkdir_ifnotexists(evaldir)
 
     model = utils.get_class(conf.get_string('train.model_class'))(conf=conf.get_config('model'))
-    if torch.cuda.is_available():
-        model.cuda()
+    model.to(device)
 
     # Load geometry network model
     old_checkpnts_dir = os.path.join(expdir_geometry, timestamp, 'checkpoints')
-    saved_model_state = torch.load(os.path.join(old_checkpnts_dir, 'ModelParameters', checkpoint + ".pth"))
+    saved_model_state = torch.load(os.path.join(old_checkpnts_dir, 'ModelParameters', checkpoint + ".pth"), map_location=device)
     model.load_state_dict(saved_model_state["model_state_dict"])
 
     # Load rendering network model
     model_fake = utils.get_class(conf.get_string('train.model_class'))(conf=conf.get_config('model'))
-    if torch.cuda.is_available():
-        model_fake.cuda()
+    model_fake.to(device)
     old_checkpnts_dir = os.path.join(expdir_appearance, timestamp, 'checkpoints')
-    saved_model_state = torch.load(os.path.join(old_checkpnts_dir, 'ModelParameters', checkpoint + ".pth"))
+    saved_model_state = torch.load(os.path.join(old_checkpnts_dir, 'ModelParameters', checkpoint + ".pth"), map_location=device)
     model_fake.load_state_dict(saved_model_state["model_state_dict"])
 
     model.rendering_network = model_fake.rendering_network
@@ -69,7 +68,7 @@ def evaluate(**kwargs):
 
     model.eval()
 
-    gt_pose = eval_dataset.get_gt_pose(scaled=True).cuda()
+    gt_pose = eval_dataset.get_gt_pose(scaled=True).to(device)
     gt_quat = rend_util.rot_to_quat(gt_pose[:, :3, :3])
     gt_pose_vec = torch.cat([gt_quat, gt_pose[:, :3, 3]], 1)
 
@@ -88,7 +87,7 @@ def evaluate(**kwargs):
     q_new = CubicSpline(t_in, pose[:, :4].detach().cpu().numpy(), bc_type='periodic')
     q_new = q_new(t_out)
     q_new = q_new / np.linalg.norm(q_new, 2, 1)[:, None]
-    q_new = torch.from_numpy(q_new).cuda().float()
+    q_new = torch.from_numpy(q_new).to(device).float()
 
     images_dir = '{0}/novel_views_rendering'.format(evaldir)
     utils.mkdir_ifnotexists(images_dir)
@@ -96,19 +95,20 @@ def evaluate(**kwargs):
     indices, model_input, ground_truth = next(iter(eval_dataloader))
 
     for i, (new_q, scale) in enumerate(zip(q_new, s_new)):
-        torch.cuda.empty_cache()
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
 
         new_q = new_q.unsqueeze(0)
         new_t = -rend_util.quat_to_rot(new_q)[:, :, 2] * scale
 
-        new_p = torch.eye(4).float().cuda().unsqueeze(0)
+        new_p = torch.eye(4, device=device).float().unsqueeze(0)
         new_p[:, :3, :3] = rend_util.quat_to_rot(new_q)
         new_p[:, :3, 3] = new_t
 
         sample = {
-            "object_mask": torch.zeros_like(model_input['object_mask']).cuda().bool(),
-            "uv": model_input['uv'].cuda(),
-            "intrinsics": model_input['intrinsics'].cuda(),
+            "object_mask": torch.zeros_like(model_input['object_mask']).to(device).bool(),
+            "uv": model_input['uv'].to(device),
+            "intrinsics": model_input['intrinsics'].to(device),
             "pose": new_p
         }
 
@@ -137,12 +137,15 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--conf', type=str, default='./confs/dtu_fixed_cameras.conf')
     parser.add_argument('--gpu', type=str, default='auto', help='GPU to use [default: GPU auto]')
+    parser.add_argument('--device', type=str, default='auto', help='Device to run on, e.g. cpu or cuda [default: cuda if available]')
     parser.add_argument('--geometry_id', type=int, default=65, help='The scan id of the learned geometry.')
     parser.add_argument('--appearance_id', type=int, default=110, help='The scan id of the learned appearance.')
 
     opt = parser.parse_args()
 
-    if opt.gpu == "auto":
+    if opt.device == 'cpu':
+        gpu = 'ignore'
+    elif opt.gpu == "auto":
         deviceIDs = GPUtil.getAvailable(order='memory', limit=1, maxLoad=0.5, maxMemory=0.5, includeNan=False, excludeID=[], excludeUUID=[])
         gpu = deviceIDs[0]
     else:
@@ -155,5 +158,6 @@ if __name__ == '__main__':
              exps_folder_name='trained_models',
              evals_folder_name='evals_disentanglement',
              geometry_id=opt.geometry_id,
-             appearance_id=opt.appearance_id
+             appearance_id=opt.appearance_id,
+             device=opt.device
              )
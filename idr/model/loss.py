@@ -23,7 +23,7 @@ def gram_matrix(y):
     return gram
 
 class IDRLoss(nn.Module):
-    def __init__(self, rgb_weight, eikonal_weight, mask_weight, alpha, perceptual_weight, content_weight, style_weight):
+    def __init__(self, rgb_weight, eikonal_weight, mask_weight, alpha, perceptual_weight, content_weight, style_weight, cache_style=True):
         super().__init__()
         self.rgb_weight = float(rgb_weight)
         self.eikonal_weight = float(eikonal_weight)
@@ -37,9 +37,13 @@ class IDRLoss(nn.Module):
         
         self.VGG = Vgg16(requires_grad=False)
 
+        # The style image is fixed during training, its Gram matrices are computed once by set_style_image
+        self.cache_style = cache_style
+        self.gram_style = None
+
     def get_rgb_loss(self,rgb_values, rgb_gt, network_object_mask, object_mask):
         if (network_object_mask & object_mask).sum() == 0:
-            return torch.tensor(0.0).cuda().float()
+            return torch.tensor(0.0, device=rgb_values.device).float()
 
         rgb_values = rgb_values[network_object_mask & object_mask]
         rgb_gt = rgb_gt.reshape(-1, 3)[network_object_mask & object_mask]
@@ -48,7 +52,7 @@ class IDRLoss(nn.Module):
 
     def get_eikonal_loss(self, grad_theta):
         if grad_theta.shape[0] == 0:
-            return torch.tensor(0.0).cuda().float()
+            return torch.tensor(0.0, device=grad_theta.device).float()
 
         eikonal_loss = ((grad_theta.norm(2, dim=1) - 1) ** 2).mean()
         return eikonal_loss
@@ -56,7 +60,7 @@ class IDRLoss(nn.Module):
     def get_mask_loss(self, sdf_output, network_object_mask, object_mask):
         mask = ~(network_object_mask & object_mask)
         if mask.sum() == 0:
-            return torch.tensor(0.0).cuda().float()
+            return torch.tensor(0.0, device=sdf_output.device).float()
         sdf_pred = -self.alpha * sdf_output[mask]
         gt = object_mask[mask].float()
         mask_loss = (1 / self.alpha) * F.binary_cross_entropy_with_logits(sdf_pred.squeeze(-1), gt, reduction='sum') / float(object_mask.shape[0])
@@ -66,28 +70,23 @@ class IDRLoss(nn.Module):
         bs = rgb_gt.shape[0]
         rgb_pred = rgb_values.reshape(bs, img_res, img_res, rgb_values.shape[-1]) * 255.0
         target_s = rgb_gt.reshape(bs, img_res, img_res, rgb_gt.shape[-1]) * 255.0
-        style_s = style_img * 255.0
         mask = object_mask.float().reshape(bs, img_res, img_res, 1)
 
         # [B, H, W, C] -> [B, C, H, W]
         rgb_pred = rgb_pred.permute(0, 3, 1, 2)
         target_s = target_s.permute(0, 3, 1, 2)
-        style_s = style_s.permute(0, 3, 1, 2)
         mask = mask.permute(0, 3, 1, 2)
 
         rgb_pred = torch.clamp(rgb_pred, 0., 255., out=None)
         target_s = torch.clamp(target_s, 0., 255., out=None)
-        style_s = torch.clamp(style_s, 0., 255., out=None)
         mask = torch.clamp(mask, 0., 1., out=None)
         
         _rgb_pred = interpolate(rgb_pred)
         _target_s = interpolate(target_s)
-        _style_s = interpolate(style_s)
         _mask = interpolate(mask)
     
         rgb_pred_features = self.VGG(normalize_batch(_rgb_pred) * _mask)
         rgb_gt_features = self.VGG(normalize_batch(_target_s) * _mask)
-        style_features = self.VGG(normalize_batch(_style_s))
 
 
         def img2mse(x, y, mask=None):
@@ -101,22 +100,40 @@ class IDRLoss(nn.Module):
 
         # style loss
         style_loss = 0.
-        gram_style = []
-        for k, y in style_features.items():
-            gram_style.append(gram_matrix(y))
-        
+        gram_style = self.get_style_grams(style_img)
+
         gram_pred = []
         for k, y in rgb_pred_features.items():
             gram_pred.append(gram_matrix(y))
 
         for gm_y, gm_s in zip(gram_pred, gram_style):
-            style_loss += img2mse(gm_y, gm_s[:1, :, :])
+            style_loss += img2mse(gm_y, gm_s)
 
         return content_loss, style_loss
 
+    @torch.no_grad()
+    def set_style_image(self, style_img):
+        ''' Precompute the Gram matrices of the style image [H, W, 3] of the dataset, reused at every step '''
+        if self.cache_style:
+            self.gram_style = self.compute_style_grams(style_img.unsqueeze(0))
+
+    def get_style_grams(self, style_img):
+        if self.gram_style is not None:
+            return self.gram_style
+        return self.compute_style_grams(style_img)
+
+    @torch.no_grad()
+    def compute_style_grams(self, style_img):
+        # only the first style image of the batch is used
+        style_s = style_img[:1] * 255.0
+        style_s = style_s.permute(0, 3, 1, 2) # [B, H, W, C] -> [B, C, H, W]
+        style_s = torch.clamp(style_s, 0., 255., out=None)
+        style_features = self.VGG(normalize_batch(interpolate(style_s)))
+        return [gram_matrix(y) for y in style_features.values()]
+
 
     def forward(self, model_outputs, ground_truth, style_img=None):
-        rgb_gt = ground_truth['rgb'].cuda()
+        rgb_gt = ground_truth['rgb'].to(model_outputs['rgb_values'].device)
         network_object_mask = model_outputs['network_object_mask']
         object_mask = model_outputs['object_mask']
 
@@ -126,7 +143,7 @@ class IDRLoss(nn.Module):
         content_loss = style_loss = 0.
         if ground_truth['style_img'] is not None:
             img_res = ground_truth['img_res']
-            style_img = ground_truth['style_img'].cuda()
+            style_img = ground_truth['style_img'].to(rgb_gt.device)
             content_loss, style_loss = self.get_style_loss(img_res, model_outputs['rgb_values'], rgb_gt, style_img, object_mask)
 
         loss = self.rgb_weight * rgb_loss + \
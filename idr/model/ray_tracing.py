@@ -2,6 +2,19 @@ import torch
 import torch.nn as nn
 from utils import rend_util
 
+# Rough peak memory of one SDF network evaluation under no_grad, in bytes per point
+SDF_BYTES_PER_POINT = 512 * 4 * 4
+
+
+def split_sdf(sdf, points, chunk):
+    ''' Evaluate sdf on points in chunks of at most chunk points '''
+    if points.shape[0] == 0:
+        return points.new_zeros(0)
+    if points.shape[0] <= chunk:
+        return sdf(points)
+    return torch.cat([sdf(pnts) for pnts in torch.split(points, chunk, dim=0)])
+
+
 class RayTracing(nn.Module):
     def __init__(
             self,
@@ -12,6 +25,10 @@ class RayTracing(nn.Module):
             sphere_tracing_iters=10,
             n_steps=100,
             n_secant_steps=8,
+            convergence_check_every=2,
+            n_coarse_steps=12,
+            min_sdf_chunk=100000,
+            sdf_chunk_memory=0.25,
     ):
         super().__init__()
 
@@ -22,6 +39,10 @@ class RayTracing(nn.Module):
         self.line_search_step = line_search_step
         self.n_steps = n_steps
         self.n_secant_steps = n_secant_steps
+        self.convergence_check_every = max(1, convergence_check_every)
+        self.n_coarse_steps = n_coarse_steps
+        self.min_sdf_chunk = min_sdf_chunk
+        self.sdf_chunk_memory = sdf_chunk_memory
 
     def forward(self,
                 sdf,
@@ -41,9 +62,9 @@ class RayTracing(nn.Module):
 
         # The non convergent rays should be handled by the sampler
         sampler_mask = unfinished_mask_start
-        sampler_net_obj_mask = torch.zeros_like(sampler_mask).bool().cuda()
+        sampler_net_obj_mask = torch.zeros_like(sampler_mask).bool()
         if sampler_mask.sum() > 0:
-            sampler_min_max = torch.zeros((batch_size, num_pixels, 2)).cuda()
+            sampler_min_max = torch.zeros((batch_size, num_pixels, 2), device=ray_directions.device)
             sampler_min_max.reshape(-1, 2)[sampler_mask, 0] = acc_start_dis[sampler_mask]
             sampler_min_max.reshape(-1, 2)[sampler_mask, 1] = acc_end_dis[sampler_mask]
 
@@ -98,134 +119,173 @@ class RayTracing(nn.Module):
 
 
     def sphere_tracing(self, batch_size, num_pixels, sdf, cam_loc, ray_directions, mask_intersect, sphere_intersections):
-        ''' Run sphere tracing algorithm for max iterations from both sides of unit sphere intersection '''
+        ''' Run sphere tracing algorithm for max iterations from both sides of unit sphere intersection.
+        Both fronts are traced together on a compacted list of active (ray, front) entries, start fronts step
+        forward and end fronts step backward along the ray. The list is compacted, and convergence checked,
+        every convergence_check_every iterations; finished entries are masked out in between.
+        '''
 
-        sphere_intersections_points = cam_loc.reshape(batch_size, 1, 1, 3) + sphere_intersections.unsqueeze(-1) * ray_directions.unsqueeze(2)
-        unfinished_mask_start = mask_intersect.reshape(-1).clone()
-        unfinished_mask_end = mask_intersect.reshape(-1).clone()
-
-        # Initialize start current points
-        curr_start_points = torch.zeros(batch_size * num_pixels, 3).cuda().float()
-        curr_start_points[unfinished_mask_start] = sphere_intersections_points[:,:,0,:].reshape(-1,3)[unfinished_mask_start]
-        acc_start_dis = torch.zeros(batch_size * num_pixels).cuda().float()
-        acc_start_dis[unfinished_mask_start] = sphere_intersections.reshape(-1,2)[unfinished_mask_start,0]
+        n_total_pxl = batch_size * num_pixels
+        device = ray_directions.device
+        rays_cam = cam_loc.unsqueeze(1).expand(batch_size, num_pixels, 3).reshape(-1, 3)
+        rays_dir = ray_directions.reshape(-1, 3)
+        mask_intersect = mask_intersect.reshape(-1)
 
-        # Initialize end current points
-        curr_end_points = torch.zeros(batch_size * num_pixels, 3).cuda().float()
-        curr_end_points[unfinished_mask_end] = sphere_intersections_points[:,:,1,:].reshape(-1,3)[unfinished_mask_end]
-        acc_end_dis = torch.zeros(batch_size * num_pixels).cuda().float()
-        acc_end_dis[unfinished_mask_end] = sphere_intersections.reshape(-1,2)[unfinished_mask_end,1]
+        # Distances of both fronts, acc_dis[0] for the start and acc_dis[1] for the end front
+        acc_dis = torch.zeros(2, n_total_pxl, device=device).float()
+        acc_dis[:, mask_intersect] = sphere_intersections.reshape(-1, 2)[mask_intersect].t()
+        acc_flat = acc_dis.view(-1)
 
         # Initizliae min and max depth
-        min_dis = acc_start_dis.clone()
-        max_dis = acc_end_dis.clone()
+        min_dis = acc_dis[0].clone()
+        max_dis = acc_dis[1].clone()
 
-        # Iterate on the rays (from both sides) till finding a surface
-        iters = 0
+        # Active entries index acc_flat, entry e is ray e % n_total_pxl of front e // n_total_pxl
+        ray_idx = mask_intersect.nonzero(as_tuple=False).reshape(-1)
+        entries = torch.cat([ray_idx, ray_idx + n_total_pxl])
+        rays = torch.cat([ray_idx, ray_idx])
+        sign = torch.cat([torch.ones_like(ray_idx), -torch.ones_like(ray_idx)]).float()
+        alive = torch.ones_like(entries, dtype=torch.bool)
 
-        next_sdf_start = torch.zeros_like(acc_start_dis).cuda()
-        next_sdf_start[unfinished_mask_start] = sdf(curr_start_points[unfinished_mask_start])
+        def entry_points(e, r):
+            return rays_cam[r] + acc_flat[e].unsqueeze(1) * rays_dir[r]
 
-        next_sdf_end = torch.zeros_like(acc_end_dis).cuda()
-        next_sdf_end[unfinished_mask_end] = sdf(curr_end_points[unfinished_mask_end])
+        # Iterate on the rays (from both sides) till finding a surface
+        iters = 0
+        next_sdf = sdf(entry_points(entries, rays)) if entries.numel() > 0 else torch.zeros(0, device=device)
 
         while True:
-            # Update sdf
-            curr_sdf_start = torch.zeros_like(acc_start_dis).cuda()
-            curr_sdf_start[unfinished_mask_start] = next_sdf_start[unfinished_mask_start]
-            curr_sdf_start[curr_sdf_start <= self.sdf_threshold] = 0
-
-            curr_sdf_end = torch.zeros_like(acc_end_dis).cuda()
-            curr_sdf_end[unfinished_mask_end] = next_sdf_end[unfinished_mask_end]
-            curr_sdf_end[curr_sdf_end <= self.sdf_threshold] = 0
-
-            # Update masks
-            unfinished_mask_start = unfinished_mask_start & (curr_sdf_start > self.sdf_threshold)
-            unfinished_mask_end = unfinished_mask_end & (curr_sdf_end > self.sdf_threshold)
-
-            if (unfinished_mask_start.sum() == 0 and unfinished_mask_end.sum() == 0) or iters == self.sphere_tracing_iters:
+            # Update sdf and masks
+            alive = alive & (next_sdf > self.sdf_threshold)
+            curr_sdf = torch.where(alive, next_sdf, torch.zeros_like(next_sdf))
+
+            if iters % self.convergence_check_every == 0 or iters == self.sphere_tracing_iters:
+                keep = alive.nonzero(as_tuple=False).reshape(-1)
+                entries, rays, sign, alive, curr_sdf = entries[keep], rays[keep], sign[keep], alive[keep], curr_sdf[keep]
+                if entries.numel() == 0:
+                    break
+            if iters == self.sphere_tracing_iters:
                 break
             iters += 1
 
-            # Make step
-            # Update distance
-            acc_start_dis = acc_start_dis + curr_sdf_start
-            acc_end_dis = acc_end_dis - curr_sdf_end
-
-            # Update points
-            curr_start_points = (cam_loc.unsqueeze(1) + acc_start_dis.reshape(batch_size, num_pixels, 1) * ray_directions).reshape(-1, 3)
-            curr_end_points = (cam_loc.unsqueeze(1) + acc_end_dis.reshape(batch_size, num_pixels, 1) * ray_directions).reshape(-1, 3)
+            # Make step, start fronts move forward and end fronts backward
+            acc_flat[entries] += sign * curr_sdf
+            next_sdf = sdf(entry_points(entries, rays))
 
             # Fix points which wrongly crossed the surface
-            next_sdf_start = torch.zeros_like(acc_start_dis).cuda()
-            next_sdf_start[unfinished_mask_start] = sdf(curr_start_points[unfinished_mask_start])
-
-            next_sdf_end = torch.zeros_like(acc_end_dis).cuda()
-            next_sdf_end[unfinished_mask_end] = sdf(curr_end_points[unfinished_mask_end])
-
-            not_projected_start = next_sdf_start < 0
-            not_projected_end = next_sdf_end < 0
             not_proj_iters = 0
-            while (not_projected_start.sum() > 0 or not_projected_end.sum() > 0) and not_proj_iters < self.line_step_iters:
+            while not_proj_iters < self.line_step_iters:
+                not_projected = (alive & (next_sdf < 0)).nonzero(as_tuple=False).reshape(-1)
+                if not_projected.numel() == 0:
+                    break
                 # Step backwards
-                acc_start_dis[not_projected_start] -= ((1 - self.line_search_step) / (2 ** not_proj_iters)) * curr_sdf_start[not_projected_start]
-                curr_start_points[not_projected_start] = (cam_loc.unsqueeze(1) + acc_start_dis.reshape(batch_size, num_pixels, 1) * ray_directions).reshape(-1, 3)[not_projected_start]
-
-                acc_end_dis[not_projected_end] += ((1 - self.line_search_step) / (2 ** not_proj_iters)) * curr_sdf_end[not_projected_end]
-                curr_end_points[not_projected_end] = (cam_loc.unsqueeze(1) + acc_end_dis.reshape(batch_size, num_pixels, 1) * ray_directions).reshape(-1, 3)[not_projected_end]
-
-                # Calc sdf
-                next_sdf_start[not_projected_start] = sdf(curr_start_points[not_projected_start])
-                next_sdf_end[not_projected_end] = sdf(curr_end_points[not_projected_end])
-
-                # Update mask
-                not_projected_start = next_sdf_start < 0
-                not_projected_end = next_sdf_end < 0
+                e, r = entries[not_projected], rays[not_projected]
+                acc_flat[e] -= sign[not_projected] * ((1 - self.line_search_step) / (2 ** not_proj_iters)) * curr_sdf[not_projected]
+                next_sdf[not_projected] = sdf(entry_points(e, r))
                 not_proj_iters += 1
 
-            unfinished_mask_start = unfinished_mask_start & (acc_start_dis < acc_end_dis)
-            unfinished_mask_end = unfinished_mask_end & (acc_start_dis < acc_end_dis)
+            alive = alive & (acc_dis[0, rays] < acc_dis[1, rays])
+
+        unfinished_mask_start = torch.zeros(n_total_pxl, dtype=torch.bool, device=device)
+        unfinished_mask_start[rays[alive & (sign > 0)]] = True
+        acc_start_dis, acc_end_dis = acc_dis[0], acc_dis[1]
+        curr_start_points = rays_cam + acc_start_dis.unsqueeze(1) * rays_dir
 
         return curr_start_points, unfinished_mask_start, acc_start_dis, acc_end_dis, min_dis, max_dis
 
+    def sdf_chunk_size(self, device):
+        ''' Number of points per SDF call, a fraction of the free device memory '''
+        if device.type == 'cuda' and hasattr(torch.cuda, 'mem_get_info'):
+            free, _ = torch.cuda.mem_get_info(device)
+            free += torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+            return int(max(self.min_sdf_chunk, self.sdf_chunk_memory * free // SDF_BYTES_PER_POINT))
+        return self.min_sdf_chunk
+
     def ray_sampler(self, sdf, cam_loc, object_mask, ray_directions, sampler_min_max, sampler_mask):
-        ''' Sample the ray in a given range and run secant on rays which have sign transition '''
+        ''' Sample the ray in a given range and run secant on rays which have sign transition.
+        The n_steps samples are searched coarse to fine: n_coarse_steps evenly strided samples are evaluated
+        first, then only the coarse interval bracketing the first sign transition (or around the minimal SDF
+        value for P_out pixels) is refined on the full grid.
+        '''
 
         batch_size, num_pixels, _ = ray_directions.shape
         n_total_pxl = batch_size * num_pixels
-        sampler_pts = torch.zeros(n_total_pxl, 3).cuda().float()
-        sampler_dists = torch.zeros(n_total_pxl).cuda().float()
-
-        intervals_dist = torch.linspace(0, 1, steps=self.n_steps).cuda().view(1, 1, -1)
-
-        pts_intervals = sampler_min_max[:, :, 0].unsqueeze(-1) + intervals_dist * (sampler_min_max[:, :, 1] - sampler_min_max[:, :, 0]).unsqueeze(-1)
-        points = cam_loc.reshape(batch_size, 1, 1, 3) + pts_intervals.unsqueeze(-1) * ray_directions.unsqueeze(2)
+        device = ray_directions.device
+        sampler_pts = torch.zeros(n_total_pxl, 3, device=device).float()
+        sampler_dists = torch.zeros(n_total_pxl, device=device).float()
+        chunk = self.sdf_chunk_size(device)
 
         # Get the non convergent rays
         mask_intersect_idx = torch.nonzero(sampler_mask).flatten()
-        points = points.reshape((-1, self.n_steps, 3))[sampler_mask, :, :]
-        pts_intervals = pts_intervals.reshape((-1, self.n_steps))[sampler_mask]
-
-        sdf_val_all = []
-        for pnts in torch.split(points.reshape(-1, 3), 100000, dim=0):
-            sdf_val_all.append(sdf(pnts))
-        sdf_val = torch.cat(sdf_val_all).reshape(-1, self.n_steps)
-
-        tmp = torch.sign(sdf_val) * torch.arange(self.n_steps, 0, -1).cuda().float().reshape((1, self.n_steps))  # Force argmin to return the first min value
-        sampler_pts_ind = torch.argmin(tmp, -1)
-        sampler_pts[mask_intersect_idx] = points[torch.arange(points.shape[0]), sampler_pts_ind, :]
-        sampler_dists[mask_intersect_idx] = pts_intervals[torch.arange(pts_intervals.shape[0]), sampler_pts_ind]
+        n_rays = mask_intersect_idx.shape[0]
+        cam_loc_rays = cam_loc.unsqueeze(1).expand(batch_size, num_pixels, 3).reshape(-1, 3)[mask_intersect_idx]
+        ray_directions_rays = ray_directions.reshape(-1, 3)[mask_intersect_idx]
+        z_min = sampler_min_max.reshape(-1, 2)[mask_intersect_idx, 0]
+        z_max = sampler_min_max.reshape(-1, 2)[mask_intersect_idx, 1]
+        rays_arange = torch.arange(n_rays, device=device)
+
+        def z_at(rays, ind):
+            ''' Distance of sample ind of the n_steps grid on rays '''
+            t = ind.float() / max(self.n_steps - 1, 1)
+            if ind.dim() == 2:
+                return z_min[rays].unsqueeze(-1) + t * (z_max[rays] - z_min[rays]).unsqueeze(-1)
+            return z_min[rays] + t * (z_max[rays] - z_min[rays])
+
+        def sdf_at(rays, ind):
+            ''' SDF of samples ind [n, k] on rays [n] '''
+            z = z_at(rays, ind)
+            points = cam_loc_rays[rays].unsqueeze(1) + z.unsqueeze(-1) * ray_directions_rays[rays].unsqueeze(1)
+            return split_sdf(sdf, points.reshape(-1, 3), chunk).reshape(ind.shape)
+
+        # Coarse pass on every stride-th sample, the last sample of the grid is always included
+        stride = max(1, -(-(self.n_steps - 1) // max(self.n_coarse_steps - 1, 1)))
+        coarse_ind = list(range(0, self.n_steps, stride))
+        if coarse_ind[-1] != self.n_steps - 1:
+            coarse_ind.append(self.n_steps - 1)
+        n_coarse = len(coarse_ind)
+        coarse_ind = torch.tensor(coarse_ind, device=device)
+        coarse_sdf = sdf_at(rays_arange, coarse_ind.unsqueeze(0).expand(n_rays, -1))
+
+        # First sample inside the surface, or the last sample if there is none
+        tmp = torch.sign(coarse_sdf) * torch.arange(n_coarse, 0, -1, device=device).float().reshape((1, n_coarse))  # Force argmin to return the first min value
+        coarse_k = torch.argmin(tmp, -1)
+        sampler_pts_ind = coarse_ind[coarse_k]
+        sdf_high = coarse_sdf[rays_arange, coarse_k]
+        # Previous sample, wraps around to the last one for rays starting inside the surface
+        low_ind = coarse_ind[coarse_k - 1]
+        sdf_low = coarse_sdf[rays_arange, coarse_k - 1]
+
+        # Refine the brackets (coarse k - 1, coarse k] on the full grid
+        bracket = torch.nonzero((coarse_k > 0) & (sdf_high < 0)).flatten()
+        if bracket.shape[0] > 0:
+            k = coarse_k[bracket]
+            window_ind = torch.min(coarse_ind[k - 1].unsqueeze(-1) + torch.arange(1, stride + 1, device=device),
+                                   coarse_ind[k].unsqueeze(-1))
+            window_sdf = torch.cat([sdf_at(bracket, window_ind[:, :-1]), sdf_high[bracket].unsqueeze(-1)], -1)
+            prev_ind = torch.cat([coarse_ind[k - 1].unsqueeze(-1), window_ind[:, :-1]], -1)
+            prev_sdf = torch.cat([sdf_low[bracket].unsqueeze(-1), window_sdf[:, :-1]], -1)
+
+            tmp = torch.sign(window_sdf) * torch.arange(stride, 0, -1, device=device).float().reshape((1, stride))
+            j = torch.argmin(tmp, -1)
+            window_arange = torch.arange(bracket.shape[0], device=device)
+            sampler_pts_ind[bracket] = window_ind[window_arange, j]
+            sdf_high[bracket] = window_sdf[window_arange, j]
+            low_ind[bracket] = prev_ind[window_arange, j]
+            sdf_low[bracket] = prev_sdf[window_arange, j]
+
+        sampler_dists[mask_intersect_idx] = z_at(rays_arange, sampler_pts_ind)
 
         true_surface_pts = object_mask[sampler_mask]
-        net_surface_pts = (sdf_val[torch.arange(sdf_val.shape[0]), sampler_pts_ind] < 0)
+        net_surface_pts = (sdf_high < 0)
 
-        # take points with minimal SDF value for P_out pixels
-        p_out_mask = ~(true_surface_pts & net_surface_pts)
-        n_p_out = p_out_mask.sum()
-        if n_p_out > 0:
-            out_pts_idx = torch.argmin(sdf_val[p_out_mask, :], -1)
-            sampler_pts[mask_intersect_idx[p_out_mask]] = points[p_out_mask, :, :][torch.arange(n_p_out), out_pts_idx, :]
-            sampler_dists[mask_intersect_idx[p_out_mask]] = pts_intervals[p_out_mask, :][torch.arange(n_p_out), out_pts_idx]
+        # take points with minimal SDF value for P_out pixels, refined around the coarse minimum
+        p_out = torch.nonzero(~(true_surface_pts & net_surface_pts)).flatten()
+        if p_out.shape[0] > 0:
+            min_ind = coarse_ind[torch.argmin(coarse_sdf[p_out], -1)]
+            window_ind = (min_ind.unsqueeze(-1) + torch.arange(-stride + 1, stride, device=device)).clamp(0, self.n_steps - 1)
+            window_sdf = sdf_at(p_out, window_ind)
+            out_pts_ind = window_ind[torch.arange(p_out.shape[0], device=device), torch.argmin(window_sdf, -1)]
+            sampler_dists[mask_intersect_idx[p_out]] = z_at(p_out, out_pts_ind)
 
         # Get Network object mask
         sampler_net_obj_mask = sampler_mask.clone()
@@ -233,40 +293,44 @@ class RayTracing(nn.Module):
 
         # Run Secant method
         secant_pts = net_surface_pts & true_surface_pts if self.training else net_surface_pts
-        n_secant_pts = secant_pts.sum()
-        if n_secant_pts > 0:
+        secant_rays = torch.nonzero(secant_pts).flatten()
+        if secant_rays.shape[0] > 0:
             # Get secant z predictions
-            z_high = pts_intervals[torch.arange(pts_intervals.shape[0]), sampler_pts_ind][secant_pts]
-            sdf_high = sdf_val[torch.arange(sdf_val.shape[0]), sampler_pts_ind][secant_pts]
-            z_low = pts_intervals[secant_pts][torch.arange(n_secant_pts), sampler_pts_ind[secant_pts] - 1]
-            sdf_low = sdf_val[secant_pts][torch.arange(n_secant_pts), sampler_pts_ind[secant_pts] - 1]
-            cam_loc_secant = cam_loc.unsqueeze(1).repeat(1, num_pixels, 1).reshape((-1, 3))[mask_intersect_idx[secant_pts]]
-            ray_directions_secant = ray_directions.reshape((-1, 3))[mask_intersect_idx[secant_pts]]
-            z_pred_secant = self.secant(sdf_low, sdf_high, z_low, z_high, cam_loc_secant, ray_directions_secant, sdf)
-
-            # Get points
-            sampler_pts[mask_intersect_idx[secant_pts]] = cam_loc_secant + z_pred_secant.unsqueeze(-1) * ray_directions_secant
-            sampler_dists[mask_intersect_idx[secant_pts]] = z_pred_secant
+            z_high = z_at(secant_rays, sampler_pts_ind[secant_rays])
+            z_low = z_at(secant_rays, low_ind[secant_rays])
+            z_pred_secant = self.secant(sdf_low[secant_rays], sdf_high[secant_rays], z_low, z_high,
+                                        cam_loc_rays[secant_rays], ray_directions_rays[secant_rays], sdf)
+            sampler_dists[mask_intersect_idx[secant_rays]] = z_pred_secant
+
+        # Get points
+        sampler_pts[mask_intersect_idx] = cam_loc_rays + sampler_dists[mask_intersect_idx].unsqueeze(-1) * ray_directions_rays
 
         return sampler_pts, sampler_net_obj_mask, sampler_dists
 
     def secant(self, sdf_low, sdf_high, z_low, z_high, cam_loc, ray_directions, sdf):
-        ''' Runs the secant method for interval [z_low, z_high] for n_secant_steps '''
+        ''' Runs the secant method for interval [z_low, z_high] for n_secant_steps.
+        All rays are updated with masked selects, without host synchronization. Degenerate secant steps
+        (equal SDF values at both ends) fall back to bisection.
+        '''
+
+        chunk = self.sdf_chunk_size(ray_directions.device)
 
-        z_pred = - sdf_low * (z_high - z_low) / (sdf_high - sdf_low) + z_low
+        def secant_step(sdf_low, sdf_high, z_low, z_high):
+            z_pred = - sdf_low * (z_high - z_low) / (sdf_high - sdf_low) + z_low
+            return torch.where(torch.isfinite(z_pred), z_pred, 0.5 * (z_low + z_high))
+
+        z_pred = secant_step(sdf_low, sdf_high, z_low, z_high)
         for i in range(self.n_secant_steps):
             p_mid = cam_loc + z_pred.unsqueeze(-1) * ray_directions
-            sdf_mid = sdf(p_mid)
+            sdf_mid = split_sdf(sdf, p_mid, chunk)
             ind_low = sdf_mid > 0
-            if ind_low.sum() > 0:
-                z_low[ind_low] = z_pred[ind_low]
-                sdf_low[ind_low] = sdf_mid[ind_low]
+            z_low = torch.where(ind_low, z_pred, z_low)
+            sdf_low = torch.where(ind_low, sdf_mid, sdf_low)
             ind_high = sdf_mid < 0
-            if ind_high.sum() > 0:
-                z_high[ind_high] = z_pred[ind_high]
-                sdf_high[ind_high] = sdf_mid[ind_high]
+            z_high = torch.where(ind_high, z_pred, z_high)
+            sdf_high = torch.where(ind_high, sdf_mid, sdf_high)
 
-            z_pred = - sdf_low * (z_high - z_low) / (sdf_high - sdf_low) + z_low
+            z_pred = secant_step(sdf_low, sdf_high, z_low, z_high)
 
         return z_pred
 
@@ -277,7 +341,7 @@ class RayTracing(nn.Module):
 
         n = self.n_steps
         # steps = torch.linspace(0.0, 1.0,n).cuda()
-        steps = torch.empty(n).uniform_(0.0, 1.0).cuda()
+        steps = torch.empty(n, device=ray_directions.device).uniform_(0.0, 1.0)
         mask_max_dis = max_dis[mask].unsqueeze(-1)
         mask_min_dis = min_dis[mask].unsqueeze(-1)
         steps = steps.unsqueeze(0).repeat(n_mask_points, 1) * (mask_max_dis - mask_min_dis) + mask_min_dis
@@ -289,11 +353,7 @@ class RayTracing(nn.Module):
             1).repeat(1, n, 1)
         points = mask_points_all.reshape(-1, 3)
 
-        mask_sdf_all = []
-        for pnts in torch.split(points, 100000, dim=0):
-            mask_sdf_all.append(sdf(pnts))
-
-        mask_sdf_all = torch.cat(mask_sdf_all).reshape(-1, n)
+        mask_sdf_all = split_sdf(sdf, points, self.sdf_chunk_size(points.device)).reshape(-1, n)
         min_vals, min_idx = mask_sdf_all.min(-1)
         min_mask_points = mask_points_all.reshape(-1, n, 3)[torch.arange(0, n_mask_points), min_idx]
         min_mask_dist = steps.reshape(-1, n)[torch.arange(0, n_mask_points), min_idx]
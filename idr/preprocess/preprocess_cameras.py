@@ -1,13 +1,16 @@
 import numpy as np
 import matplotlib.image as mpimg
 import matplotlib.pyplot as plt
-import cv2
 import argparse
 from glob import glob
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import utils.general as utils
 
+# Number of float64 elements held by one chunk of the batched point/camera computations (64MB)
+MAX_CHUNK_ELEMENTS = 1 << 23
+
 def get_Ps(cameras,number_of_cameras):
     Ps = []
     for i in range(0, number_of_cameras):
@@ -36,32 +39,45 @@ def get_fundamental_matrix(P_1,P_2):
 
 
 
-# Given a point (curx,cury) in image 0, get the  maximum and minimum
-# possible depth of the point, considering the second image silhouette (index j)
-def get_min_max_d(curx, cury, P_j, silhouette_j, P_0, Fj0, j):
-    # transfer point to line using the fundamental matrix:
-    cur_l_1=Fj0 @ np.array([curx,cury,1.0]).astype(np.float)
-    cur_l_1 = cur_l_1 / np.linalg.norm(cur_l_1[:2])
-
-    # Distances of the silhouette points from the epipolar line:
-    dists = np.abs(silhouette_j.T @ cur_l_1)
-    relevant_matching_points_1 = silhouette_j[:, dists < 0.7]
-
-    if relevant_matching_points_1.shape[1]==0:
-        return (0.0,0.0)
-    X = cv2.triangulatePoints(P_0, P_j, np.tile(np.array([curx, cury]).astype(np.float),
-                                                (relevant_matching_points_1.shape[1], 1)).T,
-                              relevant_matching_points_1[:2, :])
-    depths = P_0[2] @ (X / X[3])
-    reldepth=depths >= 0
-    depths=depths[reldepth]
-    if depths.shape[0] == 0:
-        return (0.0, 0.0)
+# Given points (xs, ys) in image 0, get the maximum and minimum possible depth of each point, considering the
+# silhouette of image j. (0, 0) is returned for points without a valid depth.
+# Points are split into chunks bounding the size of the point/silhouette distance matrix, chunks are processed
+# on pool when given.
+def get_min_max_d_batch(xs, ys, P_j, silhouette_j, P_0, Fj0, pool=None):
+    n_chunk = max(1, MAX_CHUNK_ELEMENTS // max(silhouette_j.shape[1], 1))
+    chunks = [(xs[i:i + n_chunk], ys[i:i + n_chunk]) for i in range(0, xs.shape[0], n_chunk)]
+    run = lambda c: _get_min_max_d_chunk(c[0], c[1], P_j, silhouette_j, P_0, Fj0)
+    results = list(pool.map(run, chunks)) if pool is not None else [run(c) for c in chunks]
+    if len(results) == 0:
+        return np.zeros(0), np.zeros(0)
+    return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
 
-    min_depth=depths.min()
-    max_depth = depths.max()
+def _get_min_max_d_chunk(xs, ys, P_j, silhouette_j, P_0, Fj0):
+    # transfer points to lines using the fundamental matrix:
+    cur_l_1 = Fj0 @ np.stack((xs, ys, np.ones_like(xs))).astype(np.float64)
+    cur_l_1 = cur_l_1 / np.linalg.norm(cur_l_1[:2], axis=0)
 
-    return min_depth,max_depth
+    # Distances of the silhouette points from the epipolar lines:
+    dists = np.abs(silhouette_j.T @ cur_l_1)
+    sil_inds, pt_inds = np.nonzero(dists < 0.7)
+
+    min_depth = np.full(xs.shape[0], np.inf)
+    max_depth = np.full(xs.shape[0], -np.inf)
+    if pt_inds.shape[0] > 0:
+        # Linear triangulation of every matching pair, as in cv2.triangulatePoints
+        x_0 = np.stack((xs[pt_inds], ys[pt_inds]), axis=1)
+        x_j = silhouette_j[:2, sil_inds].T
+        A = np.stack((x_0[:, 0:1] * P_0[2] - P_0[0], x_0[:, 1:2] * P_0[2] - P_0[1],
+                      x_j[:, 0:1] * P_j[2] - P_j[0], x_j[:, 1:2] * P_j[2] - P_j[1]), axis=1)
+        X = np.linalg.svd(A)[-1][:, -1, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            depths = (X @ P_0[2]) / X[:, 3]
+        reldepth = depths >= 0
+        np.minimum.at(min_depth, pt_inds[reldepth], depths[reldepth])
+        np.maximum.at(max_depth, pt_inds[reldepth], depths[reldepth])
+
+    found = np.isfinite(min_depth)
+    return np.where(found, min_depth, 0.0), np.where(found, max_depth, 0.0)
 
 #get all fundamental matrices that trasform points from camera 0 to lines in Ps
 def get_fundamental_matrices(P_0, Ps):
@@ -81,44 +97,53 @@ def get_all_mask_points(masks_dir):
         mask_points = np.where(img.max(axis=2) > 0.5)
         xs = mask_points[1]
         ys = mask_points[0]
-        mask_points_all.append(np.stack((xs,ys,np.ones_like(xs))).astype(np.float))
+        mask_points_all.append(np.stack((xs,ys,np.ones_like(xs))).astype(np.float64))
         mask_ims.append(cur_mask)
     return mask_points_all,np.array(mask_ims)
 
-def refine_visual_hull(masks, Ps, scale, center):
+def refine_visual_hull(masks, Ps, scale, center, grid_size=100, minimal_views=45, workers=None):
     num_cam=masks.shape[0]
-    GRID_SIZE=100
-    MINIMAL_VIEWS=45 # Fitted for DTU, might need to change for different data.
     im_height=masks.shape[1]
     im_width = masks.shape[2]
-    xx, yy, zz = np.meshgrid(np.linspace(-scale, scale, GRID_SIZE), np.linspace(-scale, scale, GRID_SIZE),
-                             np.linspace(-scale, scale, GRID_SIZE))
+    xx, yy, zz = np.meshgrid(np.linspace(-scale, scale, grid_size), np.linspace(-scale, scale, grid_size),
+                             np.linspace(-scale, scale, grid_size))
     points = np.stack((xx.flatten(), yy.flatten(), zz.flatten()))
     points = points + center[:, np.newaxis]
-    appears = np.zeros((GRID_SIZE*GRID_SIZE*GRID_SIZE, 1))
-    for i in range(num_cam):
-        proji = Ps[i] @ np.concatenate((points, np.ones((1, GRID_SIZE*GRID_SIZE*GRID_SIZE))), axis=0)
-        depths = proji[2]
-        proj_pixels = np.round(proji[:2] / depths).astype(np.long)
-        relevant_inds = np.logical_and(proj_pixels[0] >= 0, proj_pixels[1] < im_height)
-        relevant_inds = np.logical_and(relevant_inds, proj_pixels[0] < im_width)
-        relevant_inds = np.logical_and(relevant_inds, proj_pixels[1] >= 0)
-        relevant_inds = np.logical_and(relevant_inds, depths > 0)
-        relevant_inds = np.where(relevant_inds)[0]
-
-        cur_mask = masks[i] > 0.5
-        relmask = cur_mask[proj_pixels[1, relevant_inds], proj_pixels[0, relevant_inds]]
-        relevant_inds = relevant_inds[relmask]
-        appears[relevant_inds] = appears[relevant_inds] + 1
-
-    final_points = points[:, (appears >= MINIMAL_VIEWS).flatten()]
+    masks = masks > 0.5
+    Ps = Ps.astype(np.float32)
+
+    # Project chunks of grid points to all the cameras at once and count the masks they fall in
+    def count_appears(points_chunk):
+        proj = Ps @ np.concatenate((points_chunk, np.ones((1, points_chunk.shape[1]))), axis=0).astype(np.float32)
+        depths = proj[:, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            proj_pixels = np.round(proj[:, :2] / depths[:, np.newaxis])
+        relevant = (proj_pixels[:, 0] >= 0) & (proj_pixels[:, 0] < im_width) & \
+                   (proj_pixels[:, 1] >= 0) & (proj_pixels[:, 1] < im_height) & (depths > 0)
+        cam_inds, point_inds = np.nonzero(relevant)
+        px = proj_pixels[cam_inds, 0, point_inds].astype(np.int64)
+        py = proj_pixels[cam_inds, 1, point_inds].astype(np.int64)
+        appears = np.zeros(points_chunk.shape[1], dtype=np.int64)
+        np.add.at(appears, point_inds[masks[cam_inds, py, px]], 1)
+        return appears
+
+    n_chunk = max(1, MAX_CHUNK_ELEMENTS // (3 * num_cam))
+    chunks = [points[:, i:i + n_chunk] for i in range(0, points.shape[1], n_chunk)]
+    if workers is not None and workers > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            appears = np.concatenate(list(pool.map(count_appears, chunks)))
+    else:
+        appears = np.concatenate([count_appears(c) for c in chunks])
+
+    final_points = points[:, appears >= minimal_views]
     centroid=final_points.mean(axis=1)
     normalize = final_points - centroid[:, np.newaxis]
 
     return centroid,np.sqrt((normalize ** 2).sum(axis=0)).mean() * 3,final_points.T
 
 # the normaliztion script needs a set of 2D object masks and camera projection matrices (P_i=K_i[R_i |t_i] where [R_i |t_i] is world to camera transformation)
-def get_normalization_function(Ps,mask_points_all,number_of_normalization_points,number_of_cameras,masks_all):
+def get_normalization_function(Ps,mask_points_all,number_of_normalization_points,number_of_cameras,masks_all,
+                               grid_size=100, minimal_views=45, workers=None):
     P_0 = Ps[0]
     Fs = get_fundamental_matrices(P_0, Ps)
     P_0_center = np.linalg.svd(P_0)[-1][-1, :]
@@ -128,36 +153,37 @@ def get_normalization_function(Ps,mask_points_all,number_of_normalization_points
     xs = mask_points_all[0][0, :]
     ys = mask_points_all[0][1, :]
 
-    counter = 0
-    all_Xs = []
-
     # sample a subset of 2D points from camera 0
     indss = np.random.permutation(xs.shape[0])[:number_of_normalization_points]
-
-    for i in indss:
-        curx = xs[i]
-        cury = ys[i]
-        # for each point, check its min/max depth in all other cameras.
-        # If there is an intersection of relevant depth keep the point
-        observerved_in_all = True
-        max_d_all = 1e10
-        min_d_all = 1e-10
+    xs = xs[indss]
+    ys = ys[indss]
+
+    # for each point, check its min/max depth in all other cameras.
+    # If there is an intersection of relevant depth keep the point.
+    # Points are processed together, camera by camera, dropping the points that are already rejected
+    observerved_in_all = np.ones(xs.shape[0], dtype=bool)
+    max_d_all = np.full(xs.shape[0], 1e10)
+    min_d_all = np.full(xs.shape[0], 1e-10)
+    pool = ThreadPoolExecutor(workers) if workers is not None and workers > 1 else None
+    try:
         for j in range(1, number_of_cameras, 5):
-            min_d, max_d = get_min_max_d(curx, cury, Ps[j], mask_points_all[j], P_0, Fs[j], j)
-
-            if abs(min_d) < 0.00001:
-                observerved_in_all = False
+            active = np.nonzero(observerved_in_all)[0]
+            if active.shape[0] == 0:
                 break
-            max_d_all = np.min(np.array([max_d_all, max_d]))
-            min_d_all = np.max(np.array([min_d_all, min_d]))
-            if max_d_all < min_d_all + 1e-2:
-                observerved_in_all = False
-                break
-        if observerved_in_all:
-            direction = np.linalg.inv(P_0[:3, :3]) @ np.array([curx, cury, 1.0])
-            all_Xs.append(P_0_center[:3] + direction * min_d_all)
-            all_Xs.append(P_0_center[:3] + direction * max_d_all)
-            counter = counter + 1
+            min_d, max_d = get_min_max_d_batch(xs[active], ys[active], Ps[j], mask_points_all[j], P_0, Fs[j], pool)
+
+            max_d_all[active] = np.minimum(max_d_all[active], max_d)
+            min_d_all[active] = np.maximum(min_d_all[active], min_d)
+            observerved_in_all[active] = (np.abs(min_d) >= 0.00001) & (max_d_all[active] >= min_d_all[active] + 1e-2)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    keep = np.nonzero(observerved_in_all)[0]
+    directions = (np.linalg.inv(P_0[:3, :3]) @ np.stack((xs[keep], ys[keep], np.ones(keep.shape[0])))).T
+    all_Xs = np.stack((P_0_center[:3] + directions * min_d_all[keep, np.newaxis],
+                       P_0_center[:3] + directions * max_d_all[keep, np.newaxis]), axis=1).reshape(-1, 3)
+    counter = keep.shape[0]
 
     print("Number of points:%d" % counter)
     centroid = np.array(all_Xs).mean(axis=0)
@@ -165,7 +191,7 @@ def get_normalization_function(Ps,mask_points_all,number_of_normalization_points
     scale = np.array(all_Xs).std()
 
     # OPTIONAL: refine the visual hull
-    centroid,scale,all_Xs = refine_visual_hull(masks_all, Ps, scale, centroid)
+    centroid,scale,all_Xs = refine_visual_hull(masks_all, Ps, scale, centroid, grid_size, minimal_views, workers)
 
     normalization = np.eye(4).astype(np.float32)
 
@@ -179,7 +205,7 @@ def get_normalization_function(Ps,mask_points_all,number_of_normalization_points
     return normalization,all_Xs
 
 
-def get_normalization(source_dir, use_linear_init=False):
+def get_normalization(source_dir, use_linear_init=False, grid_size=100, minimal_views=45, workers=None):
     print('Preprocessing', source_dir)
 
     if use_linear_init:
@@ -197,7 +223,8 @@ def get_normalization(source_dir, use_linear_init=False):
     number_of_cameras = len(masks_all)
     Ps = get_Ps(cameras, number_of_cameras)
 
-    normalization,all_Xs=get_normalization_function(Ps, mask_points_all, number_of_normalization_points, number_of_cameras,masks_all)
+    normalization,all_Xs=get_normalization_function(Ps, mask_points_all, number_of_normalization_points, number_of_cameras,masks_all,
+                                                    grid_size, minimal_views, workers)
 
     cameras_new={}
     for i in range(number_of_cameras):
@@ -225,6 +252,9 @@ if __name__ == "__main__":
     parser.add_argument('--source_dir', type=str, default='', help='data source folder for preprocess')
     parser.add_argument('--dtu', default=False, action="store_true", help='If set, apply preprocess to all DTU scenes.')
     parser.add_argument('--use_linear_init', default=False, action="store_true", help='If set, preprocess for linear init cameras.')
+    parser.add_argument('--grid_size', type=int, default=100, help='Resolution of the visual hull refinement grid.')
+    parser.add_argument('--minimal_views', type=int, default=45, help='Number of masks a visual hull point must project into. Fitted for DTU, might need to change for different data.')
+    parser.add_argument('--workers', type=int, default=0, help='Number of threads, 0 to run on the main thread.')
 
     opt = parser.parse_args()
 
@@ -232,8 +262,8 @@ if __name__ == "__main__":
         source_dir = './datasets/DTU'
         scene_dirs = sorted(glob(os.path.join(source_dir, "scan*")))
         for scene_dir in scene_dirs:
-            get_normalization(scene_dir,opt.use_linear_init)
+            get_normalization(scene_dir,opt.use_linear_init, opt.grid_size, opt.minimal_views, opt.workers)
     else:
-        get_normalization(opt.source_dir, opt.use_linear_init)
+        get_normalization(opt.source_dir, opt.use_linear_init, opt.grid_size, opt.minimal_views, opt.workers)
 
     print('Done!')
@@ -6,6 +6,7 @@ import torch
 
 import utils.general as utils
 import utils.plots as plt
+from utils.checkpoint import CheckpointWriter
 
 class IDRTrainRunner():
     def __init__(self,**kwargs):
@@ -71,6 +72,12 @@ class IDRTrainRunner():
 
         if (not self.GPU_INDEX == 'ignore'):
             os.environ["CUDA_VISIBLE_DEVICES"] = '{0}'.format(self.GPU_INDEX)
+        # resolved after CUDA_VISIBLE_DEVICES is set, 'auto' picks CUDA when it is available
+        self.device = utils.get_device(kwargs.get('device', 'auto'))
+        print('device : {0}'.format(self.device))
+        if self.device.type == 'cpu':
+            # the single intra-op thread set above is only meant to keep data handling light next to a GPU
+            torch.set_num_threads(os.cpu_count() or 1)
 
         print('shell command : {0}'.format(' '.join(sys.argv)))
 
@@ -98,10 +105,11 @@ class IDRTrainRunner():
         self.plot_img_idx = self.conf.get_int('misc.plot_img_idx')
         self.model = utils.get_class(self.conf.get_string('train.model_class'))(conf=self.conf.get_config('model'))
 
-        if torch.cuda.is_available():
-            self.model.cuda()
+        self.model.to(self.device)
 
-        self.loss = utils.get_class(self.conf.get_string('train.loss_class'))(**self.conf.get_config('loss')).cuda()
+        self.loss = utils.get_class(self.conf.get_string('train.loss_class'))(**self.conf.get_config('loss')).to(self.device)
+        if self.train_dataset.style_img is not None and hasattr(self.loss, 'set_style_image'):
+            self.loss.set_style_image(self.train_dataset.style_img.to(self.device))
 
         self.lr = self.conf.get_float('train.learning_rate')
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.lr)
@@ -112,7 +120,7 @@ class IDRTrainRunner():
         # settings for camera optimization
         if self.train_cameras:
             num_images = len(self.train_dataset)
-            self.pose_vecs = torch.nn.Embedding(num_images, 7, sparse=True).cuda()
+            self.pose_vecs = torch.nn.Embedding(num_images, 7, sparse=True).to(self.device)
             self.pose_vecs.weight.data.copy_(self.train_dataset.get_pose_init())
 
             self.optimizer_cam = torch.optim.SparseAdam(self.pose_vecs.parameters(), self.conf.get_float('train.learning_rate_cam'))
@@ -122,7 +130,7 @@ class IDRTrainRunner():
             old_checkpnts_dir = os.path.join(self.expdir, timestamp, 'checkpoints')
 
             saved_model_state = torch.load(
-                os.path.join(old_checkpnts_dir, 'ModelParameters', str(kwargs['checkpoint']) + ".pth"))
+                os.path.join(old_checkpnts_dir, 'ModelParameters', str(kwargs['checkpoint']) + ".pth"), map_location=self.device)
             self.model.load_state_dict(saved_model_state["model_state_dict"], strict=False)
             self.start_epoch = saved_model_state['epoch']
 
@@ -136,11 +144,11 @@ class IDRTrainRunner():
 
             if self.train_cameras:
                 data = torch.load(
-                    os.path.join(old_checkpnts_dir, self.optimizer_cam_params_subdir, str(kwargs['checkpoint']) + ".pth"))
+                    os.path.join(old_checkpnts_dir, self.optimizer_cam_params_subdir, str(kwargs['checkpoint']) + ".pth"), map_location=self.device)
                 self.optimizer_cam.load_state_dict(data["optimizer_cam_state_dict"])
 
                 data = torch.load(
-                    os.path.join(old_checkpnts_dir, self.cam_params_subdir, str(kwargs['checkpoint']) + ".pth"))
+                    os.path.join(old_checkpnts_dir, self.cam_params_subdir, str(kwargs['checkpoint']) + ".pth"), map_location=self.device)
                 self.pose_vecs.load_state_dict(data["pose_vecs_state_dict"])
 
         self.num_pixels = self.conf.get_int('train.num_pixels')
@@ -152,6 +160,10 @@ class IDRTrainRunner():
         self.plot_freq = self.conf.get_int('train.plot_freq')
         self.plot_conf = self.conf.get_config('plot')
 
+        self.ckpt_writer = CheckpointWriter(keep_last=self.conf.get_int('train.ckpt_keep_last', default=0),
+                                            keep_every=self.conf.get_int('train.ckpt_keep_every', default=0),
+                                            async_save=self.conf.get_bool('train.async_checkpoint', default=True))
+
         self.alpha_milestones = self.conf.get_list('train.alpha_milestones', default=[])
         self.alpha_factor = self.conf.get_float('train.alpha_factor', default=0.0)
         for acc in self.alpha_milestones:
@@ -159,41 +171,18 @@ class IDRTrainRunner():
                 self.loss.alpha = self.loss.alpha * self.alpha_factor
 
     def save_checkpoints(self, epoch):
-        torch.save(
-            {"epoch": epoch, "model_state_dict": self.model.state_dict()},
-            os.path.join(self.checkpoints_path, self.model_params_subdir, str(epoch) + ".pth"))
-        torch.save(
-            {"epoch": epoch, "model_state_dict": self.model.state_dict()},
-            os.path.join(self.checkpoints_path, self.model_params_subdir, "latest.pth"))
-
-        torch.save(
-            {"epoch": epoch, "optimizer_state_dict": self.optimizer.state_dict()},
-            os.path.join(self.checkpoints_path, self.optimizer_params_subdir, str(epoch) + ".pth"))
-        torch.save(
-            {"epoch": epoch, "optimizer_state_dict": self.optimizer.state_dict()},
-            os.path.join(self.checkpoints_path, self.optimizer_params_subdir, "latest.pth"))
-
-        torch.save(
-            {"epoch": epoch, "scheduler_state_dict": self.scheduler.state_dict()},
-            os.path.join(self.checkpoints_path, self.scheduler_params_subdir, str(epoch) + ".pth"))
-        torch.save(
-            {"epoch": epoch, "scheduler_state_dict": self.scheduler.state_dict()},
-            os.path.join(self.checkpoints_path, self.scheduler_params_subdir, "latest.pth"))
-
+        # epoch files are written in the background, latest.pth is a link to the newest one
+        states = [(self.model_params_subdir, "model_state_dict", self.model),
+                  (self.optimizer_params_subdir, "optimizer_state_dict", self.optimizer),
+                  (self.scheduler_params_subdir, "scheduler_state_dict", self.scheduler)]
         if self.train_cameras:
-            torch.save(
-                {"epoch": epoch, "optimizer_cam_state_dict": self.optimizer_cam.state_dict()},
-                os.path.join(self.checkpoints_path, self.optimizer_cam_params_subdir, str(epoch) + ".pth"))
-            torch.save(
-                {"epoch": epoch, "optimizer_cam_state_dict": self.optimizer_cam.state_dict()},
-                os.path.join(self.checkpoints_path, self.optimizer_cam_params_subdir, "latest.pth"))
-
-            torch.save(
-                {"epoch": epoch, "pose_vecs_state_dict": self.pose_vecs.state_dict()},
-                os.path.join(self.checkpoints_path, self.cam_params_subdir, str(epoch) + ".pth"))
-            torch.save(
-                {"epoch": epoch, "pose_vecs_state_dict": self.pose_vecs.state_dict()},
-                os.path.join(self.checkpoints_path, self.cam_params_subdir, "latest.pth"))
+            states += [(self.optimizer_cam_params_subdir, "optimizer_cam_state_dict", self.optimizer_cam),
+                       (self.cam_params_subdir, "pose_vecs_state_dict", self.pose_vecs)]
+        for subdir, key, module in states:
+            self.ckpt_writer.save(
+                {"epoch": epoch, key: module.state_dict()},
+                os.path.join(self.checkpoints_path, subdir, str(epoch) + ".pth"),
+                step=epoch, latest="latest.pth")
 
     def run(self):
         print("training...")
@@ -222,15 +211,15 @@ class IDRTrainRunner():
                     return m
                 indices, model_input, ground_truth = index_dataloader(self.plot_dataloader, self.plot_img_idx)
 
-                model_input["intrinsics"] = model_input["intrinsics"].cuda()
-                model_input["uv"] = model_input["uv"].cuda()
-                model_input["object_mask"] = model_input["object_mask"].cuda()
+                model_input["intrinsics"] = model_input["intrinsics"].to(self.device)
+                model_input["uv"] = model_input["uv"].to(self.device)
+                model_input["object_mask"] = model_input["object_mask"].to(self.device)
 
                 if self.train_cameras:
-                    pose_input = self.pose_vecs(indices.cuda())
+                    pose_input = self.pose_vecs(indices.to(self.device))
                     model_input['pose'] = pose_input
                 else:
-                    model_input['pose'] = model_input['pose'].cuda()
+                    model_input['pose'] = model_input['pose'].to(self.device)
 
                 split = utils.split_input(model_input, self.total_pixels)
                 res = []
@@ -268,15 +257,15 @@ class IDRTrainRunner():
 
                 ground_truth['img_res'] = self.patch_size // self.stride_length
 
-                model_input["intrinsics"] = model_input["intrinsics"].cuda()
-                model_input["uv"] = model_input["uv"].cuda()
-                model_input["object_mask"] = model_input["object_mask"].cuda()
+                model_input["intrinsics"] = model_input["intrinsics"].to(self.device)
+                model_input["uv"] = model_input["uv"].to(self.device)
+                model_input["object_mask"] = model_input["object_mask"].to(self.device)
 
                 if self.train_cameras:
-                    pose_input = self.pose_vecs(indices.cuda())
+                    pose_input = self.pose_vecs(indices.to(self.device))
                     model_input['pose'] = pose_input
                 else:
-                    model_input['pose'] = model_input['pose'].cuda()
+                    model_input['pose'] = model_input['pose'].to(self.device)
 
                 model_outputs = self.model(model_input)
                 loss_output = self.loss(model_outputs, ground_truth)
@@ -308,3 +297,5 @@ class IDRTrainRunner():
                 self.train_dataset.change_sampling_idx(self.patch_size, self.stride_length)
 
             self.scheduler.step()
+
+        self.ckpt_writer.close()
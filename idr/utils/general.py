@@ -2,6 +2,12 @@ import os
 from glob import glob
 import torch
 
+def get_device(device=None):
+    '''torch.device of a name such as 'cpu' or 'cuda:0', None picks CUDA when it is available'''
+    if device is None or device == 'auto':
+        return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    return torch.device(device)
+
 def mkdir_ifnotexists(directory):
     if not os.path.exists(directory):
         os.mkdir(directory)
@@ -27,7 +33,7 @@ def split_input(model_input, total_pixels):
      '''
     n_pixels = 10000
     split = []
-    for i, indx in enumerate(torch.split(torch.arange(total_pixels).cuda(), n_pixels, dim=0)):
+    for i, indx in enumerate(torch.split(torch.arange(total_pixels, device=model_input['uv'].device), n_pixels, dim=0)):
         data = model_input.copy()
         data['uv'] = torch.index_select(model_input['uv'], 1, indx)
         data['object_mask'] = torch.index_select(model_input['object_mask'], 1, indx)
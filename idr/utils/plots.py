@@ -1,3 +1,4 @@
+import itertools
 import plotly.graph_objs as go
 import plotly.offline as offline
 import numpy as np
@@ -7,6 +8,7 @@ import torchvision
 import trimesh
 from PIL import Image
 from utils import rend_util
+from utils.general import get_device
 
 def plot(model, indices, model_outputs ,pose, rgb_gt, path, epoch, img_res, plot_nimgs, max_depth, resolution):
     # arrange data to plot
@@ -17,7 +19,7 @@ def plot(model, indices, model_outputs ,pose, rgb_gt, path, epoch, img_res, plot
     rgb_eval = model_outputs['rgb_values']
     rgb_eval = rgb_eval.reshape(batch_size, num_samples, 3)
 
-    depth = torch.ones(batch_size * num_samples).cuda().float() * max_depth
+    depth = torch.ones(batch_size * num_samples, device=points.device).float() * max_depth
     depth[network_object_mask] = rend_util.get_depth(points, pose).reshape(-1)[network_object_mask]
     depth = depth.reshape(batch_size, num_samples, 1)
     network_object_mask = network_object_mask.reshape(batch_size,-1)
@@ -36,7 +38,8 @@ def plot(model, indices, model_outputs ,pose, rgb_gt, path, epoch, img_res, plot
     surface_traces = get_surface_trace(path=path,
                                        epoch=epoch,
                                        sdf=lambda x: model.implicit_network(x)[:, 0],
-                                       resolution=resolution
+                                       resolution=resolution,
+                                       device=points.device
                                        )
     data.append(surface_traces[0])
 
@@ -109,28 +112,148 @@ def get_3D_quiver_trace(points, directions, color='#bd1540', name=''):
     return trace
 
 
-def get_surface_trace(path, epoch, sdf, resolution=100, return_mesh=False):
-    grid = get_grid_uniform(resolution)
-    points = grid['grid_points']
-
-    z = []
-    for i, pnts in enumerate(torch.split(points, 100000, dim=0)):
-        z.append(sdf(pnts).detach().cpu().numpy())
-    z = np.concatenate(z, axis=0)
-
-    if (not (np.min(z) > 0 or np.max(z) < 0)):
-
-        z = z.astype(np.float32)
-
-        verts, faces, normals, values = measure.marching_cubes_lewiner(
-            volume=z.reshape(grid['xyz'][1].shape[0], grid['xyz'][0].shape[0],
-                             grid['xyz'][2].shape[0]).transpose([1, 0, 2]),
-            level=0,
-            spacing=(grid['xyz'][0][2] - grid['xyz'][0][1],
-                     grid['xyz'][0][2] - grid['xyz'][0][1],
-                     grid['xyz'][0][2] - grid['xyz'][0][1]))
-
-        verts = verts + np.array([grid['xyz'][0][0], grid['xyz'][1][0], grid['xyz'][2][0]])
+def sparse_marching_cubes(sdf, xyz, transform=None, device=None, coarse_resolution=32, margin=1.0, chunk=100000):
+    ''' Coarse to fine marching cubes on the grid of nodes xyz.
+    The SDF is evaluated on a coarse lattice first and blocks are subdivided only while the values at their
+    corners do not rule out the zero level set, i.e. a corner changes sign or |sdf| is within the block
+    diagonal (the SDF is close to 1-Lipschitz). Marching cubes then runs on every remaining coarse block,
+    nodes that were never evaluated take the value of a corner of the pruned block containing them.
+    Args:
+      sdf: function of [N, 3] points.
+      xyz: evenly spaced node coordinates along x, y and z, with the same spacing.
+      transform: function mapping grid points to the points sdf is evaluated at, None for identity.
+      coarse_resolution: number of coarse blocks along the longest axis.
+      margin: scale of the pruning bound, values below 1 trade accuracy for fewer SDF queries.
+      chunk: number of points per SDF call.
+    Returns:
+      verts, faces, normals in grid coordinates, None if the zero level set is not crossed.
+    '''
+    device = get_device(device)
+    n = np.array([len(a) for a in xyz])
+    h = xyz[0][2] - xyz[0][1]
+    origin = np.array([a[0] for a in xyz])
+    block = 1 << max(0, int(np.ceil(np.log2(max(n.max() - 1, 1) / coarse_resolution))))
+    cells = -(-(n - 1) // block) * block # padded to a multiple of the coarse block
+    d1, d2 = int(cells[1] + 1), int(cells[2] + 1)
+    n_valid = torch.tensor(n - 1, device=device)
+    origin_t = torch.tensor(origin, device=device).float()
+
+    def node_ids(idx):
+        return (idx[..., 0] * d1 + idx[..., 1]) * d2 + idx[..., 2]
+
+    def eval_nodes(ids):
+        idx = torch.stack([ids // (d1 * d2), (ids // d2) % d1, ids % d2], -1)
+        points = origin_t + idx.float() * h
+        if transform is not None:
+            points = transform(points)
+        with torch.no_grad():
+            z = [sdf(pnts).detach() for pnts in torch.split(points, chunk, dim=0)]
+        return torch.cat(z).float() if len(z) > 0 else torch.zeros(0, device=device)
+
+    # Sorted ids and SDF values of every node evaluated so far
+    known_ids = torch.zeros(0, dtype=torch.long, device=device)
+    known_vals = torch.zeros(0, device=device)
+
+    def find(ids):
+        pos = torch.searchsorted(known_ids, ids).clamp(max=max(known_ids.shape[0] - 1, 0))
+        if known_ids.shape[0] == 0:
+            return pos, torch.zeros_like(ids, dtype=torch.bool)
+        return pos, known_ids[pos] == ids
+
+    def lookup(ids):
+        ''' SDF at node ids, only nodes that were not seen before are evaluated '''
+        nonlocal known_ids, known_vals
+        uniq, inv = torch.unique(ids, return_inverse=True)
+        pos, found = find(uniq)
+        vals = torch.empty(uniq.shape[0], device=device)
+        vals[found] = known_vals[pos[found]]
+        new_ids = uniq[~found]
+        new_vals = eval_nodes(new_ids)
+        vals[~found] = new_vals
+        known_ids, order = torch.sort(torch.cat([known_ids, new_ids]))
+        known_vals = torch.cat([known_vals, new_vals])[order]
+        return vals[inv]
+
+    def near_surface(blocks, vals, stride):
+        crossing = (vals.min(-1)[0] <= 0) & (vals.max(-1)[0] >= 0)
+        near = vals.abs().min(-1)[0] <= margin * stride * h * np.sqrt(3)
+        return (blocks < n_valid).all(-1) & (crossing | near)
+
+    corners = torch.tensor(list(itertools.product(range(2), repeat=3)), device=device)
+    sub_nodes = torch.tensor(list(itertools.product(range(3), repeat=3)), device=device)
+    # Corner q of child block c among the 27 nodes of its parent
+    child_corners = ((corners.unsqueeze(1) + corners.unsqueeze(0)) * torch.tensor([9, 3, 1], device=device)).sum(-1)
+    batch = max(1, chunk // 8)
+
+    # Coarse lattice
+    top = [torch.arange(c // block, device=device) * block for c in cells]
+    blocks = torch.stack(torch.meshgrid(*top), -1).reshape(-1, 3)
+    keep = []
+    for b in torch.split(blocks, batch):
+        vals = lookup(node_ids(b.unsqueeze(1) + corners * block))
+        keep.append(b[near_surface(b, vals, block)])
+    chunks = torch.cat(keep)
+
+    # Subdivide the blocks near the surface down to the grid cells
+    blocks, stride = chunks, block
+    while stride > 1 and blocks.shape[0] > 0:
+        half = stride // 2
+        children = []
+        for b in torch.split(blocks, batch):
+            vals = lookup(node_ids(b.unsqueeze(1) + sub_nodes * half))
+            if half > 1:
+                child = (b.unsqueeze(1) + corners * half).reshape(-1, 3)
+                child_vals = vals[:, child_corners].reshape(-1, 8)
+                children.append(child[near_surface(child, child_vals, half)])
+        blocks = torch.cat(children) if len(children) > 0 else blocks[:0]
+        stride = half
+
+    # Marching cubes on every coarse block, streamed in batches of blocks
+    block_nodes = torch.stack(torch.meshgrid(*[torch.arange(block + 1, device=device)] * 3), -1).reshape(-1, 3)
+    verts_all, faces_all, normals_all = [], [], []
+    n_verts = 0
+    for cb in torch.split(chunks, max(1, chunk // block_nodes.shape[0])):
+        ids = node_ids(cb.unsqueeze(1) + block_nodes)
+        pos, found = find(ids)
+        vol = torch.where(found, known_vals[pos], torch.full_like(known_vals[pos], float('nan')))
+        vol = vol.reshape(-1, block + 1, block + 1, block + 1)
+        # Fill the nodes of pruned blocks from their lower corner, coarse to fine
+        step = block // 2
+        while step >= 1:
+            lattice = vol[:, ::step, ::step, ::step]
+            src = (torch.arange(lattice.shape[1], device=device) // 2) * 2
+            filled = lattice[:, src][:, :, src][:, :, :, src]
+            vol[:, ::step, ::step, ::step] = torch.where(torch.isnan(lattice), filled, lattice)
+            step //= 2
+
+        for block_origin, v in zip(cb.cpu().numpy(), vol.cpu().numpy()):
+            v = v[:n[0] - block_origin[0], :n[1] - block_origin[1], :n[2] - block_origin[2]]
+            if min(v.shape) < 2 or v.min() > 0 or v.max() < 0:
+                continue
+            verts, faces, normals, values = measure.marching_cubes_lewiner(volume=v, level=0)
+            verts_all.append(verts + block_origin)
+            faces_all.append(faces + n_verts)
+            normals_all.append(normals)
+            n_verts += verts.shape[0]
+
+    if n_verts == 0:
+        return None
+
+    # Merge the vertices shared by neighbouring blocks, computed in grid index units to match exactly
+    verts, inv = np.unique(np.round(np.concatenate(verts_all), 6), axis=0, return_inverse=True)
+    faces = inv.reshape(-1)[np.concatenate(faces_all)]
+    normals = np.zeros_like(verts)
+    normals[inv.reshape(-1)] = np.concatenate(normals_all)
+
+    return verts * h + origin, faces, normals
+
+
+def get_surface_trace(path, epoch, sdf, resolution=100, return_mesh=False, device=None):
+    grid = get_grid_uniform(resolution, device=device, with_points=False)
+    mesh = sparse_marching_cubes(sdf, grid['xyz'], device=device)
+
+    if mesh is not None:
+        verts, faces, normals = mesh
 
         I, J, K = faces.transpose()
 
@@ -146,27 +269,11 @@ def get_surface_trace(path, epoch, sdf, resolution=100, return_mesh=False):
         return traces
     return None
 
-def get_surface_high_res_mesh(sdf, resolution=100):
+def get_surface_high_res_mesh(sdf, resolution=100, device=None):
+    device = get_device(device)
     # get low res mesh to sample point cloud
-    grid = get_grid_uniform(100)
-    z = []
-    points = grid['grid_points']
-
-    for i, pnts in enumerate(torch.split(points, 100000, dim=0)):
-        z.append(sdf(pnts).detach().cpu().numpy())
-    z = np.concatenate(z, axis=0)
-
-    z = z.astype(np.float32)
-
-    verts, faces, normals, values = measure.marching_cubes_lewiner(
-        volume=z.reshape(grid['xyz'][1].shape[0], grid['xyz'][0].shape[0],
-                         grid['xyz'][2].shape[0]).transpose([1, 0, 2]),
-        level=0,
-        spacing=(grid['xyz'][0][2] - grid['xyz'][0][1],
-                 grid['xyz'][0][2] - grid['xyz'][0][1],
-                 grid['xyz'][0][2] - grid['xyz'][0][1]))
-
-    verts = verts + np.array([grid['xyz'][0][0], grid['xyz'][1][0], grid['xyz'][2][0]])
+    grid = get_grid_uniform(100, device=device, with_points=False)
+    verts, faces, normals = sparse_marching_cubes(sdf, grid['xyz'], device=device)
 
     mesh_low_res = trimesh.Trimesh(verts, faces, normals)
     components = mesh_low_res.split(only_watertight=False)
@@ -174,7 +281,7 @@ def get_surface_high_res_mesh(sdf, resolution=100):
     mesh_low_res = components[areas.argmax()]
 
     recon_pc = trimesh.sample.sample_surface(mesh_low_res, 10000)[0]
-    recon_pc = torch.from_numpy(recon_pc).float().cuda()
+    recon_pc = torch.from_numpy(recon_pc).float().to(device)
 
     # Center and align the recon pc
     s_mean = recon_pc.mean(dim=0)
@@ -182,64 +289,44 @@ def get_surface_high_res_mesh(sdf, resolution=100):
     s_cov = torch.mm(s_cov.transpose(0, 1), s_cov)
     vecs = torch.eig(s_cov, True)[1].transpose(0, 1)
     if torch.det(vecs) < 0:
-        vecs = torch.mm(torch.tensor([[1, 0, 0], [0, 0, 1], [0, 1, 0]]).cuda().float(), vecs)
+        vecs = torch.mm(torch.tensor([[1, 0, 0], [0, 0, 1], [0, 1, 0]], device=device).float(), vecs)
     helper = torch.bmm(vecs.unsqueeze(0).repeat(recon_pc.shape[0], 1, 1),
                        (recon_pc - s_mean).unsqueeze(-1)).squeeze()
 
-    grid_aligned = get_grid(helper.cpu(), resolution)
-
-    grid_points = grid_aligned['grid_points']
-
-    g = []
-    for i, pnts in enumerate(torch.split(grid_points, 100000, dim=0)):
-        g.append(torch.bmm(vecs.unsqueeze(0).repeat(pnts.shape[0], 1, 1).transpose(1, 2),
-                           pnts.unsqueeze(-1)).squeeze() + s_mean)
-    grid_points = torch.cat(g, dim=0)
+    grid_aligned = get_grid(helper.cpu(), resolution, device=device, with_points=False)
 
-    # MC to new grid
-    points = grid_points
-    z = []
-    for i, pnts in enumerate(torch.split(points, 100000, dim=0)):
-        z.append(sdf(pnts).detach().cpu().numpy())
-    z = np.concatenate(z, axis=0)
+    # MC to new grid, aligned grid points are rotated back to the object frame
+    mesh = sparse_marching_cubes(sdf, grid_aligned['xyz'], transform=lambda pnts: torch.mm(pnts, vecs) + s_mean,
+                                 device=device)
 
     meshexport = None
-    if (not (np.min(z) > 0 or np.max(z) < 0)):
+    if mesh is not None:
+        verts, faces, normals = mesh
 
-        z = z.astype(np.float32)
-
-        verts, faces, normals, values = measure.marching_cubes_lewiner(
-            volume=z.reshape(grid_aligned['xyz'][1].shape[0], grid_aligned['xyz'][0].shape[0],
-                             grid_aligned['xyz'][2].shape[0]).transpose([1, 0, 2]),
-            level=0,
-            spacing=(grid_aligned['xyz'][0][2] - grid_aligned['xyz'][0][1],
-                     grid_aligned['xyz'][0][2] - grid_aligned['xyz'][0][1],
-                     grid_aligned['xyz'][0][2] - grid_aligned['xyz'][0][1]))
-
-        verts = torch.from_numpy(verts).cuda().float()
-        verts = torch.bmm(vecs.unsqueeze(0).repeat(verts.shape[0], 1, 1).transpose(1, 2),
-                   verts.unsqueeze(-1)).squeeze()
-        verts = (verts + grid_points[0]).cpu().numpy()
+        verts = torch.from_numpy(verts).to(device).float()
+        verts = (torch.mm(verts, vecs) + s_mean).cpu().numpy()
 
         meshexport = trimesh.Trimesh(verts, faces, normals)
 
     return meshexport
 
 
-def get_grid_uniform(resolution):
+def get_grid_uniform(resolution, device=None, with_points=True):
     x = np.linspace(-1.0, 1.0, resolution)
     y = x
     z = x
 
-    xx, yy, zz = np.meshgrid(x, y, z)
-    grid_points = torch.tensor(np.vstack([xx.ravel(), yy.ravel(), zz.ravel()]).T, dtype=torch.float)
+    grid_points = None
+    if with_points:
+        xx, yy, zz = np.meshgrid(x, y, z)
+        grid_points = torch.tensor(np.vstack([xx.ravel(), yy.ravel(), zz.ravel()]).T, dtype=torch.float).to(get_device(device))
 
-    return {"grid_points": grid_points.cuda(),
+    return {"grid_points": grid_points,
             "shortest_axis_length": 2.0,
             "xyz": [x, y, z],
             "shortest_axis_index": 0}
 
-def get_grid(points, resolution):
+def get_grid(points, resolution, device=None, with_points=True):
     eps = 0.2
     input_min = torch.min(points, dim=0)[0].squeeze().numpy()
     input_max = torch.max(points, dim=0)[0].squeeze().numpy()
@@ -265,8 +352,10 @@ def get_grid(points, resolution):
         x = np.arange(input_min[0] - eps, input_max[0] + length / (z.shape[0] - 1) + eps, length / (z.shape[0] - 1))
         y = np.arange(input_min[1] - eps, input_max[1] + length / (z.shape[0] - 1) + eps, length / (z.shape[0] - 1))
 
-    xx, yy, zz = np.meshgrid(x, y, z)
-    grid_points = torch.tensor(np.vstack([xx.ravel(), yy.ravel(), zz.ravel()]).T, dtype=torch.float).cuda()
+    grid_points = None
+    if with_points:
+        xx, yy, zz = np.meshgrid(x, y, z)
+        grid_points = torch.tensor(np.vstack([xx.ravel(), yy.ravel(), zz.ravel()]).T, dtype=torch.float).to(get_device(device))
     return {"grid_points": grid_points,
             "shortest_axis_length": length,
             "xyz": [x, y, z],
@@ -287,7 +376,7 @@ def plot_depth_maps(depth_maps, path, epoch, plot_nrow, img_res):
     img.save('{0}/depth_{1}.png'.format(path, epoch))
 
 def plot_images(rgb_points, ground_true, path, epoch, plot_nrow, img_res):
-    ground_true = (ground_true.cuda() + 1.) / 2.
+    ground_true = (ground_true.to(rgb_points.device) + 1.) / 2.
     rgb_points = (rgb_points + 1. ) / 2.
 
     output_vs_gt = torch.cat((rgb_points, ground_true), dim=0)
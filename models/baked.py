@@ -0,0 +1,246 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from tqdm import tqdm
+
+from models.embedder import Embedder
+from models.renderer import VolumetricRenderer
+
+# Corner offsets of a voxel for trilinear interpolation
+CORNERS = torch.tensor([[i, j, k] for i in range(2) for j in range(2) for k in range(2)])
+
+class BakedNeRF(nn.Module):
+    '''Inference-only NeRF with density and style-conditioned color features baked into a sparse voxel grid
+    at a set of keyframe times. Rendering only does trilinear lookups, linear blending between the two nearest
+    keyframes and the small view-dependent color head.
+    '''
+
+    def __init__(self, xyz_min, xyz_max, times, resolution=128, num_entries=0, feature_dim=128, use_viewdirs=True,
+        use_embed=True, multires_views=4, zero_viewdir=False, act_fn='ReLU', N_samples=256, ray_chunk=1024*4, pts_chunk=1024*64):
+
+        super().__init__()
+        self.resolution = resolution
+        self.feature_dim = feature_dim
+        self.use_viewdirs = use_viewdirs
+        self.use_embed = use_embed
+        self.multires_views = multires_views
+        self.zero_viewdir = zero_viewdir
+        self.act_fn_name = act_fn
+        self.N_samples = N_samples
+        self.chunk = ray_chunk
+        self.pts_chunk = pts_chunk
+
+        self.register_buffer('xyz_min', torch.Tensor(xyz_min))
+        self.register_buffer('xyz_max', torch.Tensor(xyz_max))
+        self.register_buffer('times', torch.Tensor(times)) # [T]
+        # Row of each grid vertex in the feature table, -1 for empty vertices
+        self.register_buffer('index', torch.full([resolution] * 3, -1, dtype=torch.int32))
+        # Raw density and color feature of occupied vertices at every keyframe
+        self.register_buffer('table', torch.zeros([len(times), num_entries, 1 + feature_dim], dtype=torch.half))
+
+        # View-dependent head, the feature part of its first layer is folded into the baked features
+        if use_viewdirs:
+            periodic_fns = [torch.sin, torch.cos] if use_embed else []
+            self.embeddirs = Embedder(3, multires_views, multires_views-1, periodic_fns, log_sampling=True, include_input=True)
+            self.dir_linear = nn.Linear(self.embeddirs.out_dim, feature_dim, bias=False)
+            self.rgb_linear = nn.Linear(feature_dim, 3)
+            self.act_fn = getattr(nn, act_fn)()
+
+        self.renderer = VolumetricRenderer()
+
+    def get_kwargs(self):
+        return {
+            'xyz_min': self.xyz_min.cpu().numpy(),
+            'xyz_max': self.xyz_max.cpu().numpy(),
+            'times': self.times.cpu().numpy(),
+            'resolution': self.resolution,
+            'num_entries': self.table.shape[1],
+            'feature_dim': self.feature_dim,
+            'use_viewdirs': self.use_viewdirs,
+            'use_embed': self.use_embed,
+            'multires_views': self.multires_views,
+            'zero_viewdir': self.zero_viewdir,
+            'act_fn': self.act_fn_name,
+            'N_samples': self.N_samples,
+            'ray_chunk': self.chunk,
+            'pts_chunk': self.pts_chunk,
+        }
+
+    def vertices(self):
+        '''Positions of all grid vertices [R^3, 3]'''
+        steps = torch.linspace(0, 1, self.resolution, device=self.xyz_min.device)
+        grid = torch.stack(torch.meshgrid(steps, steps, steps), -1).reshape(-1, 3)
+        return self.xyz_min + (self.xyz_max - self.xyz_min) * grid
+
+    def keyframes(self, times):
+        '''Two nearest keyframes and blending weight for each time [N, 1]'''
+        times = times.reshape(-1).to(self.times)
+        if len(self.times) == 1:
+            k0 = torch.zeros_like(times, dtype=torch.long)
+            return k0, k0, torch.zeros_like(times)
+        k1 = torch.searchsorted(self.times, times.contiguous()).clamp(1, len(self.times)-1)
+        k0 = k1 - 1
+        w = (times - self.times[k0]) / (self.times[k1] - self.times[k0]).clamp(min=1e-10)
+        return k0, k1, w.clamp(0, 1)
+
+    def lookup(self, pts, k0, k1, w):
+        '''Trilinear lookup of baked values.
+        Args:
+          pts: [N, 3]. Query points.
+          k0, k1, w: [N]. Keyframes and blending weight of each point.
+        Returns:
+          values: [N, 1+C]. Raw density and color feature, zero in empty space.
+          mask: [N]. Points touching at least one occupied vertex.
+        '''
+        R = self.resolution
+        u = (pts - self.xyz_min) / (self.xyz_max - self.xyz_min) * (R - 1)
+        inside = ((u >= 0) & (u <= R - 1)).all(-1)
+        i0 = u.floor().long().clamp(0, R - 2)
+        f = (u - i0).clamp(0, 1)
+
+        corners = CORNERS.to(pts.device)
+        idx = i0[:, None] + corners # [N, 8, 3]
+        weights = torch.where(corners.bool(), f[:, None], 1 - f[:, None]).prod(-1) # [N, 8]
+        ids = self.index[idx[..., 0], idx[..., 1], idx[..., 2]].long() # [N, 8]
+        valid = (ids >= 0) & inside[:, None]
+        mask = valid.any(-1)
+
+        values = pts.new_zeros([len(pts), 1 + self.feature_dim])
+        if not mask.any():
+            return values, mask
+        ids, weights = ids[mask].clamp(min=0), (weights * valid)[mask]
+        k0, k1, w = k0[mask], k1[mask], w[mask]
+        v0 = (self.table[k0[:, None], ids].float() * weights[..., None]).sum(1)
+        v1 = (self.table[k1[:, None], ids].float() * weights[..., None]).sum(1)
+        values[mask] = v0 + w[:, None] * (v1 - v0)
+        return values, mask
+
+    def color_head(self, feature, embedded_dirs):
+        if not self.use_viewdirs:
+            return feature
+        h = self.act_fn(feature + self.dir_linear(embedded_dirs))
+        return self.rgb_linear(h)
+
+    def render_rays(self, rays_o, rays_d, near, far, times):
+        S = self.N_samples
+        t_vals = torch.linspace(0., 1., steps=S, device=rays_o.device)
+        z_vals = near * (1. - t_vals) + far * t_vals # [N_rays, N_samples]
+        pts = (rays_o[..., None, :] + rays_d[..., None, :] * z_vals[..., :, None]).reshape(-1, 3) # [N_rays * N_samples, 3]
+
+        k0, k1, w = self.keyframes(times) # [N_rays]
+        ray_id = torch.arange(len(rays_o), device=rays_o.device).repeat_interleave(S)
+        if self.use_viewdirs:
+            viewdirs = rays_d / torch.norm(rays_d, dim=-1, keepdim=True)
+            embedded_dirs = self.embeddirs(viewdirs) # [N_rays, C]
+            if self.zero_viewdir:
+                embedded_dirs = torch.zeros_like(embedded_dirs)
+
+        raw = pts.new_zeros([len(pts), 4])
+        for i in range(0, len(pts), self.pts_chunk):
+            end = min(i+self.pts_chunk, len(pts))
+            chunk_ray = ray_id[i:end]
+            values, mask = self.lookup(pts[i:end], k0[chunk_ray], k1[chunk_ray], w[chunk_ray])
+            if not mask.any():
+                continue
+            # the view-dependent head only runs on samples near occupied vertices
+            chunk_ray = chunk_ray[mask]
+            rgb = self.color_head(values[mask, 1:], embedded_dirs[chunk_ray] if self.use_viewdirs else None)
+            raw[i:end][mask] = torch.cat([rgb, values[mask, :1]], -1)
+
+        return self.renderer(raw.reshape(len(rays_o), S, 4), z_vals, rays_d)
+
+    @torch.no_grad()
+    def forward(self, rays_o, rays_d, times, bound_batch, stl_idx=None, test=True, **kwargs):
+        """Render rays, same inputs and outputs as NeRFNet.forward. The style is fixed when baking, stl_idx is ignored.
+        """
+        rays_o, rays_d = rays_o.squeeze(0), rays_d.squeeze(0)
+        if times is None:
+            times = torch.zeros_like(rays_d[..., :1])
+        times = times.squeeze(0)
+
+        near, far = bound_batch
+        if isinstance(near, int) or isinstance(near, float):
+            near = near * torch.ones_like(rays_d[...,:1], dtype=torch.float)
+        if isinstance(far, int) or isinstance(far, float):
+            far = far * torch.ones_like(rays_d[...,:1], dtype=torch.float)
+
+        all_ret = {}
+        for i in range(0, rays_o.shape[0], self.chunk):
+            end = min(i+self.chunk, rays_o.shape[0])
+            ret = self.render_rays(rays_o[i:end], rays_d[i:end], near[i:end], far[i:end], times[i:end])
+            for k in ret:
+                if k not in all_ret:
+                    all_ret[k] = []
+                all_ret[k].append(ret[k])
+        return {k : torch.cat(all_ret[k], 0) for k in all_ret}
+
+
+@torch.no_grad()
+def bake_nerf(model, xyz_min, xyz_max, times=None, stl_idx=None, resolution=128, thres=0.01, **kwargs):
+    """Bake the fine network of a NeRFNet into a BakedNeRF.
+    Args:
+      model: NeRFNet, not wrapped by DataParallel.
+      times: keyframe times for dynamic NeRF, None for static scenes.
+      stl_idx: style the color features are conditioned on.
+      thres: density threshold, vertices around denser ones are kept.
+    """
+    net = model.nerf_fine
+    mlp = net.mlp
+    device = next(net.parameters()).device
+    keyframes = [None] if times is None else sorted(float(t) for t in times)
+
+    use_viewdirs = mlp.use_viewdirs
+    feature_dim = mlp.views_linears[0].out_features if use_viewdirs else 3
+    baked = BakedNeRF(xyz_min, xyz_max, [0.] if times is None else keyframes, resolution=resolution,
+        feature_dim=feature_dim, use_viewdirs=use_viewdirs, zero_viewdir=mlp.zero_viewdir,
+        use_embed=len(net.embeddirs.periodic_fns) > 0 if use_viewdirs else True,
+        multires_views=len(net.embeddirs.freq_bands) if use_viewdirs else 0,
+        act_fn=type(mlp.act_fn).__name__, **kwargs).to(device)
+    chunk = baked.pts_chunk
+
+    def query(pts, t):
+        chunk_t = None if t is None else torch.full_like(pts[:, :1], t)
+        out = net(pts[:, None], None, stl_idx=stl_idx, times=chunk_t, head=False)[:, 0] # [N, W+1]
+        density, feature = out[:, -1:], out[:, :-1]
+        if use_viewdirs:
+            # fold the feature part of the first view layer into the baked feature
+            W = feature.shape[-1]
+            feature = F.linear(feature, mlp.views_linears[0].weight[:, :W], mlp.views_linears[0].bias)
+        return density, feature
+
+    # occupied vertices at any keyframe
+    verts = baked.vertices() # [R^3, 3]
+    density = torch.zeros_like(verts[:, 0])
+    for t in tqdm(keyframes, desc='Baking density'):
+        for i in range(0, len(verts), chunk):
+            end = min(i+chunk, len(verts))
+            density[i:end] = torch.maximum(density[i:end], F.relu(query(verts[i:end], t)[0][:, 0]))
+    occupied = (density > thres).float().reshape(1, 1, *[resolution] * 3)
+    occupied = F.max_pool3d(occupied, kernel_size=3, stride=1, padding=1).reshape(-1) > 0
+    ids = occupied.nonzero(as_tuple=True)[0]
+    print(f"[Bake]: {len(ids)} / {len(verts)} occupied vertices, {len(keyframes)} keyframes")
+
+    baked.index.view(-1)[ids] = torch.arange(len(ids), device=device, dtype=torch.int32)
+    baked.table = torch.zeros([len(keyframes), len(ids), 1 + feature_dim], dtype=torch.half, device=device)
+    for k, t in enumerate(tqdm(keyframes, desc='Baking features')):
+        for i in range(0, len(ids), chunk):
+            end = min(i+chunk, len(ids))
+            density, feature = query(verts[ids[i:end]], t)
+            baked.table[k, i:end] = torch.cat([density, feature], -1).half()
+
+    # view-dependent head
+    if use_viewdirs:
+        W = mlp.views_linears[0].in_features - baked.embeddirs.out_dim
+        baked.dir_linear.weight.copy_(mlp.views_linears[0].weight[:, W:])
+        baked.rgb_linear.load_state_dict(mlp.rgb_linear.state_dict())
+    return baked
+
+def save_baked(baked, path):
+    torch.save({'kwargs': baked.get_kwargs(), 'model': baked.state_dict()}, path)
+    print(f"[Bake]: saved to {path}")
+
+def load_baked(path):
+    ckpt = torch.load(path, map_location='cpu')
+    baked = BakedNeRF(**ckpt['kwargs'])
+    baked.load_state_dict(ckpt['model'])
+    return baked
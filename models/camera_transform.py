@@ -1,5 +1,4 @@
 import torch
-torch.autograd.set_detect_anomaly(True)
 import torch.nn as nn
 import numpy as np
 
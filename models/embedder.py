@@ -17,31 +17,37 @@ class Embedder(nn.Module):
                  log_sampling=True, include_input=True):
         super(Embedder, self).__init__()
 
-        embed_fns = []
         d = input_dim
         out_dim = 0
 
         # Identity map if no periodic_fns provided
-        if include_input or len(periodic_fns) == 0:
-            embed_fns.append(lambda x : x)
+        self.include_input = include_input or len(periodic_fns) == 0
+        if self.include_input:
             out_dim += d
 
-        if len(periodic_fns) != 0:
-            if log_sampling:
-                freq_bands = 2.**torch.linspace(0., max_freq, steps=N_freqs)
-            else:
-                freq_bands = torch.linspace(2.**0., 2.**max_freq, steps=N_freqs)
+        if log_sampling:
+            freq_bands = 2.**torch.linspace(0., max_freq, steps=N_freqs)
+        else:
+            freq_bands = torch.linspace(2.**0., 2.**max_freq, steps=N_freqs)
+        if len(periodic_fns) == 0:
+            freq_bands = freq_bands[:0]
+        out_dim += d * len(freq_bands) * len(periodic_fns)
 
-            for freq in freq_bands:
-                for p_fn in periodic_fns:
-                    embed_fns.append(lambda x, p_fn=p_fn, freq=freq : p_fn(x * freq))
-                    out_dim += d
-
-        self.embed_fns = embed_fns
+        # Not saved in checkpoints, rebuilt from the config
+        self.register_buffer('freq_bands', freq_bands, persistent=False)
+        self.periodic_fns = periodic_fns
         self.out_dim = out_dim
 
     def forward(self, inputs):
-        return torch.cat([fn(inputs) for fn in self.embed_fns], -1)
+        outputs = [inputs] if self.include_input else []
+        if len(self.freq_bands) > 0:
+            # Same layout as [p_fn(x * freq) for freq in freq_bands for p_fn in periodic_fns]
+            x = inputs[..., None, :] * self.freq_bands[:, None] # [..., N_freqs, d]
+            x = torch.stack([p_fn(x) for p_fn in self.periodic_fns], -2) # [..., N_freqs, N_fns, d]
+            outputs.append(x.flatten(-3))
+        if len(outputs) == 1:
+            return outputs[0]
+        return torch.cat(outputs, -1)
 
 # def get_embedder(input_dims, multires, i=0):
 #     if i == -1:
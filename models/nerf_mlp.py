@@ -8,10 +8,13 @@ import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from tqdm import tqdm, trange
 import math
 
 from models.embedder import Embedder
+from models.tineuvox import voxel_pyramid
+from utils.profiler import span
 
 from utils.error import *
 from pdb import set_trace as st
@@ -109,7 +112,9 @@ class MLP(nn.Module):
         else:
             self.output_linear = nn.Linear(W, output_ch)
 
-    def forward(self, feature_vector, view_dirs=None, style_feature=None):
+    def forward(self, feature_vector, view_dirs=None, style_feature=None, head=True):
+        """head: if False, return the color feature fed to the view-dependent head and the density [N, W+1]
+        """
         input_pts, input_views = feature_vector, view_dirs
         h = input_pts
         # featurenet in tineuvox
@@ -125,42 +130,51 @@ class MLP(nn.Module):
             feature = self.feature_linear(h) # CIM
 
             # Disable view direction for AM
-            if self.zero_viewdir:
+            if self.zero_viewdir and input_views is not None:
                 input_views = torch.zeros_like(input_views).to(input_views.device)
 
-            # AM for color and density from SIM and CIM
-            if self.embed_mlp:
-                for i, l in enumerate(self.mix_d_net[:-1]):
-                    if i == 0:
-                        feature_d_mix = self.mix_d_net[i](torch.cat([h, style_feature], dim=-1))
-                        feature_d_mix = self.act_fn(feature_d_mix)
-                    else:
-                        feature_d_mix = self.mix_d_net[i](feature_d_mix, dim=-1)
-                        feature_d_mix = self.act_fn(feature_d_mix)
-                alpha = self.lemma * alpha + (1 - self.lemma) * self.mix_d_net[-1](feature_d_mix)
-
-                for i, l in enumerate(self.mix_rgb_net[:-1]):
-                    if i == 0:
-                        feature_mix = self.mix_rgb_net[i](torch.cat([feature, style_feature], dim=-1))
-                        feature_mix = self.act_fn(feature_mix)
-                    else:
-                        feature_mix = self.mix_rgb_net[i](feature_mix)
-                        feature_mix = self.act_fn(feature_mix)
-                feature = self.gamma * feature + (1 - self.gamma) * self.mix_rgb_net[-1](feature_mix)
-
-            # previous code
-            h = torch.cat([feature, input_views], -1)
-            for i, l in enumerate(self.views_linears):
-                h = self.views_linears[i](h)
-                h = self.act_fn(h)
-
-            rgb = self.rgb_linear(h) # rgbnet in tineuvox
-            outputs = torch.cat([rgb, alpha], -1)
+            # Styles share the geometry trunk, only the style mixing and the color head run per style
+            if isinstance(style_feature, (list, tuple)):
+                return torch.stack([self.style_head(h, alpha, feature, input_views, s, head) for s in style_feature], 0)
+            outputs = self.style_head(h, alpha, feature, input_views, style_feature, head)
         else:
             outputs = self.output_linear(h)
 
         return outputs
 
+    def style_head(self, h, alpha, feature, input_views, style_feature=None, head=True):
+        # AM for color and density from SIM and CIM
+        if self.embed_mlp:
+            for i, l in enumerate(self.mix_d_net[:-1]):
+                if i == 0:
+                    feature_d_mix = self.mix_d_net[i](torch.cat([h, style_feature], dim=-1))
+                    feature_d_mix = self.act_fn(feature_d_mix)
+                else:
+                    feature_d_mix = self.mix_d_net[i](feature_d_mix, dim=-1)
+                    feature_d_mix = self.act_fn(feature_d_mix)
+            alpha = self.lemma * alpha + (1 - self.lemma) * self.mix_d_net[-1](feature_d_mix)
+
+            for i, l in enumerate(self.mix_rgb_net[:-1]):
+                if i == 0:
+                    feature_mix = self.mix_rgb_net[i](torch.cat([feature, style_feature], dim=-1))
+                    feature_mix = self.act_fn(feature_mix)
+                else:
+                    feature_mix = self.mix_rgb_net[i](feature_mix)
+                    feature_mix = self.act_fn(feature_mix)
+            feature = self.gamma * feature + (1 - self.gamma) * self.mix_rgb_net[-1](feature_mix)
+
+        if not head:
+            return torch.cat([feature, alpha], -1)
+
+        # previous code
+        h = torch.cat([feature, input_views], -1)
+        for i, l in enumerate(self.views_linears):
+            h = self.views_linears[i](h)
+            h = self.act_fn(h)
+
+        rgb = self.rgb_linear(h) # rgbnet in tineuvox
+        return torch.cat([rgb, alpha], -1)
+
     def load_weights_from_keras(self, weights):
         assert self.use_viewdirs, "Not implemented if use_viewdirs=False"
 
@@ -197,11 +211,16 @@ class NeRFMLP(nn.Module):
     def __init__(self, input_dim=3, output_dim=4, net_depth=8, net_width=256, no_skip=False, act_fn="relu", skips=[4],
         viewdirs=True, use_embed=True, multires=10, multires_views=4, multires_times=8, multires_grid=2, netchunk=1024*64, fix_weight=False,
         zero_viewdir=False, embed_mlp=False, offset_mlp=False, embed_posembed=False, stl_num=None,
-        is_dynamic=False, xyz_min=None, xyz_max=None, num_voxels=0, num_voxels_base=0, num_voxel_grids=0, deformation_depth=3):
+        is_dynamic=False, xyz_min=None, xyz_max=None, num_voxels=0, num_voxels_base=0, num_voxel_grids=0, deformation_depth=3,
+        cache_viewdirs=True, grad_checkpoint=False):
 
         super().__init__()
 
         self.chunk = netchunk
+        # Recompute MLP, deformation and style activations of each chunk in backward instead of storing them
+        self.grad_checkpoint = grad_checkpoint
+        # Embed view directions once per ray instead of once per sample
+        self.cache_viewdirs = cache_viewdirs
         self.embed_mlp = embed_mlp
         self.offset_mlp = offset_mlp
         self.embed_posembed = embed_posembed
@@ -315,17 +334,21 @@ class NeRFMLP(nn.Module):
         return ret_lst
 
 
-    def mult_dist_interp(self, ray_pts_delta):
+    def get_voxel_pyramid(self):
+        # Rebuilding the pyramid is only needed when the features change, reuse it when no graph is recorded
+        if torch.is_grad_enabled() and self.voxel_features.requires_grad:
+            return voxel_pyramid(self.voxel_features)
+        key = (self.voxel_features.data_ptr(), self.voxel_features._version)
+        if getattr(self, '_pyramid_key', None) != key:
+            self._pyramid, self._pyramid_key = voxel_pyramid(self.voxel_features.detach()), key
+        return self._pyramid
 
-        x_pad = math.ceil((self.voxel_features.shape[2]-1)/4.0)*4-self.voxel_features.shape[2]+1
-        y_pad = math.ceil((self.voxel_features.shape[3]-1)/4.0)*4-self.voxel_features.shape[3]+1
-        z_pad = math.ceil((self.voxel_features.shape[4]-1)/4.0)*4-self.voxel_features.shape[4]+1
-        grid = F.pad(self.voxel_features.float(),(0,z_pad,0,y_pad,0,x_pad))
-        # three
-        vox_l = self.grid_sampler(ray_pts_delta, grid)
-        vox_m = self.grid_sampler(ray_pts_delta, grid[:,:,::2,::2,::2])
-        vox_s = self.grid_sampler(ray_pts_delta, grid[:,:,::4,::4,::4])
-        vox_feature = torch.cat((vox_l,vox_m,vox_s),-1)
+    def mult_dist_interp(self, ray_pts_delta, pyramid=None):
+
+        if pyramid is None:
+            pyramid = self.get_voxel_pyramid()
+        # three levels in one lookup
+        vox_feature = self.grid_sampler(ray_pts_delta, pyramid)
 
         if len(vox_feature.shape)==1:
             vox_feature_flatten = vox_feature.unsqueeze(0)
@@ -343,6 +366,17 @@ class NeRFMLP(nn.Module):
         self.voxel_features = torch.nn.Parameter(
             F.interpolate(self.voxel_features.data, size=tuple(self.world_size), mode='trilinear', align_corners=True))
 
+    def checkpoint(self, fn, *inputs):
+        """Calls fn(*inputs), with activations recomputed in backward if grad_checkpoint is set.
+        inputs: tensors or None, other arguments should be bound in fn.
+        """
+        if not (self.grad_checkpoint and torch.is_grad_enabled()):
+            return fn(*inputs)
+        # parameters only receive gradients through the checkpoint if one of its inputs requires grad
+        device = next(x.device for x in inputs if x is not None)
+        anchor = torch.ones(1, device=device, requires_grad=True)
+        return checkpoint(lambda _, *args: fn(*args), anchor, *inputs)
+
     def batchify(self, inputs):
         """Single forward feed that applies to smaller batches.
         """
@@ -354,21 +388,57 @@ class NeRFMLP(nn.Module):
         outputs = torch.cat(query_batches, 0) # [N_pts, C]
         return outputs
 
-    def forward(self, inputs, viewdirs=None, stl_idx=None, times=None, **kwargs):
+    def style_embedding(self, stl_idx, embedded_pts):
+        """Conditional style feature of a single style vector stl_idx [1, stl_num] for each point
+        """
+        n = embedded_pts.shape[0]
+        _stl_idx = stl_idx.expand(n, stl_idx.shape[-1])
+        # add the position embedding to learned conditional style feature
+        if self.embed_posembed:
+            for ii, l in enumerate(self.embed_net):
+                if ii == 1:
+                    stl_embed = self.embed_net[ii](torch.cat([stl_embed, embedded_pts, _stl_idx], -1))
+                    stl_embed = self.act_fn(stl_embed)
+                elif ii == 0:
+                    stl_embed = self.embed_net[ii](_stl_idx)
+                    stl_embed = self.act_fn(stl_embed)
+                else:
+                    # stl_embed = self.embed_net[ii](stl_embed)
+                    stl_embed = self.embed_net[ii](torch.cat([stl_embed, _stl_idx], -1))
+                    stl_embed = self.act_fn(stl_embed)
+            return stl_embed
+        stl_embed = stl_idx
+        for ii, l in enumerate(self.embed_net):
+            stl_embed = self.embed_net[ii](stl_embed)
+            stl_embed = self.act_fn(stl_embed)
+        return stl_embed.expand([n, stl_embed.shape[-1]])
+
+    def forward(self, inputs, viewdirs=None, stl_idx=None, times=None, head=True, multi_style=False, **kwargs):
         """Prepares inputs and applies network.
         inputs: shape:[1024, 64, 3]
         viewdirs: shape:[1024, 3]
-        times: shape:
+        times: shape:[1024, 1]
+        head: if False, skip the view-dependent head and return color features and density, see MLP.forward
+        multi_style: stl_idx holds K style vectors [K, stl_num], geometry is computed once and the output is [K, 1024, 64, C]
         """
 
         # Flatten
         inputs_flat = torch.reshape(inputs, [-1, inputs.shape[-1]]) # [N_pts, C]
+        # Per-ray quantities are computed once per ray and gathered for each sample
         if(times is not None):
-            times_flat = torch.reshape(times.repeat(inputs.shape[1], 1), [-1, 1])
-
-        if viewdirs is not None:
-            input_dirs = viewdirs[:,None].expand(inputs.shape)
-            input_dirs_flat = torch.reshape(input_dirs, [-1, input_dirs.shape[-1]])
+            with span('timenet', times):
+                time_embed_rays = self.timenet(self.time_embedder(times.reshape(-1, 1))) # [N_rays, C]
+            # padded multi-resolution voxel grid, shared by all chunks
+            with span('voxel_pyramid'):
+                pyramid = self.get_voxel_pyramid()
+
+        if viewdirs is not None and self.embeddirs is not None:
+            if self.cache_viewdirs:
+                with span('embedder/views', viewdirs):
+                    embedded_dirs_rays = self.embeddirs(viewdirs) # [N_rays, C]
+            else:
+                input_dirs = viewdirs[:,None].expand(inputs.shape)
+                input_dirs_flat = torch.reshape(input_dirs, [-1, input_dirs.shape[-1]])
 
         # print("inputs_flat: ", inputs_flat.shape)
         # print("times_flat: ", times_flat.shape)
@@ -376,66 +446,68 @@ class NeRFMLP(nn.Module):
         output_chunks = []
         for i in range(0, inputs_flat.shape[0], self.chunk):
             end = min(i+self.chunk, inputs_flat.shape[0])
-            embedded_pts = self.embedder(inputs_flat[i:end])
+            with span('embedder/pts', inputs_flat[i:end]):
+                embedded_pts = self.embedder(inputs_flat[i:end])
             style_feature = None
+            # ray index of each sample in the chunk
+            ray_idx = torch.arange(i, end, device=inputs.device) // inputs.shape[1]
+
+            # view direction embedding
+            embedded_dirs = None
+            if viewdirs is not None and self.embeddirs is not None:
+                if self.cache_viewdirs:
+                    embedded_dirs = embedded_dirs_rays[ray_idx]
+                else:
+                    with span('embedder/views', input_dirs_flat[i:end]):
+                        embedded_dirs = self.embeddirs(input_dirs_flat[i:end])
 
             # Style Implicit Module, to learn the conditional style embedding
             if self.embed_mlp:
-                # add the position embedding to learned conditional style feature
-                if self.embed_posembed:
-                    _stl_idx = stl_idx.expand(end-i, stl_idx.shape[-1])
-                    for ii, l in enumerate(self.embed_net):
-                        if ii == 1:
-                            stl_embed = self.embed_net[ii](torch.cat([stl_embed, embedded_pts, _stl_idx], -1))
-                            stl_embed = self.act_fn(stl_embed)
-                        elif ii == 0:
-                            stl_embed = self.embed_net[ii](_stl_idx)
-                            stl_embed = self.act_fn(stl_embed)
-                        else:
-                            # stl_embed = self.embed_net[ii](stl_embed)
-                            stl_embed = self.embed_net[ii](torch.cat([stl_embed, _stl_idx], -1))
-                            stl_embed = self.act_fn(stl_embed)
-                    style_feature = stl_embed
-                else:
-                    for ii, l in enumerate(self.embed_net):
-                        stl_embed = self.embed_net[ii](stl_embed)
-                        stl_embed = self.act_fn(stl_embed)
-                    style_feature = stl_embed.expand([end-i, stl_embed.shape[-1]])
+                with span('style_embedding', embedded_pts):
+                    if multi_style:
+                        style_feature = [self.checkpoint(self.style_embedding, stl, embedded_pts) for stl in stl_idx.reshape(-1, 1, stl_idx.shape[-1])]
+                    else:
+                        style_feature = self.checkpoint(self.style_embedding, stl_idx, embedded_pts)
 
             # embedded = self.embedder(inputs_flat[i:end]) # CIM output
 
             # Compute Time Embedding
             if(times is not None):
-                # print("TIMES:", times_flat.shape)
-                time_embed = self.time_embedder(times_flat[i:end])
-                time_embed = self.timenet(time_embed)
+                time_embed = time_embed_rays[ray_idx]
 
                 # print("time_embed: ", time_embed.shape)
                 # print("embedded_pts: ", embedded_pts.shape)
 
                 # Compute Deformation + Voxel Grid Sample
-                ray_delta = self.deformationnet(embedded_pts, time_embed)
+                with span('deformation', embedded_pts):
+                    ray_delta = self.checkpoint(self.deformationnet, embedded_pts, time_embed)
 
                 # Voxel Query
-                voxel_features = self.mult_dist_interp(ray_delta)
-                voxel_features = self.grid_embedder(voxel_features)
-
-                # append view direction embedding
-                embedded_dirs = None
-                if self.embeddirs is not None:
-                    embedded_dirs = self.embeddirs(input_dirs_flat[i:end])
+                with span('voxel_interp', ray_delta):
+                    voxel_features = self.mult_dist_interp(ray_delta, pyramid)
+                with span('embedder/grid', voxel_features):
+                    voxel_features = self.grid_embedder(voxel_features)
 
                 feature_vector = torch.cat([embedded_pts, time_embed, voxel_features], axis = -1)
             else:
                 feature_vector = embedded_pts
 
             # Append to embedded
-            h = self.mlp(feature_vector, view_dirs=embedded_dirs, style_feature=style_feature) # [N_chunk, C]
+            with span('mlp', feature_vector):
+                if isinstance(style_feature, list):
+                    h = self.checkpoint(lambda x, v, *s: self.mlp(x, view_dirs=v, style_feature=list(s), head=head),
+                        feature_vector, embedded_dirs, *style_feature) # [K, N_chunk, C]
+                else:
+                    h = self.checkpoint(lambda x, v, s: self.mlp(x, view_dirs=v, style_feature=s, head=head),
+                        feature_vector, embedded_dirs, style_feature) # [N_chunk, C]
             output_chunks.append(h)
-        outputs_flat = torch.cat(output_chunks, 0) # [N_pts, C]
+        outputs_flat = torch.cat(output_chunks, -2) # [(K,) N_pts, C]
+        if multi_style and outputs_flat.dim() == 2:
+            # style independent network
+            outputs_flat = outputs_flat.expand(stl_idx.reshape(-1, stl_idx.shape[-1]).shape[0], *outputs_flat.shape)
 
         # Unflatten
-        sh = list(inputs.shape[:-1]) + [outputs_flat.shape[-1]]
+        sh = list(outputs_flat.shape[:-2]) + list(inputs.shape[:-1]) + [outputs_flat.shape[-1]]
         return torch.reshape(outputs_flat, sh)
 
 
@@ -13,9 +13,10 @@ from tqdm import tqdm, trange
 
 import matplotlib.pyplot as plt
 
-from models.sampler import StratifiedSampler, ImportanceSampler
+from models.sampler import StratifiedSampler, ImportanceSampler, OccupancyGrid
 from models.renderer import VolumetricRenderer
 from models.nerf_mlp import NeRFMLP, EmbedMLP
+from utils.profiler import span
 from pdb import set_trace as st
 
 from utils.error import *
@@ -26,7 +27,8 @@ class NeRFNet(nn.Module):
         viewdirs=True, use_embed=True, multires=10, multires_views=4, ray_chunk=1024*32, pts_chuck=1024*64,
         perturb=1., raw_noise_std=0., fix_param=False, zero_viewdir=False, embed_mlp=False, offset_mlp=False, embed_posembed=False, stl_num=None,
         is_dynamic=False, xyz_min=None, xyz_max=None, num_voxels=0, num_voxels_base=0, num_voxel_grids=0,
-        multires_times=0, multires_grid=0, deformation_depth=0):
+        multires_times=0, multires_grid=0, deformation_depth=0, occ_grid=False, occ_grid_res=64, occ_thres=0.01, cache_viewdirs=True,
+        early_stop=False, early_stop_thres=1e-3, early_stop_block=32, grad_checkpoint=False):
 
         super().__init__()
         self.fix_coarse, self.fix_fine = fix_param
@@ -37,6 +39,14 @@ class NeRFNet(nn.Module):
         if N_importance > 0:
             self.importance_sampler = ImportanceSampler(N_importance, perturb=perturb, lindisp=False, pytest=False)
 
+        # Occupancy grid to skip samples in empty space, refreshed by update_occupancy_grid()
+        self.occupancy_grid = None
+        if occ_grid:
+            if xyz_min is None or xyz_max is None:
+                raise ValueError("Occupancy grid requires xyz_min and xyz_max")
+            print(f"> Occupancy grid: resolution {occ_grid_res}, threshold {occ_thres}")
+            self.occupancy_grid = OccupancyGrid(xyz_min, xyz_max, resolution=occ_grid_res, thres=occ_thres)
+
         # Create transformer
         # self.cam_transformer = None
         # if args.num_cameras > 0:
@@ -58,7 +68,8 @@ class NeRFNet(nn.Module):
         self.nerf = NeRFMLP(input_dim=3, output_dim=4, net_depth=netdepth, net_width=netwidth, no_skip=no_skip, act_fn=act_fn, skips=[4],
                 viewdirs=viewdirs, use_embed=use_embed, multires=multires, multires_views=multires_views, netchunk=pts_chuck,
                 is_dynamic=is_dynamic, xyz_min=xyz_min, xyz_max=xyz_max, num_voxels=num_voxels, num_voxels_base=num_voxels_base, num_voxel_grids=num_voxel_grids,
-                multires_times=multires_times, multires_grid=multires_grid, deformation_depth=deformation_depth)
+                multires_times=multires_times, multires_grid=multires_grid, deformation_depth=deformation_depth, cache_viewdirs=cache_viewdirs,
+                grad_checkpoint=grad_checkpoint)
         if self.fix_coarse == True or self.fix_coarse == "True":
             print(f"> Fix NeRF Coarse")
             for p in self.nerf.mlp.parameters():
@@ -70,7 +81,8 @@ class NeRFNet(nn.Module):
                 viewdirs=viewdirs, use_embed=use_embed, multires=multires, multires_views=multires_views, netchunk=pts_chuck,
                 zero_viewdir=zero_viewdir, embed_mlp=embed_mlp, offset_mlp=offset_mlp, embed_posembed=embed_posembed, stl_num=stl_num,
                 is_dynamic=is_dynamic, xyz_min=xyz_min, xyz_max=xyz_max, num_voxels=num_voxels, num_voxels_base=num_voxels_base, num_voxel_grids=num_voxel_grids,
-                multires_times=multires_times, multires_grid=multires_grid, deformation_depth=deformation_depth)
+                multires_times=multires_times, multires_grid=multires_grid, deformation_depth=deformation_depth, cache_viewdirs=cache_viewdirs,
+                grad_checkpoint=grad_checkpoint)
             if self.fix_fine == True or self.fix_fine == "True":
                 print(f"> Fix NeRF Fine")
                 for p in self.nerf_fine.mlp.parameters():
@@ -90,14 +102,65 @@ class NeRFNet(nn.Module):
         # no perturbation
         self.render_kwargs_test['perturb'] = 0.
         self.render_kwargs_test['raw_noise_std'] = 0.
+        # early ray termination at test time
+        self.render_kwargs_test['early_stop'] = early_stop
+        self.render_kwargs_test['early_stop_thres'] = early_stop_thres
+        self.render_kwargs_test['early_stop_block'] = early_stop_block
 
     def _set_tinuvox_grid_resolution(self, num_voxels):
         self.nerf._set_tinuvox_grid_resolution(num_voxels)
         if N_importance > 0:
             self.nerf_fine._set_tinuvox_grid_resolution(num_voxels)
 
+    def query_samples(self, net, pts, viewdirs, stl_idx=None, times=None, mask=None, ray_id=None, multi_style=False, **kwargs):
+        """Query raw data of sample points, skipping the ones dropped by the occupancy grid.
+        Args:
+          pts: [N_rays, N_samples, 3]. Sampled points.
+          viewdirs: [N_rays, 3]. View directions.
+          times: [N_rays, 1]. Times of rays.
+          mask: [N_rays, N_samples]. Occupied samples, all samples are queried if None.
+          ray_id: [M]. Index of the ray of each occupied sample.
+          multi_style: stl_idx holds K style vectors, see NeRFMLP.forward.
+        Returns:
+          raw: [(K,) N_rays, N_samples, C]. Raw predictions, zero for dropped samples.
+        """
+        if mask is None:
+            return net(pts, viewdirs, stl_idx=stl_idx, times=times, multi_style=multi_style)
+
+        n_styles = [stl_idx.reshape(-1, stl_idx.shape[-1]).shape[0]] if multi_style else []
+        if ray_id.numel() == 0:
+            raw = torch.zeros(n_styles + list(pts.shape[:-1]) + [4], device=pts.device)
+            if torch.is_grad_enabled():
+                # keep the net in the graph with zero gradients, so that backward and the DDP reducer still see its parameters
+                raw = raw + 0 * sum(p.sum() for p in net.parameters() if p.requires_grad)
+            return raw
+        # Packed samples are queried as rays with a single sample
+        chunk_v = viewdirs[ray_id] if viewdirs is not None else None
+        chunk_t = times[ray_id] if times is not None else None
+        raw_packed = net(pts[mask][:, None], chunk_v, stl_idx=stl_idx, times=chunk_t, multi_style=multi_style)[..., 0, :] # [(K,) M, C]
+        raw = raw_packed.new_zeros(n_styles + list(pts.shape[:-1]) + [raw_packed.shape[-1]])
+        if multi_style:
+            raw[:, mask] = raw_packed
+        else:
+            raw[mask] = raw_packed
+        return raw
+
+    def block_query(self, net, pts, viewdirs, stl_idx=None, times=None, mask=None, **kwargs):
+        """Returns function(ray_ids, sample_slice) querying raw data of a block of samples, see VolumetricRenderer.forward_early_stop.
+        """
+        def query(ray_ids, block):
+            extras = {}
+            if mask is not None:
+                block_mask = mask[ray_ids, block]
+                extras = dict(mask=block_mask, ray_id=block_mask.nonzero(as_tuple=True)[0])
+            block_v = viewdirs[ray_ids] if viewdirs is not None else None
+            block_t = times[ray_ids] if times is not None else None
+            return self.query_samples(net, pts[ray_ids, block], block_v, stl_idx=stl_idx, times=block_t, **extras)
+        return query
+
     def render_rays(self, rays_o, rays_d, near, far, viewdirs=None, stl_idx=None, times=None, raw_noise_std=0.,
-        verbose=False, retraw = False, retpts=False, pytest=False, **kwargs):
+        verbose=False, retraw = False, retpts=False, pytest=False, multi_style=False,
+        early_stop=False, early_stop_thres=1e-3, early_stop_block=32, **kwargs):
         """Volumetric rendering.
         Args:
           ray_o: origins of rays. [N_rays, 3]
@@ -107,6 +170,10 @@ class NeRFNet(nn.Module):
           raw_noise_std: If True, add noise on raw output from nn
           verbose: bool. If True, print more debugging info.
           times: float. The times for each frame for dynamic NeRF data [N_rays, 1]
+          multi_style: stl_idx holds K style vectors [K, stl_num]. The coarse pass and sampling are shared,
+            fine outputs get a style dimension after the ray dimension, e.g. rgb [N_rays, K, 3].
+          early_stop: inference only. Stop querying rays whose transmittance drops below early_stop_thres,
+            checked every early_stop_block samples, and skip the fine network for rays with coarse acc below it.
         Returns:
           rgb: [N_rays, 3]. Estimated RGB color of a ray. Comes from fine model.
           raw: [N_rays, N_samples, C]. Raw predictions from model.
@@ -120,11 +187,20 @@ class NeRFNet(nn.Module):
         # print("rays_o: ", rays_o.shape)
         # print("times: ", times.shape)
         # Primary sampling
-        pts, z_vals, _ = self.point_sampler(rays_o, rays_d, bounds, **kwargs)  # [N_rays, N_samples, 3]
+        with span('sampler/coarse', rays_o):
+            pts, z_vals, sampler_extras = self.point_sampler(rays_o, rays_d, bounds, occupancy_grid=self.occupancy_grid, **kwargs)  # [N_rays, N_samples, 3]
 
         # print(pts.shape)
-        raw = self.nerf(pts, viewdirs, times = times)
-        ret = self.renderer(raw, z_vals, rays_d, raw_noise_std=raw_noise_std, pytest=pytest)
+        early_stop = early_stop and not multi_style and not torch.is_grad_enabled()
+        if early_stop:
+            with span('renderer/early_stop/coarse', pts):
+                ret, raw = self.renderer.forward_early_stop(self.block_query(self.nerf, pts, viewdirs, times=times, **sampler_extras),
+                    z_vals, rays_d, block_size=early_stop_block, T_thres=early_stop_thres)
+        else:
+            with span('query/coarse', pts):
+                raw = self.query_samples(self.nerf, pts, viewdirs, times=times, **sampler_extras)
+            with span('renderer', raw):
+                ret = self.renderer(raw, z_vals, rays_d, raw_noise_std=raw_noise_std, pytest=pytest)
 
         # Buffer raw/pts
         if retraw:
@@ -139,11 +215,26 @@ class NeRFNet(nn.Module):
             ret0 = ret
 
             # resample
-            pts, z_vals, sampler_extras = self.importance_sampler(rays_o, rays_d, z_vals, **ret, **kwargs) # [N_rays, N_samples + N_importance, 3]
-            # obtain raw data
-            raw = self.nerf_fine(pts, viewdirs, stl_idx=stl_idx, times=times)
-            # render raw data
-            ret = self.renderer(raw, z_vals, rays_d, raw_noise_std=raw_noise_std, pytest=pytest)
+            with span('sampler/importance', rays_o):
+                pts, z_vals, sampler_extras = self.importance_sampler(rays_o, rays_d, z_vals, occupancy_grid=self.occupancy_grid, **ret, **kwargs) # [N_rays, N_samples + N_importance, 3]
+            if early_stop:
+                # rays that hit nothing in the coarse pass are not queried
+                active = ret0['acc'][..., 0] > early_stop_thres
+                with span('renderer/early_stop/fine', pts):
+                    ret, raw = self.renderer.forward_early_stop(
+                        self.block_query(self.nerf_fine, pts, viewdirs, stl_idx=stl_idx, times=times, **sampler_extras),
+                        z_vals, rays_d, active=active, block_size=early_stop_block, T_thres=early_stop_thres)
+            else:
+                # obtain raw data
+                with span('query/fine', pts):
+                    raw = self.query_samples(self.nerf_fine, pts, viewdirs, stl_idx=stl_idx, times=times, multi_style=multi_style, **sampler_extras)
+                # render raw data
+                with span('renderer', raw):
+                    if multi_style:
+                        raw = raw.movedim(0, 1) # [N_rays, K, N_samples, C]
+                        ret = self.renderer(raw, z_vals[:, None], rays_d[:, None], raw_noise_std=raw_noise_std, pytest=pytest)
+                    else:
+                        ret = self.renderer(raw, z_vals, rays_d, raw_noise_std=raw_noise_std, pytest=pytest)
 
             # Buffer raw/pts
             if retraw:
@@ -185,7 +276,7 @@ class NeRFNet(nn.Module):
 
         # # Disentangle ray batch
         rays_o, rays_d = rays_o.squeeze(0), rays_d.squeeze(0)
-        times = times.squeeze(0)
+        times = times.squeeze(0) if times is not None else None
         # # TODO: this line is not compatible with batch size > 1
         # rays_o, rays_d = ray_batch.squeeze(0) #[2,1,3] -> [1,3] [1,3] squeeze out batch dim
         # # rays_o, rays_d = ray_batch #[2,1,3] -> [1,3] [1,3] don't squeeze out batch dim
@@ -240,7 +331,27 @@ class NeRFNet(nn.Module):
         return all_ret
 
     # query raw data for points
-    def forward_pts(self, pts_batch, test=False, **kwargs):
-        raw = self.nerf(pts_batch)
+    def forward_pts(self, pts_batch, viewdirs=None, times=None, test=False, **kwargs):
+        # density does not depend on view direction, feed zeros if not given
+        if viewdirs is None and self.use_viewdirs:
+            viewdirs = torch.zeros_like(pts_batch[:, 0])
+        raw = self.nerf(pts_batch, viewdirs, times=times)
 #         raw = 1.0 - torch.exp(-F.relu(raw))
         return raw
+
+    @torch.no_grad()
+    def update_occupancy_grid(self, times=None):
+        """Refresh the occupancy grid from coarse density queries.
+        Args:
+          times: list of times to query for dynamic NeRF, a cell is occupied if occupied at any of them.
+        """
+        grid = self.occupancy_grid
+        pts = grid.cell_centers(jitter=True) # [R^3, 3]
+        density = torch.zeros_like(pts[:, 0])
+        for t in ([None] if times is None else times):
+            for i in range(0, pts.shape[0], self.chunk):
+                end = min(i+self.chunk, pts.shape[0])
+                chunk_t = None if t is None else torch.full_like(pts[i:end, :1], float(t))
+                raw = self.forward_pts(pts[i:end, None], times=chunk_t) # [N_chunk, 1, C]
+                density[i:end] = torch.maximum(density[i:end], F.relu(raw[:, 0, -1]))
+        grid.update(density)
@@ -3,6 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from utils.error import *
+from utils.precision import float32
 
 
 def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=False):
@@ -70,6 +71,7 @@ class VolumetricRenderer(nn.Module):
     #     CHECK(disp_map=disp_map)
     #     return dict(rgb=rgb_map, disp=disp_map, acc=acc_map, weights=weights, depth=depth_map)
 
+    @float32
     def forward(self, raw, z_vals, rays_d, **kwargs):
         """Transforms model's predictions to semantically meaningful values.
         Args:
@@ -141,6 +143,46 @@ class VolumetricRenderer(nn.Module):
 
         return dict(rgb=rgb_map, disp=disp_map, acc=acc_map, weights=weights, depth=depth_map)
 
+    @torch.no_grad()
+    def forward_early_stop(self, query_fn, z_vals, rays_d, active=None, block_size=32, T_thres=1e-3, **kwargs):
+        """Inference only. Query raw data in blocks of samples along the rays and stop querying a ray once its
+        transmittance drops below T_thres, the remaining samples are treated as empty space.
+        The rendered color differs from the dense path by at most T_thres.
+        Args:
+            query_fn: function(ray_ids, sample_slice) returning raw [len(ray_ids), n_samples, C].
+            z_vals: [num_rays, num_samples]. Point intervals sampled along the ray.
+            rays_d: [num_rays, 3]. Ray directions.
+            active: [num_rays]. Rays to query, the others are rendered as empty space.
+        Returns:
+            ret: see forward.
+            raw: [num_rays, num_samples, C]. Queried raw data, zero for skipped samples.
+        """
+        N_rays, N_samples = z_vals.shape
+        dists = z_vals[...,1:] - z_vals[...,:-1]
+        dists = torch.cat([dists, 1e10 * torch.ones_like(dists[...,:1])], -1)  # Infinite padding: [N_rays, N_samples]
+        dists = dists * torch.linalg.norm(rays_d[..., None, :], ord=2, dim=-1)
+
+        T = torch.ones_like(z_vals[:, 0]) # transmittance before the current block
+        alive = torch.ones_like(T, dtype=torch.bool) if active is None else active.clone()
+        raw = None
+        for start in range(0, N_samples, block_size):
+            ray_ids = alive.nonzero(as_tuple=True)[0]
+            if len(ray_ids) == 0:
+                break
+            block = slice(start, min(start+block_size, N_samples))
+            raw_block = query_fn(ray_ids, block) # [N_alive, N_block, C]
+            if raw is None:
+                raw = raw_block.new_zeros([N_rays, N_samples, raw_block.shape[-1]])
+            raw[ray_ids, block] = raw_block
+
+            alpha = 1.-torch.exp(-self.act_fn(raw_block[..., -1]) * dists[ray_ids, block])
+            T[ray_ids] = T[ray_ids] * torch.prod(1.-alpha + 1e-10, -1)
+            alive[ray_ids] = T[ray_ids] >= T_thres
+
+        if raw is None:
+            raw = torch.zeros(list(z_vals.shape) + [4], device=z_vals.device)
+        return self.forward(raw, z_vals, rays_d, raw_noise_std=0.), raw
+
 # Integration along rays: \int V(o + td) dt
 class ProjectionRenderer(nn.Module):
     def __init__(self, raw_noise_std=0.):
@@ -1,9 +1,10 @@
 import torch
-torch.autograd.set_detect_anomaly(True)
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 
+from utils.precision import float32
+
 # TODO: remove this dependency
 # from torchsearchsorted import searchsorted
 
@@ -30,10 +31,12 @@ class StratifiedSampler(nn.Module):
         bounds: [N_rays, 2] near far boundary
 
         render_kwargs: other render parameters
+            occupancy_grid: optional OccupancyGrid used to skip samples in empty space
 
         Return:
         pts: [N_rays, N_samples, 3] Point samples on every ray
         z_vals: [N_rays, N_samples] The z-values of rays
+        extras: mask/ray_id/step_id of the occupied samples if occupancy_grid is given
         """
 
         perturb = render_kwargs['perturb'] if 'perturb' in render_kwargs else self.perturb
@@ -68,6 +71,11 @@ class StratifiedSampler(nn.Module):
 
         pts = rays_o[...,None,:] + rays_d[...,None,:] * z_vals[...,:,None] # [N_rays, N_samples, 3]
 
+        # Drop samples in empty space if an occupancy grid is provided
+        occupancy_grid = render_kwargs.get('occupancy_grid', None)
+        if occupancy_grid is not None:
+            return pts, z_vals, occupancy_grid.pack(pts)
+
         # No extras
         return pts, z_vals, {}
 
@@ -85,7 +93,8 @@ class ImportanceSampler(nn.Module):
         self.lindisp = lindisp
         self.pytest = pytest
 
-    # Hierarchical sampling (section 5.2)
+    # Hierarchical sampling (section 5.2), the CDF is built in fp32 under autocast
+    @float32
     def sample_pdf(self, bins, weights, det=False):
         # Get pdf
         weights = weights + 1e-5 # prevent nans
@@ -163,8 +172,83 @@ class ImportanceSampler(nn.Module):
 
         pts = rays_o[...,None,:] + rays_d[...,None,:] * z_vals[...,:,None] # [N_rays, N_samples + N_importance, 3]
 
+        # Drop samples in empty space if an occupancy grid is provided
+        occupancy_grid = render_kwargs.get('occupancy_grid', None)
+        if occupancy_grid is not None:
+            ret_extras.update(occupancy_grid.pack(pts))
+
         return pts, z_vals, ret_extras
 
+# Occupancy Grid for empty space skipping
+class OccupancyGrid(nn.Module):
+
+    def __init__(self, xyz_min, xyz_max, resolution=64, thres=0.01, decay=0.95):
+        """ Init occupancy grid
+        xyz_min, xyz_max: [3] bounding box covered by the grid, samples outside are treated as empty
+        resolution: number of cells along each axis
+        thres: density threshold above which a cell is occupied
+        decay: decay of the running density estimate between refreshes
+        """
+        super(OccupancyGrid, self).__init__()
+        self.resolution = resolution
+        self.thres = thres
+        self.decay = decay
+
+        # Derived from the radiance field, so not stored in checkpoints
+        self.register_buffer('xyz_min', torch.Tensor(xyz_min), persistent=False)
+        self.register_buffer('xyz_max', torch.Tensor(xyz_max), persistent=False)
+        self.register_buffer('density', torch.zeros([resolution] * 3), persistent=False)
+        # Every cell is occupied until the first refresh
+        self.register_buffer('bitfield', torch.ones([resolution] * 3, dtype=torch.bool), persistent=False)
+
+    def cell_centers(self, jitter=False):
+        """ Return cell centers (or random points inside each cell if jitter) [resolution^3, 3]
+        """
+        R = self.resolution
+        idx = torch.arange(R, device=self.bitfield.device)
+        ijk = torch.stack(torch.meshgrid(idx, idx, idx), -1).reshape(-1, 3).float() # [R^3, 3]
+        offset = torch.rand_like(ijk) if jitter else 0.5
+        return self.xyz_min + (ijk + offset) / R * (self.xyz_max - self.xyz_min)
+
+    def query(self, pts):
+        """ Look up occupancy of points
+        pts: [..., 3] query points
+
+        Return:
+        mask: [...] True for points inside occupied cells
+        """
+        R = self.resolution
+        ijk = ((pts - self.xyz_min) / (self.xyz_max - self.xyz_min) * R).floor().long()
+        inside = ((ijk >= 0) & (ijk < R)).all(-1)
+        ijk = ijk.clamp(0, R-1)
+        flat_idx = (ijk[..., 0] * R + ijk[..., 1]) * R + ijk[..., 2]
+        return inside & self.bitfield.view(-1)[flat_idx]
+
+    def pack(self, pts):
+        """ Pack occupied samples into per-ray lists
+        pts: [N_rays, N_samples, 3] point samples
+
+        Return:
+        mask: [N_rays, N_samples] True for kept samples
+        ray_id: [M] the index of the ray of each kept sample
+        step_id: [M] the i'th step on a ray of each kept sample
+        """
+        mask = self.query(pts)
+        ray_id, step_id = mask.nonzero(as_tuple=True)
+        return dict(mask=mask, ray_id=ray_id, step_id=step_id)
+
+    @torch.no_grad()
+    def update(self, density):
+        """ Refresh the bitfield from newly queried densities
+        density: [resolution^3] densities at cell_centers()
+        """
+        density = density.reshape(self.density.shape)
+        self.density = torch.maximum(self.density * self.decay, density)
+        bitfield = (self.density > self.thres).float()
+        # Dilate by one cell to be conservative at the surface
+        bitfield = F.max_pool3d(bitfield[None, None], kernel_size=3, stride=1, padding=1)[0, 0]
+        self.bitfield = bitfield > 0
+
 # Layered Sampling Layer
 class LayeredSampler(nn.Module):
 
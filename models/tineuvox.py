@@ -2,29 +2,14 @@ import functools
 import math
 import os
 import time
-from tkinter import W
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.cpp_extension import load
 from torch_scatter import segment_coo
 
-parent_dir = os.path.dirname(os.path.abspath(__file__))
-render_utils_cuda = load(
-        name='render_utils_cuda',
-        sources=[
-            os.path.join(parent_dir, path)
-            for path in ['cuda/render_utils.cpp', 'cuda/render_utils_kernel.cu']],
-        verbose=True)
-
-total_variation_cuda = load(
-        name='total_variation_cuda',
-        sources=[
-            os.path.join(parent_dir, path)
-            for path in ['cuda/total_variation.cpp', 'cuda/total_variation_kernel.cu']],
-        verbose=True)
+from models import tineuvox_ops
 
 
 # H - height of image
@@ -41,16 +26,18 @@ def compute_bbox_by_cam_frustrm(rays, near, far):
     # Read in the rays from the data-dfiles
     xyz_min = torch.Tensor([np.inf, np.inf, np.inf])
     xyz_max = -xyz_min
-    # Read in from data loader
-    rays_o = rays[..., 0, :]
-    rays_d = rays[..., 1, :]
-    # Normalize
-    viewdirs = rays_d / rays_d.norm(dim = -1, keepdim = True)
-
-    pts_nf = torch.stack([rays_o+viewdirs*near, rays_o+viewdirs*far])
-
-    xyz_min = torch.minimum(xyz_min, pts_nf.amin((0,1,2,3)))
-    xyz_max = torch.maximum(xyz_max, pts_nf.amax((0,1,2,3)))
+    # Read in from data loader one view at a time, rays may be a memory-mapped array
+    for i in range(len(rays)):
+        rays_view = torch.as_tensor(np.array(rays[i], dtype=np.float32)) # [H, W, ro+rd, 3]
+        rays_o = rays_view[..., 0, :]
+        rays_d = rays_view[..., 1, :]
+        # Normalize
+        viewdirs = rays_d / rays_d.norm(dim = -1, keepdim = True)
+
+        pts_nf = torch.stack([rays_o+viewdirs*near, rays_o+viewdirs*far])
+
+        xyz_min = torch.minimum(xyz_min, pts_nf.amin((0,1,2)))
+        xyz_max = torch.maximum(xyz_max, pts_nf.amax((0,1,2)))
     print('compute_bbox_by_cam_frustrm: xyz_min', xyz_min)
     print('compute_bbox_by_cam_frustrm: xyz_max', xyz_max)
     print('compute_bbox_by_cam_frustrm: finish')
@@ -238,7 +225,7 @@ class TiNeuVox(torch.nn.Module):
 
     def feature_total_variation_add_grad(self, weight, dense_mode):
         weight = weight * self.world_size.max() / 128
-        total_variation_cuda.total_variation_add_grad(
+        tineuvox_ops.total_variation_add_grad(
             self.feature.float(), self.feature.grad.float(), weight, weight, weight, dense_mode)
 
     def grid_sampler(self, xyz, *grids, mode=None, align_corners=True):
@@ -259,17 +246,21 @@ class TiNeuVox(torch.nn.Module):
         return ret_lst
 
 
-    def mult_dist_interp(self, ray_pts_delta):
+    def get_voxel_pyramid(self):
+        # Rebuilding the pyramid is only needed when the features change, reuse it when no graph is recorded
+        if torch.is_grad_enabled() and self.feature.requires_grad:
+            return voxel_pyramid(self.feature)
+        key = (self.feature.data_ptr(), self.feature._version)
+        if getattr(self, '_pyramid_key', None) != key:
+            self._pyramid, self._pyramid_key = voxel_pyramid(self.feature.detach()), key
+        return self._pyramid
 
-        x_pad = math.ceil((self.feature.shape[2]-1)/4.0)*4-self.feature.shape[2]+1
-        y_pad = math.ceil((self.feature.shape[3]-1)/4.0)*4-self.feature.shape[3]+1
-        z_pad = math.ceil((self.feature.shape[4]-1)/4.0)*4-self.feature.shape[4]+1
-        grid = F.pad(self.feature.float(),(0,z_pad,0,y_pad,0,x_pad))
-        # three
-        vox_l = self.grid_sampler(ray_pts_delta, grid)
-        vox_m = self.grid_sampler(ray_pts_delta, grid[:,:,::2,::2,::2])
-        vox_s = self.grid_sampler(ray_pts_delta, grid[:,:,::4,::4,::4])
-        vox_feature = torch.cat((vox_l,vox_m,vox_s),-1)
+    def mult_dist_interp(self, ray_pts_delta, pyramid=None):
+
+        if pyramid is None:
+            pyramid = self.get_voxel_pyramid()
+        # three levels in one lookup
+        vox_feature = self.grid_sampler(ray_pts_delta, pyramid)
 
         if len(vox_feature.shape)==1:
             vox_feature_flatten = vox_feature.unsqueeze(0)
@@ -285,7 +276,7 @@ class TiNeuVox(torch.nn.Module):
         rays_o = rays_o.reshape(-1, 3).contiguous()
         rays_d = rays_d.reshape(-1, 3).contiguous()
         stepdist = stepsize * self.voxel_size
-        ray_pts, mask_outbbox, ray_id = render_utils_cuda.sample_pts_on_rays(
+        ray_pts, mask_outbbox, ray_id = tineuvox_ops.sample_pts_on_rays(
                 rays_o, rays_d, self.xyz_min, self.xyz_max, near, far, stepdist)[:3]
         mask_inbbox = ~mask_outbbox
         hit = torch.zeros([len(rays_o)], dtype=torch.bool)
@@ -307,7 +298,7 @@ class TiNeuVox(torch.nn.Module):
         rays_o = rays_o.contiguous()
         rays_d = rays_d.contiguous()
         stepdist = stepsize * self.voxel_size
-        ray_pts, mask_outbbox, ray_id, step_id, N_steps, t_min, t_max = render_utils_cuda.sample_pts_on_rays(
+        ray_pts, mask_outbbox, ray_id, step_id, N_steps, t_min, t_max = tineuvox_ops.sample_pts_on_rays(
             rays_o, rays_d, self.xyz_min, self.xyz_max, near, far, stepdist)
         mask_inbbox = ~mask_outbbox
         ray_pts = ray_pts[mask_inbbox]
@@ -404,7 +395,7 @@ class TiNeuVox(torch.nn.Module):
 class Alphas2Weights(torch.autograd.Function):
     @staticmethod
     def forward(ctx, alpha, ray_id, N):
-        weights, T, alphainv_last, i_start, i_end = render_utils_cuda.alpha2weight(alpha, ray_id, N)
+        weights, T, alphainv_last, i_start, i_end = tineuvox_ops.alpha2weight(alpha, ray_id, N)
         if alpha.requires_grad:
             ctx.save_for_backward(alpha, weights, T, alphainv_last, i_start, i_end)
             ctx.n_rays = N
@@ -414,7 +405,7 @@ class Alphas2Weights(torch.autograd.Function):
     @torch.autograd.function.once_differentiable
     def backward(ctx, grad_weights, grad_last):
         alpha, weights, T, alphainv_last, i_start, i_end = ctx.saved_tensors
-        grad = render_utils_cuda.alpha2weight_backward(
+        grad = tineuvox_ops.alpha2weight_backward(
                 alpha, weights, T, alphainv_last,
                 i_start, i_end, ctx.n_rays, grad_weights, grad_last)
         return grad, None, None
@@ -600,6 +591,21 @@ def batch_indices_generator(N, BS):
         yield idx[top:top+BS]
         top += BS
 
+def voxel_pyramid(feature):
+    '''Pad the voxel grid to 4k+1 voxels and stack it with its 2x and 4x subsampled levels along channels.
+    The coarse levels are linearly upsampled back onto the full lattice, which trilinear interpolation
+    reproduces exactly, so one grid_sample gives the three-level lookup.
+    '''
+    x_pad = math.ceil((feature.shape[2]-1)/4.0)*4-feature.shape[2]+1
+    y_pad = math.ceil((feature.shape[3]-1)/4.0)*4-feature.shape[3]+1
+    z_pad = math.ceil((feature.shape[4]-1)/4.0)*4-feature.shape[4]+1
+    grid = F.pad(feature.float(),(0,z_pad,0,y_pad,0,x_pad))
+    levels = [grid] + [
+        F.interpolate(grid[:,:,::s,::s,::s], size=tuple(grid.shape[2:]), mode='trilinear', align_corners=True)
+        for s in [2, 4]
+    ]
+    return torch.cat(levels, 1) # [1, 3*C, X, Y, Z]
+
 def poc_fre(input_data,poc_buf):
 
     input_data_emb = (input_data.unsqueeze(-1) * poc_buf).flatten(-2)
@@ -0,0 +1,159 @@
+import functools
+import os
+
+import torch
+
+# Ray marching and total variation ops used by TiNeuVox.
+# The CUDA extensions in models/cuda are compiled lazily on the first call with CUDA tensors
+# (torch caches the build), the vectorized PyTorch implementation below is used for CPU
+# tensors or when CUDA / a compiler is unavailable.
+
+parent_dir = os.path.dirname(os.path.abspath(__file__))
+
+EXTENSION_SOURCES = {
+    'render_utils_cuda': ['cuda/render_utils.cpp', 'cuda/render_utils_kernel.cu'],
+    'total_variation_cuda': ['cuda/total_variation.cpp', 'cuda/total_variation_kernel.cu'],
+}
+
+@functools.lru_cache(maxsize=None)
+def load_extension(name):
+    '''JIT-compile the CUDA extension, return None if it cannot be built'''
+    from torch.utils.cpp_extension import load, CUDA_HOME
+    if not torch.cuda.is_available() or CUDA_HOME is None:
+        return None
+    try:
+        return load(
+            name=name,
+            sources=[os.path.join(parent_dir, path) for path in EXTENSION_SOURCES[name]],
+            verbose=True)
+    except Exception as e:
+        print(f"[Warning!] Failed to build {name}, fall back to PyTorch implementation: {e}")
+        return None
+
+def get_extension(name, tensor):
+    if not tensor.is_cuda:
+        return None
+    return load_extension(name)
+
+
+def sample_pts_on_rays(rays_o, rays_d, xyz_min, xyz_max, near, far, stepdist):
+    '''Sample points with a fixed step inside the ray-bbox intersection.
+    Output:
+        ray_pts:      [M, 3] sampled points.
+        mask_outbbox: [M]    whether each point is out of the bbox.
+        ray_id:       [M]    the index of the ray of each point.
+        step_id:      [M]    the i'th step on a ray of each point.
+        N_steps:      [N]    number of points on each ray.
+        t_min, t_max: [N]    the ray-bbox intersection.
+    '''
+    ext = get_extension('render_utils_cuda', rays_o)
+    if ext is not None:
+        return ext.sample_pts_on_rays(rays_o, rays_d, xyz_min, xyz_max, near, far, stepdist)
+
+    # ray-bbox intersection
+    vec = torch.where(rays_d == 0, torch.full_like(rays_d, 1e-6), rays_d)
+    rate_a = (xyz_max - rays_o) / vec
+    rate_b = (xyz_min - rays_o) / vec
+    t_min = torch.minimum(rate_a, rate_b).amax(-1).clamp(min=near, max=far)
+    t_max = torch.maximum(rate_a, rate_b).amin(-1).clamp(min=near, max=far)
+
+    # at least 1 point on each ray
+    N_steps = torch.ceil((t_max - t_min) / stepdist).clamp(min=1).long()
+    ray_id = torch.repeat_interleave(torch.arange(len(rays_o), device=rays_o.device), N_steps)
+    step_id = torch.arange(len(ray_id), device=rays_o.device) - (N_steps.cumsum(0) - N_steps)[ray_id]
+
+    rays_start = rays_o + rays_d * t_min[:, None]
+    rays_dir = rays_d / rays_d.norm(dim=-1, keepdim=True)
+    ray_pts = rays_start[ray_id] + rays_dir[ray_id] * (stepdist * step_id)[:, None]
+    mask_outbbox = ((xyz_min > ray_pts) | (xyz_max < ray_pts)).any(-1)
+    return ray_pts, mask_outbbox, ray_id, step_id, N_steps, t_min, t_max
+
+
+def _segment_to_dense(values, i_start, lengths, fill):
+    '''Scatter per-ray segments of values into a [n_rays, max_len] matrix'''
+    n_rays = len(i_start)
+    max_len = int(lengths.max()) if n_rays > 0 else 0
+    pos = torch.arange(max_len, device=values.device)
+    valid = pos[None] < lengths[:, None] # [n_rays, max_len]
+    dense = values.new_full([n_rays, max_len], fill)
+    idx = (i_start[:, None] + pos[None])[valid]
+    dense[valid] = values[idx]
+    return dense, valid, idx
+
+def alpha2weight(alpha, ray_id, n_rays):
+    '''Per-point alpha to accumulated blending weight, rays stop when transmittance drops below 1e-3.
+    ray_id must be sorted, i.e. the points of each ray are contiguous.
+    Output:
+        weight, T:     [M]      blending weight and transmittance before each point.
+        alphainv_last: [n_rays] transmittance left after the last point.
+        i_start, i_end: [n_rays] range of points used by each ray.
+    '''
+    ext = get_extension('render_utils_cuda', alpha)
+    if ext is not None:
+        return ext.alpha2weight(alpha, ray_id, n_rays)
+
+    counts = torch.bincount(ray_id, minlength=n_rays)
+    i_start = counts.cumsum(0) - counts
+    weight = torch.zeros_like(alpha)
+    T = torch.ones_like(alpha)
+    alphainv_last = alpha.new_ones([n_rays])
+    if len(alpha) == 0:
+        return weight, T, alphainv_last, i_start, i_start.clone()
+
+    trans, valid, idx = _segment_to_dense(1 - alpha, i_start, counts, 1.)
+    T_dense = torch.cumprod(torch.cat([torch.ones_like(trans[:, :1]), trans[:, :-1]], -1), -1)
+    # early termination: points after transmittance drops below 1e-3 are skipped
+    active = valid & (T_dense >= 1e-3)
+
+    alpha_dense = 1 - trans
+    T[idx] = torch.where(active, T_dense, torch.ones_like(T_dense))[valid]
+    weight[idx] = torch.where(active, T_dense * alpha_dense, torch.zeros_like(T_dense))[valid]
+    alphainv_last = torch.where(active, trans, torch.ones_like(trans)).prod(-1)
+    i_end = i_start + active.sum(-1)
+    return weight, T, alphainv_last, i_start, i_end
+
+def alpha2weight_backward(alpha, weight, T, alphainv_last, i_start, i_end, n_rays, grad_weights, grad_last):
+    '''Backward pass of alpha2weight'''
+    ext = get_extension('render_utils_cuda', alpha)
+    if ext is not None:
+        return ext.alpha2weight_backward(
+            alpha, weight, T, alphainv_last, i_start, i_end, n_rays, grad_weights, grad_last)
+
+    grad = torch.zeros_like(alpha)
+    if n_rays == 0 or len(alpha) == 0:
+        return grad
+
+    lengths = i_end - i_start
+    alpha_dense, valid, idx = _segment_to_dense(alpha, i_start, lengths, 0.)
+    contrib, _, _ = _segment_to_dense(grad_weights * weight, i_start, lengths, 0.)
+    T_dense, _, _ = _segment_to_dense(T, i_start, lengths, 1.)
+    gw_dense, _, _ = _segment_to_dense(grad_weights, i_start, lengths, 0.)
+
+    # accumulated gradient of all later points on the same ray
+    back_cum = contrib.flip(-1).cumsum(-1).flip(-1) - contrib
+    back_cum = back_cum + (grad_last * alphainv_last)[:, None]
+    grad_dense = gw_dense * T_dense - back_cum / (1 - alpha_dense + 1e-10)
+    grad[idx] = grad_dense[valid]
+    return grad
+
+
+@torch.no_grad()
+def total_variation_add_grad(param, grad, wx, wy, wz, dense_mode):
+    '''Add the gradient of a clamped total variation loss on a [1, C, X, Y, Z] grid to grad in place.
+    Only voxels with non-zero grad are updated unless dense_mode.
+    '''
+    ext = get_extension('total_variation_cuda', param)
+    if ext is not None:
+        return ext.total_variation_add_grad(param, grad, wx, wy, wz, dense_mode)
+
+    grad_to_add = torch.zeros_like(param)
+    for dim, w in zip([2, 3, 4], [wx / 6, wy / 6, wz / 6]):
+        n = param.shape[dim]
+        if n < 2:
+            continue
+        diff = (param.narrow(dim, 1, n-1) - param.narrow(dim, 0, n-1)).clamp(-1, 1)
+        grad_to_add.narrow(dim, 1, n-1).add_(w * diff)
+        grad_to_add.narrow(dim, 0, n-1).sub_(w * diff)
+    if not dense_mode:
+        grad_to_add *= (grad != 0)
+    grad.add_(grad_to_add)
@@ -13,6 +13,7 @@ if __name__ == '__main__':
     parser.add_argument('--conf', type=str, default='./configs/dtu_stylize.conf')
     parser.add_argument('--expname', type=str, default='')
     parser.add_argument('--gpu', type=str, default='auto', help='GPU to use [default: GPU auto]')
+    parser.add_argument('--device', type=str, default='auto', help='Device to run on, e.g. cpu or cuda [default: cuda if available]')
     parser.add_argument('--is_continue', default=False, action="store_true", help='If set, indicates continuing from a previous run.')
     parser.add_argument('--timestamp', default='latest', type=str, help='The timestamp of the run to be used in case of continuing from a previous run.')
     parser.add_argument('--checkpoint', default='latest',type=str,help='The checkpoint epoch number of the run to be used in case of continuing from a previous run.')
@@ -21,7 +22,9 @@ if __name__ == '__main__':
 
     opt = parser.parse_args()
 
-    if opt.gpu == "auto":
+    if opt.device == 'cpu':
+        gpu = 'ignore'
+    elif opt.gpu == "auto":
         deviceIDs = GPUtil.getAvailable(order='memory', limit=1, maxLoad=0.5, maxMemory=0.5, includeNan=False, excludeID=[], excludeUUID=[])
         gpu = deviceIDs[0]
     else:
@@ -37,7 +40,8 @@ if __name__ == '__main__':
                                  timestamp=opt.timestamp,
                                  checkpoint=opt.checkpoint,
                                  scan_id=opt.scan_id,
-                                 train_cameras=opt.train_cameras
+                                 train_cameras=opt.train_cameras,
+                                 device=opt.device
                                  )
 
     trainrunner.run()
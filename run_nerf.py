@@ -24,13 +24,19 @@ from data.datasets import PatchNeRFDataset
 # from data.datasets import BatchNeRFDataset as PatchNeRFDataset
 from data.collater import Ray_Batch_Collate, Image_Batch_Collate
 from models.nerf_net import NeRFNet
+from models.baked import bake_nerf, save_baked, load_baked
 from engines.lr import LRScheduler
-from engines.trainer import train_one_epoch, train_one_epoch_dynamic, save_checkpoint
-from engines.eval import evaluate, render_video, linear_eval
+from engines.trainer import train_one_epoch, train_one_epoch_dynamic, save_checkpoint, update_occupancy_grid, VGGFeatureCache
+from engines.eval import evaluate, render_video, linear_eval, style_sweep
 from models.vgg import Vgg16
 from models.transformer_net import TransformerNet
 from pdb import set_trace as st
 from models.tineuvox import compute_bbox_by_cam_frustrm
+from utils.error import set_debug
+import utils.profiler as profiler
+from utils.precision import grad_scaler
+from utils.distributed import init_distributed, is_main_process, barrier, cleanup, unwrap
+from utils.checkpoint import CheckpointWriter
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
 # TODO: Train a TiNuVox Instance and then fix this, then utilze as the content-implicit module
@@ -128,6 +134,11 @@ def create_arg_parser():
     parser.add_argument("--no_embed", action='store_false', dest='use_embed',
                         help='turn on positional encoding')
     parser.set_defaults(use_embed=True)
+    parser.add_argument("--cache_viewdirs", action='store_true', default=True,
+                        help='embed view directions once per ray instead of once per sample')
+    parser.add_argument("--no_cache_viewdirs", action='store_false', dest='cache_viewdirs',
+                        help='embed view directions once per sample')
+    parser.set_defaults(cache_viewdirs=True)
     parser.add_argument("--multires", type=int, default=10,
                         help='log2 of max freq for positional encoding (3D location)')
     parser.add_argument("--multires_views", type=int, default=4,
@@ -158,6 +169,8 @@ def create_arg_parser():
                         help='options: nerf / point cloud')
     parser.add_argument("--subsample", type=int, default=0,
                     help='subsampling rate if applicable')
+    parser.add_argument("--mmap_data", action='store_true', default=False,
+                        help='memory-map the dataset arrays and load patches lazily instead of loading everything into RAM')
 
     # corruptions
     parser.add_argument("--corrupt_cams", action='store_true',
@@ -182,6 +195,12 @@ def create_arg_parser():
                         help='frequency of testset saving')
     parser.add_argument("--i_video",   type=int, default=25000,
                         help='frequency of render_poses video saving')
+    parser.add_argument("--video_outputs", type=str, nargs='+', default=['rgb'], choices=['rgb', 'disp', 'acc'],
+                        help='outputs written to one video each by --render_video')
+    parser.add_argument("--video_size", type=int, nargs=2, default=None, metavar=('W', 'H'),
+                        help='size of the rendered videos, native resolution by default')
+    parser.add_argument("--video_resume", action='store_true', default=False,
+                        help='save video frames as PNG and skip the frames already saved by a previous run')
     parser.add_argument("--view0_only", action="store_true",
                         help='add style loss only to train view 0')
     parser.add_argument("--patch_size",   type=int, default=48,
@@ -210,6 +229,10 @@ def create_arg_parser():
                         help='')
     parser.add_argument("--linear_eval", action='store_true', default=False,
                         help='')
+    parser.add_argument("--style_sweep", action='store_true', default=False,
+                        help='render the first test view under the interpolated style vectors of linear_eval')
+    parser.add_argument("--style_batch", type=int, default=16,
+                        help='number of styles rendered in one geometry pass')
     parser.add_argument("--offset_mlp", action='store_true', default=False,
                         help='')
     parser.add_argument("--embed_mlp", action='store_true', default=False,
@@ -250,12 +273,108 @@ def create_arg_parser():
     parser.add_argument('--deformation_depth', type=int, default=3,
                         help='Depth of the deformation network.  Only for Dynamic NeRF Datasets')
 
+    # empty space skipping
+    parser.add_argument('--occ_grid', action='store_true', default=False,
+                        help='Skip samples in empty space using an occupancy grid')
+    parser.add_argument('--occ_grid_res', type=int, default=64,
+                        help='Resolution of the occupancy grid along each axis')
+    parser.add_argument('--occ_thres', type=float, default=0.01,
+                        help='Density threshold above which an occupancy grid cell is occupied')
+    parser.add_argument('--occ_update_every', type=int, default=1000,
+                        help='Refresh the occupancy grid every N iterations')
+    parser.add_argument('--occ_time_samples', type=int, default=8,
+                        help='Number of frame times queried per occupancy grid refresh.  Only for Dynamic NeRF Datasets')
+
+    # early ray termination
+    parser.add_argument('--early_stop', action='store_true', default=False,
+                        help='Stop querying rays at test time once their transmittance drops below --early_stop_thres')
+    parser.add_argument('--early_stop_thres', type=float, default=1e-3,
+                        help='Transmittance / coarse opacity tolerance of early ray termination')
+    parser.add_argument('--early_stop_block', type=int, default=32,
+                        help='Number of samples queried per ray between transmittance checks')
+
+    # baked inference
+    parser.add_argument('--bake', action='store_true', default=False,
+                        help='Bake density and color features at the exhibit times into a sparse voxel grid')
+    parser.add_argument('--render_baked', action='store_true', default=False,
+                        help='Render the exhibit video with the baked model')
+    parser.add_argument('--bake_res', type=int, default=128,
+                        help='Resolution of the baked voxel grid')
+    parser.add_argument('--bake_thres', type=float, default=0.01,
+                        help='Density threshold of occupied vertices in the baked grid')
+    parser.add_argument('--bake_keyframes', type=int, default=0,
+                        help='Number of keyframe times to bake, the others are interpolated. 0 bakes every exhibit time')
+    parser.add_argument('--bake_samples', type=int, default=256,
+                        help='Number of samples per ray of the baked renderer')
+
+    # memory
+    parser.add_argument('--grad_checkpoint', action='store_true', default=False,
+                        help='Recompute MLP, deformation and style embedding activations in backward to save memory. '
+                             'Not supported with --ddp: the reentrant per-chunk checkpoints fire the DDP gradient hooks more than once')
+
+    # VGG target caching
+    parser.add_argument('--cache_style', action='store_true', default=True,
+                        help='Compute the Gram matrices of fixed style images once per style index')
+    parser.add_argument('--no_cache_style', action='store_false', dest='cache_style',
+                        help='Recompute style Gram matrices every step')
+    parser.set_defaults(cache_style=True)
+    parser.add_argument('--content_cache_size', type=int, default=0,
+                        help='Number of ground truth patch relu2_2 features kept in an LRU cache, 0 disables it')
+
+    # checkpointing
+    parser.add_argument('--async_ckpt', action='store_true', default=True,
+                        help='Write checkpoints on a background thread from a CPU snapshot of the state dicts')
+    parser.add_argument('--no_async_ckpt', action='store_false', dest='async_ckpt',
+                        help='Write checkpoints on the training thread')
+    parser.set_defaults(async_ckpt=True)
+    parser.add_argument('--ckpt_keep_last', type=int, default=0,
+                        help='Number of most recent step checkpoints kept, 0 keeps all')
+    parser.add_argument('--ckpt_keep_every', type=int, default=0,
+                        help='Step checkpoints at multiples of this step are never removed, 0 to disable')
+
+    # mixed precision
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'],
+                        help='Autocast precision of the NeRF and VGG forward passes, rendering, CDF inversion and Gram matrices stay in fp32')
+
+    # distributed training
+    parser.add_argument('--ddp', action='store_true', default=False,
+                        help='DistributedDataParallel training with one process per device, launch with torchrun')
+    parser.add_argument('--dist_backend', type=str, default=None,
+                        help='Process group backend, defaults to nccl with CUDA and gloo on CPU')
+    parser.add_argument('--ddp_find_unused', action='store_true', default=False,
+                        help='Let DDP search for parameters that receive no gradient, e.g. submodules the forward pass skips. Not needed for --only_update_rgb, frozen parameters are excluded')
+
+    # profiling and debugging
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='Time sampler, embedder, deformation, voxel interpolation, MLP and renderer spans, logged every i_print steps')
+    parser.add_argument('--profile_trace_steps', type=int, default=10,
+                        help='Number of profiled steps written to profile_trace.json in the run dir, 0 disables the Chrome trace')
+    parser.add_argument('--debug', action='store_true', default=False,
+                        help='Enable numerical checks and autograd anomaly detection')
+
     return parser
 
 
 def main(args):
 
     device = torch.device(f'cuda:{args.gpuid}' if torch.cuda.is_available() else 'cpu')
+    rank, local_rank, world_size = 0, 0, 1
+    if args.ddp and args.grad_checkpoint:
+        # every netchunk slice is a separate reentrant checkpoint segment, DDP would mark shared parameters ready twice
+        raise ValueError("--grad_checkpoint is not supported with --ddp")
+    if args.ddp:
+        rank, local_rank, world_size = init_distributed(args.dist_backend)
+        if torch.cuda.is_available():
+            device = torch.device(f'cuda:{local_rank}')
+            torch.cuda.set_device(device)
+        else:
+            device = torch.device('cpu')
+        # every rank samples its own patches and noise, DDP broadcasts the initial weights of rank 0
+        random.seed(rank)
+        np.random.seed(rank)
+        torch.manual_seed(rank)
+        # rays of a patch are no longer split across devices in the training loop
+        args.num_devices = 1
     args.stl_idx = [float(x) for x in args.stl_idx]
 
     if args.patch_stride > 1:
@@ -270,7 +389,7 @@ def main(args):
     # print important info
     print(f"[Weights]: style: {args.style_weight}, content: {args.content_weight}, rgb: {args.rgb_weight}, density: {args.d_weight}")
     # Save/reload config
-    if not os.path.exists(run_dir):
+    if is_main_process() and not os.path.exists(run_dir):
         if not args.eval:
             os.makedirs(run_dir)
             os.makedirs(ckpt_dir)
@@ -284,15 +403,16 @@ def main(args):
         else:
             print("Error: The specified working directory does not exists!")
             return
+    barrier()
 
     # Create dataset
     print("Loading nerf data:", args.data_path)
     train_set = PatchNeRFDataset(args.data_path, subsample=args.subsample, split='train', cam_id=False,
                             patch_size=args.patch_size, style_path=args.style_path, with_mask=args.with_mask,
-                            rand_style=args.rand_style, sphere_style=args.sphere_style, mixed_styles=args.mixed_styles, patch_stride=args.patch_stride, is_dynamic=args.is_dynamic)
-    test_set = PatchNeRFDataset(args.data_path, subsample=args.subsample, split='test', cam_id=False, is_dynamic=args.is_dynamic)
+                            rand_style=args.rand_style, sphere_style=args.sphere_style, mixed_styles=args.mixed_styles, patch_stride=args.patch_stride, is_dynamic=args.is_dynamic, mmap=args.mmap_data)
+    test_set = PatchNeRFDataset(args.data_path, subsample=args.subsample, split='test', cam_id=False, is_dynamic=args.is_dynamic, mmap=args.mmap_data)
     try:
-        exhibit_set = ExhibitNeRFDataset(args.data_path, subsample=args.subsample, is_dynamic=args.is_dynamic)
+        exhibit_set = ExhibitNeRFDataset(args.data_path, subsample=args.subsample, is_dynamic=args.is_dynamic, mmap=args.mmap_data)
     except FileNotFoundError:
         exhibit_set = None
         print("Warning: No exhibit set!")
@@ -300,8 +420,9 @@ def main(args):
     stl_num = get_stl_num(f"{BASE_DIR}/{args.mixed_styles}")
     xyz_min, xyz_max = None, None
     num_voxels = 0
-    if(args.is_dynamic):
+    if(args.is_dynamic or args.occ_grid or args.bake):
         xyz_min, xyz_max = compute_bbox_by_cam_frustrm(train_set.rays, *train_set.near_far())
+    if(args.is_dynamic):
         if(args.pg_scale):
             num_voxels = args.num_voxels // (2 ** len(args.pg_scale))
         else:
@@ -312,37 +433,26 @@ def main(args):
         multires_views=args.multires_views, ray_chunk=args.ray_chunk, pts_chuck=args.pts_chunk, perturb=args.perturb,
         raw_noise_std=args.raw_noise_std, fix_param=args.fix_param, zero_viewdir=args.zero_viewdir, embed_mlp=args.embed_mlp, offset_mlp=args.offset_mlp,
         embed_posembed=args.embed_posembed, stl_num=stl_num, is_dynamic=args.is_dynamic, xyz_min=xyz_min, xyz_max=xyz_max, num_voxels=num_voxels, num_voxels_base=args.num_voxels_base, num_voxel_grids=args.num_voxel_grids,
-        multires_times=args.multires_times, multires_grid=args.multires_grid, deformation_depth=args.deformation_depth)
+        multires_times=args.multires_times, multires_grid=args.multires_grid, deformation_depth=args.deformation_depth,
+        occ_grid=args.occ_grid, occ_grid_res=args.occ_grid_res, occ_thres=args.occ_thres, cache_viewdirs=args.cache_viewdirs,
+        early_stop=args.early_stop, early_stop_thres=args.early_stop_thres, early_stop_block=args.early_stop_block,
+        grad_checkpoint=args.grad_checkpoint)
     if args.with_teach:
         teacher = NeRFNet(netdepth=args.netdepth, netwidth=args.netwidth, netwidth_fine=args.netwidth_fine, netdepth_fine=args.netdepth_fine, no_skip=args.no_skip,
             act_fn=args.act_fn, N_samples=args.N_samples, N_importance=args.N_importance, viewdirs=args.use_viewdirs, use_embed=args.use_embed, multires=args.multires,
             multires_views=args.multires_views, ray_chunk=args.ray_chunk, pts_chuck=args.pts_chunk, perturb=args.perturb,
             raw_noise_std=args.raw_noise_std, fix_param=[True, True], is_dynamic=args.is_dynamic, xyz_min=xyz_min, xyz_max=xyz_max, num_voxels=num_voxels, num_voxels_base=args.num_voxels_base, num_voxel_grids=args.num_voxel_grids,
-            multires_times=args.multires_times, multires_grid=args.multires_grid, deformation_depth=args.deformation_depth)
+            multires_times=args.multires_times, multires_grid=args.multires_grid, deformation_depth=args.deformation_depth,
+            cache_viewdirs=args.cache_viewdirs)
     else:
         teacher = None
     VGG = Vgg16(requires_grad=False)
 
-    if torch.cuda.device_count() >= 1: # TODO
-        print("Multiple GPU training")
-        model = nn.DataParallel(model)
-        VGG = nn.DataParallel(VGG)
-        if args.with_teach:
-            teacher = nn.DataParallel(teacher)
-
-    VGG, model = VGG.cuda(), model.cuda()
-    if args.with_teach:
-        teacher = teacher.cuda()
-
-    optimizer = torch.optim.Adam(params=model.parameters(), lr=args.lrate, betas=(0.9, 0.999))
-    scheduler = LRScheduler(optimizer=optimizer, init_lr=args.lrate, decay_rate=args.decay_rate, decay_steps=args.decay_step*1000)
-
-    transformer = None
-    # fix part of weights
+    # fix part of weights, before wrapping so that DDP only reduces the trainable parameters
     if args.only_update_rgb:
         print("[Info]: only update RGB layers")
         my_list = ['rgb_linear', 'views_linears']
-        for p in model.module.nerf.mlp.named_parameters():
+        for p in model.nerf.mlp.named_parameters():
             p[1].requires_grad = False
             for x in my_list:
                 flag = False
@@ -352,7 +462,7 @@ def main(args):
             if flag:
                 print(p[0])
                 p[1].requires_grad = True
-        for p in model.module.nerf_fine.mlp.named_parameters():
+        for p in model.nerf_fine.mlp.named_parameters():
             p[1].requires_grad = False
             for x in my_list:
                 flag = False
@@ -363,6 +473,37 @@ def main(args):
                 print(p[0])
                 p[1].requires_grad = True
 
+    if args.ddp:
+        print(f"[Info]: DistributedDataParallel training on {world_size} processes")
+        # VGG and the frozen teacher hold no trainable weights, each rank keeps a plain copy
+        model = model.to(device)
+        model = nn.parallel.DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None,
+            find_unused_parameters=args.ddp_find_unused)
+        VGG = VGG.to(device)
+        if args.with_teach:
+            teacher = teacher.to(device)
+    else:
+        if torch.cuda.device_count() >= 1: # TODO
+            print("Multiple GPU training")
+            model = nn.DataParallel(model)
+            VGG = nn.DataParallel(VGG)
+            if args.with_teach:
+                teacher = nn.DataParallel(teacher)
+
+        VGG, model = VGG.cuda(), model.cuda()
+        if args.with_teach:
+            teacher = teacher.cuda()
+
+    optimizer = torch.optim.Adam(params=model.parameters(), lr=args.lrate, betas=(0.9, 0.999))
+    scheduler = LRScheduler(optimizer=optimizer, init_lr=args.lrate, decay_rate=args.decay_rate, decay_steps=args.decay_step*1000)
+    scaler = grad_scaler(args.precision)
+    # random style crops change every step and cannot be cached
+    vgg_cache = VGGFeatureCache(style=args.cache_style and not args.rand_style, content_size=args.content_cache_size)
+    ckpt_writer = CheckpointWriter(keep_last=args.ckpt_keep_last, keep_every=args.ckpt_keep_every, async_save=args.async_ckpt)
+    if args.precision != 'fp32':
+        print(f"[Info]: {args.precision} autocast, loss scaling {scaler.is_enabled()}")
+
+    transformer = None
     global_step = 0
     # find and load checkpoint
     ckpt_path, ckpt_dict = args.ckpt_path, None
@@ -384,38 +525,66 @@ def main(args):
             optimizer.load_state_dict(ckpt_dict['optimizer'])
         except:
             print("[Warning!] Optimizer load failed")
+        if scaler.is_enabled() and 'scaler' in ckpt_dict:
+            scaler.load_state_dict(ckpt_dict['scaler'])
         if args.with_teach:
             teach_ckpt_path = args.teach_ckpt_path
             if not os.path.exists(teach_ckpt_path):
                 teach_ckpt_path = args.ckpt_path
             ckpt_dict = torch.load(teach_ckpt_path, map_location="cpu")
             print(f"[Teach Model]: load from {teach_ckpt_path}")
-            teacher.module.load_state_dict({k.replace('module.',''):v for k,v in ckpt_dict['model'].items()}, strict=True)
+            unwrap(teacher).load_state_dict({k.replace('module.',''):v for k,v in ckpt_dict['model'].items()}, strict=True)
+
+    # occupancy grid is not stored in checkpoints, rebuild it from the loaded weights
+    if args.occ_grid and ckpt_dict is not None:
+        update_occupancy_grid(model, train_set, args)
+
+    if args.profile:
+        trace_path = os.path.join(run_dir, 'profile_trace.json') if args.profile_trace_steps > 0 else None
+        profiler.enable(trace_path=trace_path, trace_steps=args.profile_trace_steps)
+        print(f"[Info]: Profiling enabled, trace: {trace_path}")
 
     ####### Training stage #######
     print(train_set[0])
 
     if not args.eval:
-        train_loader = torch.utils.data.DataLoader(train_set, batch_size=args.batch_size, shuffle=True, drop_last=True,
-            collate_fn=Ray_Batch_Collate(), num_workers=args.num_workers, pin_memory=args.pin_mem)
+        # each rank draws patches from its own shard of the views
+        train_sampler = None
+        if args.ddp:
+            train_sampler = torch.utils.data.distributed.DistributedSampler(train_set, num_replicas=world_size, rank=rank, shuffle=True)
+        train_loader = torch.utils.data.DataLoader(train_set, batch_size=args.batch_size, shuffle=(train_sampler is None), drop_last=True,
+            sampler=train_sampler, collate_fn=Ray_Batch_Collate(), num_workers=args.num_workers, pin_memory=args.pin_mem)
 
         # Summary writers
-        summary_writer = SummaryWriter(log_dir=log_dir)
+        summary_writer = SummaryWriter(log_dir=log_dir) if is_main_process() else None
+        epoch = 0
         while global_step < args.N_iters:
+            if train_sampler is not None:
+                train_sampler.set_epoch(epoch)
+            epoch += 1
             if(args.is_dynamic):
                 global_step = train_one_epoch_dynamic([model, teacher, VGG, transformer], optimizer, scheduler,
                     train_loader, test_set, exhibit_set, summary_writer,
                     global_step, args.N_iters, run_dir, device=device,
                     i_print=args.i_print, i_img=args.i_img, log_img_idx=args.log_img_idx,
-                    i_weights=args.i_weights, i_testset=args.i_testset, i_video=args.i_video, args=args)
+                    i_weights=args.i_weights, i_testset=args.i_testset, i_video=args.i_video, args=args, scaler=scaler, vgg_cache=vgg_cache, ckpt_writer=ckpt_writer)
             else:
                 global_step = train_one_epoch([model, teacher, VGG, transformer], optimizer, scheduler,
                     train_loader, test_set, exhibit_set, summary_writer,
                     global_step, args.N_iters, run_dir, device=device,
                     i_print=args.i_print, i_img=args.i_img, log_img_idx=args.log_img_idx,
-                    i_weights=args.i_weights, i_testset=args.i_testset, i_video=args.i_video, args=args)
-            if global_step % args.i_weights:
-                save_checkpoint(os.path.join(ckpt_dir, 'latest.ckpt'), global_step, model, optimizer)
+                    i_weights=args.i_weights, i_testset=args.i_testset, i_video=args.i_video, args=args, scaler=scaler, vgg_cache=vgg_cache, ckpt_writer=ckpt_writer)
+            if global_step % args.i_weights and is_main_process():
+                save_checkpoint(os.path.join(ckpt_dir, 'latest.ckpt'), global_step, model, optimizer, scaler, writer=ckpt_writer)
+        ckpt_writer.close()
+
+    # evaluation, baking and videos run on rank 0 with the unwrapped model
+    if args.ddp:
+        barrier()
+        if not is_main_process():
+            cleanup()
+            return
+        model = model.module
 
     ############# Test stage#################
     save_dir = os.path.join(run_dir, 'eval')
@@ -423,7 +592,10 @@ def main(args):
     '''You can either use test_set or exhibit_set in rendering a video
     '''
     if args.eval:
-        if args.linear_eval:
+        if args.style_sweep:
+            print(f"[Eval]: Style Sweep")
+            style_sweep(model, test_set, save_dir, expname=args.expname, style_batch=args.style_batch, bs=args.batch_size, device=device, is_dynamic=args.is_dynamic)
+        elif args.linear_eval:
             print(f"[Eval]: Linear Eval")
             linear_eval(model, test_set, device=device, save_dir=save_dir,  expname=args.expname, stl_idx=torch.Tensor(args.stl_idx).cuda(), bs=args.batch_size)
         else:
@@ -433,8 +605,24 @@ def main(args):
                 evaluate(model, test_set, device=device, save_dir=save_dir, stl_idx=torch.Tensor(args.stl_idx).cuda(), bs=args.batch_size, is_dynamic=args.is_dynamic)
         exit(0)
 
+    baked_path = os.path.join(run_dir, 'baked.pt')
+    if args.bake:
+        times = exhibit_set.frame_times()
+        if times is not None and 0 < args.bake_keyframes < len(times):
+            times = times[np.linspace(0, len(times)-1, args.bake_keyframes).round().astype(int)]
+        baked = bake_nerf(unwrap(model), xyz_min, xyz_max, times=times, stl_idx=torch.Tensor(args.stl_idx).cuda(),
+            resolution=args.bake_res, thres=args.bake_thres, N_samples=args.bake_samples)
+        save_baked(baked, baked_path)
+
+    if args.render_baked:
+        baked = load_baked(baked_path).cuda()
+        render_video(baked, exhibit_set, device=device, save_dir=save_dir, suffix='baked', expname=args.expname, stl_idx=torch.Tensor(args.stl_idx).cuda(), bs=args.batch_size,
+            outputs=args.video_outputs, size=args.video_size, resume=args.video_resume)
+        exit(0)
+
     if args.render_video:
-        render_video(model, exhibit_set, device=device, save_dir=save_dir, expname=args.expname, stl_idx=torch.Tensor(args.stl_idx).cuda(), bs=args.batch_size, is_dynamic=args.is_dynamic)
+        render_video(model, exhibit_set, device=device, save_dir=save_dir, expname=args.expname, stl_idx=torch.Tensor(args.stl_idx).cuda(), bs=args.batch_size, is_dynamic=args.is_dynamic,
+            outputs=args.video_outputs, size=args.video_size, resume=args.video_resume)
         exit(0)
 
 if __name__=='__main__':
@@ -446,7 +634,8 @@ if __name__=='__main__':
     args, _ = parser.parse_known_args()
 
     # enable error detection
-    torch.autograd.set_detect_anomaly(True)
+    set_debug(args.debug)
+    torch.autograd.set_detect_anomaly(args.debug)
 
     main(args)
 
@@ -0,0 +1,138 @@
+import os, sys
+import atexit
+import queue, threading
+import torch
+
+# Background checkpoint writer.
+# State dicts are snapshotted to CPU on the training thread, serialized on a worker thread,
+# written to a temporary file and renamed into place so that a crash never leaves a truncated checkpoint.
+# Shared by the NeRF trainer and the IDR runner (utils/ is a namespace package also seen from idr/).
+
+
+def snapshot(obj):
+    '''Copy every tensor in a (nested) state dict to CPU memory, detached from the live training state'''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    '''torch.save into path.tmp, fsync, then rename over path'''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def link_latest(path, latest_path):
+    '''Point latest_path to path with a relative symlink, falling back to a hardlink and then a copy'''
+    tmp_path = latest_path + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.symlink(os.path.relpath(path, os.path.dirname(latest_path)), tmp_path)
+    except (OSError, NotImplementedError):
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            import shutil
+            shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, latest_path)
+
+
+class CheckpointWriter:
+    '''Writes checkpoints off the training thread with a retention policy.
+    Args:
+      keep_last: number of most recent step checkpoints kept per directory, 0 keeps all.
+      keep_every: step checkpoints whose step is a multiple of keep_every are never removed, 0 to disable.
+      async_save: write on a background thread, otherwise save() blocks until the file is written.
+      max_pending: number of snapshots queued before save() blocks, bounds the host memory held by pending writes.
+    '''
+    def __init__(self, keep_last=0, keep_every=0, async_save=True, max_pending=1):
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.async_save = async_save
+        self._history = {} # directory -> [(step, path)] of step checkpoints written by this writer
+        self._error = None
+        self._queue = None
+        self._thread = None
+        if async_save:
+            self._queue = queue.Queue(maxsize=max(max_pending, 1))
+            self._thread = threading.Thread(target=self._worker, name='ckpt_writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def save(self, state, path, step=None, latest=None):
+        '''Snapshot state and write it to path.
+        Args:
+          state: dict of state dicts and scalars, as passed to torch.save.
+          step: step or epoch of the checkpoint, enables retention for its directory. None for files
+            that are overwritten in place (e.g. a latest checkpoint saved at the end of an epoch).
+          latest: file name in the same directory that is linked to path after it is written.
+        '''
+        self._raise_error()
+        state = snapshot(state)
+        if self._queue is None:
+            self._write(state, path, step, latest)
+        else:
+            self._queue.put((state, path, step, latest))
+
+    def wait(self):
+        '''Block until every queued checkpoint is on disk'''
+        if self._queue is not None:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._queue.join()
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._queue = None
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("checkpoint writer failed") from error
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                print(f"[Warning!] Failed to write checkpoint {item[1]}: {e}", file=sys.stderr)
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, state, path, step, latest):
+        atomic_save(state, path)
+        if latest is not None:
+            link_latest(path, os.path.join(os.path.dirname(path), latest))
+        if step is not None:
+            self._retain(path, step)
+
+    def _retain(self, path, step):
+        history = self._history.setdefault(os.path.dirname(os.path.abspath(path)), [])
+        history[:] = [(s, p) for s, p in history if p != path] + [(step, path)]
+        if self.keep_last <= 0 or len(history) <= self.keep_last:
+            return
+        kept = history[-self.keep_last:]
+        for s, p in history[:-self.keep_last]:
+            if self.keep_every > 0 and s % self.keep_every == 0:
+                kept.insert(0, (s, p))
+            elif os.path.exists(p):
+                os.remove(p)
+        history[:] = sorted(kept, key=lambda x: x[0])
@@ -0,0 +1,49 @@
+import os, sys
+import datetime
+import torch
+import torch.distributed as dist
+
+# Helpers for DistributedDataParallel training, launched with
+# torchrun --nproc_per_node N run_nerf.py --ddp ... (or python -m torch.distributed.launch --use_env)
+
+def init_distributed(backend=None):
+    '''Join the process group described by the launcher environment.
+    Args:
+      backend: 'nccl' or 'gloo', defaults to nccl with CUDA and gloo on CPU.
+    Returns:
+      rank, local_rank, world_size
+    '''
+    rank = int(os.environ['RANK'])
+    world_size = int(os.environ['WORLD_SIZE'])
+    local_rank = int(os.environ.get('LOCAL_RANK', rank))
+    if backend in [None, 'None', '']:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    # rank 0 evaluates and renders videos while the other ranks wait in the next all-reduce
+    dist.init_process_group(backend, init_method='env://', world_size=world_size, rank=rank,
+                            timeout=datetime.timedelta(hours=2))
+    print(f"[Info]: DDP rank {rank}/{world_size}, local rank {local_rank}, backend {backend}")
+    return rank, local_rank, world_size
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+def unwrap(model):
+    '''Module inside DataParallel / DistributedDataParallel'''
+    return getattr(model, 'module', model)
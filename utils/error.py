@@ -2,7 +2,12 @@ import os, sys
 import numpy as np
 import torch
 
-DEBUG = True
+# Numerical checks are expensive on the hot path, enable them with NERF_DEBUG=1 or --debug
+DEBUG = os.environ.get('NERF_DEBUG', '0') == '1'
+
+def set_debug(flag):
+    global DEBUG
+    DEBUG = flag
 
 def CHECK(**kwargs):
     if not DEBUG: return
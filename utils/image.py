@@ -60,4 +60,11 @@ def export_images(rgbs, save_dir, H=0, W=0):
     return np.stack(rgb8s, 0)
 
 def export_video(rgbs, save_path, fps=30, quality=8):
-    imageio.mimwrite(save_path, to8b(rgbs), fps=fps, quality=quality)
\ No newline at end of file
+    '''Encode an iterable of [H, W, 3] float frames one at a time, with H.264 through imageio/ffmpeg'''
+    from utils.video import VideoWriter
+    writer = VideoWriter(save_path, fps=fps, codec='libx264', quality=quality)
+    try:
+        for rgb in rgbs:
+            writer.write(to8b(rgb))
+    finally:
+        writer.close()
\ No newline at end of file
@@ -0,0 +1,59 @@
+import functools
+import torch
+
+# Mixed precision helpers for --precision {fp32, fp16, bf16}
+
+PRECISIONS = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def autocast(precision='fp32', device_type='cuda'):
+    '''Autocast context of the given precision, a no-op for fp32'''
+    dtype = PRECISIONS[precision]
+    enabled = dtype != torch.float32
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device_type, dtype=dtype, enabled=enabled)
+    # torch < 1.10 only has CUDA fp16 autocast
+    if enabled and (device_type != 'cuda' or dtype != torch.float16):
+        raise ValueError(f"precision {precision} on {device_type} requires torch >= 1.10")
+    return torch.cuda.amp.autocast(enabled=enabled)
+
+
+def grad_scaler(precision='fp32'):
+    '''Loss scaler for fp16 gradients, disabled otherwise so scale/step/update fall back to plain backward and step.
+    bf16 keeps the fp32 exponent range and needs no scaling.
+    '''
+    return torch.cuda.amp.GradScaler(enabled=(precision == 'fp16' and torch.cuda.is_available()))
+
+
+def is_autocast_enabled():
+    if torch.is_autocast_enabled():
+        return True
+    return hasattr(torch, 'is_autocast_cpu_enabled') and torch.is_autocast_cpu_enabled()
+
+
+def _no_autocast():
+    if hasattr(torch, 'autocast'):
+        return torch.autocast('cuda', enabled=False), torch.autocast('cpu', enabled=False)
+    return torch.cuda.amp.autocast(enabled=False), torch.cuda.amp.autocast(enabled=False)
+
+
+def _to_float(x):
+    if torch.is_tensor(x) and x.is_floating_point():
+        return x.float()
+    return x
+
+
+def float32(fn):
+    '''Decorator running fn in fp32 under autocast, floating point tensor arguments are cast to fp32.
+    Used for numerically sensitive ops such as cumulative products, CDF inversion and Gram matrices.
+    '''
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not is_autocast_enabled():
+            return fn(*args, **kwargs)
+        no_cuda, no_cpu = _no_autocast()
+        with no_cuda, no_cpu:
+            args = [_to_float(a) for a in args]
+            kwargs = {k: _to_float(v) for k, v in kwargs.items()}
+            return fn(*args, **kwargs)
+    return wrapper
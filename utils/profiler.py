@@ -0,0 +1,151 @@
+import os, sys
+import time, json, threading
+import torch
+
+# Opt-in profiling spans around the hot path of rendering.
+# When disabled, span() returns a shared no-op context and records nothing.
+
+ENABLED = False
+SYNC = False # synchronize CUDA at span boundaries so that wall time is attributed to the right span
+
+_lock = threading.Lock()
+_origin = 0.
+_stats = {} # name -> [calls, seconds, numel] since the last log()
+_steps = 0
+_trace = [] # Chrome trace events
+_trace_steps = 0
+_trace_path = None
+_trace_dirty = False
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('name', 'numel', 't0')
+
+    def __init__(self, name, numel):
+        self.name = name
+        self.numel = numel
+
+    def __enter__(self):
+        if SYNC:
+            torch.cuda.synchronize()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if SYNC:
+            torch.cuda.synchronize()
+        t1 = time.perf_counter()
+        _record(self.name, self.t0, t1, self.numel)
+        return False
+
+
+def enable(flag=True, sync=None, trace_path=None, trace_steps=10):
+    '''Turn profiling on or off.
+    Args:
+      sync: synchronize CUDA around spans, defaults to True if CUDA is available.
+      trace_path: Chrome trace JSON (chrome://tracing, Perfetto) written by log(), None to skip tracing.
+      trace_steps: number of steps kept in the trace.
+    '''
+    global ENABLED, SYNC, _origin, _trace_path, _trace_steps
+    ENABLED = flag
+    SYNC = torch.cuda.is_available() if sync is None else sync
+    _origin = time.perf_counter()
+    _trace_path = trace_path
+    _trace_steps = trace_steps if trace_path else 0
+    reset()
+
+
+def reset():
+    global _steps
+    with _lock:
+        _stats.clear()
+        _steps = 0
+
+
+def span(name, *tensors):
+    '''Context manager timing the enclosed block under name, tensors are counted into the size of the span.
+    Spans nest, the time of a span includes the spans inside it.
+    '''
+    if not ENABLED:
+        return _NULL_SPAN
+    numel = 0
+    for t in tensors:
+        if t is not None:
+            numel += t.numel()
+    return _Span(name, numel)
+
+
+def _record(name, t0, t1, numel):
+    global _trace_dirty
+    with _lock:
+        s = _stats.get(name)
+        if s is None:
+            s = _stats[name] = [0, 0., 0]
+        s[0] += 1
+        s[1] += t1 - t0
+        s[2] += numel
+        if _trace_steps > 0:
+            _trace.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                           'ts': (t0 - _origin) * 1e6, 'dur': (t1 - t0) * 1e6, 'args': {'numel': numel}})
+            _trace_dirty = True
+
+
+def step():
+    '''Mark the end of a training step'''
+    global _steps, _trace_steps
+    if not ENABLED:
+        return
+    _steps += 1
+    if _trace_steps > 0:
+        _trace_steps -= 1
+        if _trace_steps == 0:
+            export_chrome_trace()
+
+
+def summary():
+    '''Per span statistics averaged over the steps since the last log()
+    Returns:
+      dict name -> dict(ms, calls, numel) per step.
+    '''
+    steps = max(_steps, 1)
+    with _lock:
+        return {k: dict(ms=s[1] * 1e3 / steps, calls=s[0] / steps, numel=s[2] / steps) for k, s in _stats.items()}
+
+
+def log(summary_writer=None, global_step=0, verbose=True):
+    '''Write span statistics to the summary writer and the trace file, then start a new window'''
+    if not ENABLED:
+        return
+    stats = summary()
+    for k, s in sorted(stats.items()):
+        if summary_writer is not None:
+            summary_writer.add_scalar(f'profile/{k}/ms', s['ms'], global_step)
+            summary_writer.add_scalar(f'profile/{k}/calls', s['calls'], global_step)
+            summary_writer.add_scalar(f'profile/{k}/numel', s['numel'], global_step)
+        if verbose:
+            print(f"[Profile]: {k:<24} {s['ms']:>10.3f} ms/step {s['calls']:>8.1f} calls/step {int(s['numel']):>12d} elems/step")
+    export_chrome_trace()
+    reset()
+
+
+def export_chrome_trace(path=None):
+    global _trace_dirty
+    path = path or _trace_path
+    if path is None or not _trace_dirty:
+        return
+    with _lock:
+        events = list(_trace)
+        _trace_dirty = False
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    print(f"[Profile]: Saved {len(events)} trace events to {path}")
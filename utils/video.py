@@ -0,0 +1,120 @@
+import os, sys
+import queue, threading
+import numpy as np
+
+import cv2
+import imageio
+
+# Streaming video encoding, frames are encoded on a background thread as they are rendered
+# instead of being buffered until the end of the trajectory.
+
+
+class VideoWriter:
+    '''Background mp4 writer.
+    The video is encoded into a partial file that is renamed to path by close(), so an interrupted job never
+    leaves a truncated video behind.
+    Args:
+      path: output video path.
+      fps: frames per second.
+      size: (W, H) every frame is resized to, None keeps the native size of the first frame.
+      frame_dir: directory every frame is also saved to as PNG. A rerun can pass frames that are already
+        saved as None to write() and skip rendering them, see has_frame().
+      max_pending: number of frames queued before write() blocks.
+      codec: 'mp4v' encodes with OpenCV, any other value (e.g. 'libx264') is passed to the imageio ffmpeg writer.
+      quality: imageio ffmpeg quality from 0 to 10, None for the imageio default. Ignored with 'mp4v'.
+    '''
+    def __init__(self, path, fps=30, size=None, frame_dir=None, max_pending=8, codec='mp4v', quality=None):
+        self.path = path
+        root, ext = os.path.splitext(path)
+        self.partial_path = root + '.partial' + ext
+        self.fps = fps
+        self.codec = codec
+        self.quality = quality
+        self.size = tuple(size) if size is not None else None
+        self.frame_dir = frame_dir
+        if frame_dir is not None:
+            os.makedirs(frame_dir, exist_ok=True)
+        self.count = 0
+        self._writer = None
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._worker, name='video_writer', daemon=True)
+        self._thread.start()
+
+    def frame_path(self, index):
+        return os.path.join(self.frame_dir, f'{index:05d}.png')
+
+    def has_frame(self, index):
+        return self.frame_dir is not None and os.path.exists(self.frame_path(index))
+
+    def write(self, frame, index=None):
+        '''Queue a frame for encoding.
+        Args:
+          frame: uint8 [H, W, 3] RGB or [H, W(, 1)] grayscale, None to encode the frame saved in frame_dir.
+          index: frame index, defaults to the number of frames written so far.
+        '''
+        if self._error is not None:
+            self.close()
+        index = self.count if index is None else index
+        if frame is None and not self.has_frame(index):
+            raise FileNotFoundError(f"frame {index} of {self.path} is not saved")
+        self.count = index + 1
+        self._queue.put((index, frame))
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            if self._writer is not None:
+                if self.codec == 'mp4v':
+                    self._writer.release()
+                else:
+                    self._writer.close()
+                self._writer = None
+                if self._error is None:
+                    os.replace(self.partial_path, self.path)
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError(f"failed to write video {self.path}") from error
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+            index, frame = item
+            try:
+                if frame is None:
+                    frame = imageio.imread(self.frame_path(index))
+                elif self.frame_dir is not None:
+                    tmp_path = os.path.join(self.frame_dir, f'{index:05d}_tmp.png')
+                    imageio.imwrite(tmp_path, frame)
+                    os.replace(tmp_path, self.frame_path(index))
+                self._encode(frame)
+            except Exception as e:
+                print(f"[Warning!] Failed to write frame {index} of {self.path}: {e}", file=sys.stderr)
+                self._error = e
+
+    def _encode(self, frame):
+        if frame.ndim == 3 and frame.shape[-1] == 1:
+            frame = frame[..., 0]
+        if frame.ndim == 2:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB)
+        else:
+            frame = frame[..., :3]
+        if self._writer is None:
+            if self.size is None:
+                self.size = (frame.shape[1], frame.shape[0])
+            if self.codec == 'mp4v':
+                self._writer = cv2.VideoWriter(self.partial_path, cv2.VideoWriter_fourcc('M','P','4','V'), self.fps, self.size, True)
+            else:
+                self._writer = imageio.get_writer(self.partial_path, fps=self.fps, codec=self.codec, quality=self.quality)
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            frame = cv2.resize(frame, self.size)
+        if self.codec == 'mp4v':
+            self._writer.write(np.ascontiguousarray(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)))
+        else:
+            self._writer.append_data(np.ascontiguousarray(frame))